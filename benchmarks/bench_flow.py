@@ -0,0 +1,87 @@
+'''
+© fergascod & asleix
+Latency of the min cost flow solvers of /distribute.
+
+    python benchmarks/bench_flow.py [--sizes real 5000 20000] [--solvers networkx highs]
+
+Every solver (see flow.py) solves the flow network of the 1000 m graph for
+random station status and several required bikes and docks. All of them
+must give the same cost and the same worst move.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+import flow
+import geometry
+import synthetic
+from graph import BIKE_SPEED, Graph, Stations
+
+
+def status(n, seed=0):
+    ''' Random bikes and docks of n stations, as in synthetic.write_gbfs. '''
+    rng = np.random.default_rng(seed)
+    capacity = rng.integers(15, 36, n)
+    bikes = rng.integers(0, capacity + 1)
+    return bikes, capacity - bikes
+
+
+def worst_move(network, flow_):
+    ''' Returns the move (source, destination, bikes, distance) of highest cost. '''
+    moves = np.flatnonzero(flow_[network.first_edge:]) + network.first_edge
+    if len(moves) == 0:
+        return None
+    arc = moves[np.argmax(flow_[moves] * network.cost[moves])]
+    return (int(network.tail[arc] - network.n), int(network.head[arc] - network.n),
+            int(flow_[arc]), int(network.cost[arc]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sizes', nargs='+', default=['real', '5000', '20000'])
+    parser.add_argument('--solvers', nargs='+', default=list(flow.SOLVERS))
+    parser.add_argument('--distance', type=int, default=1000)
+    parser.add_argument('--required', nargs='+', default=['1,1', '2,2', '4,3'],
+                        help='required bikes and docks, as b,d')
+    args = parser.parse_args()
+
+    solvers = [flow.solver(name) for name in args.solvers]
+    print('%8s %9s %6s %10s' % ('stations', 'arcs', 'b,d', 'cost (km)') +
+          ''.join(' %13s' % (s.name + ' (ms)') for s in solvers))
+    for size in args.sizes:
+        lat, lon = (synthetic.bicing() if size == 'real'
+                    else synthetic.stations(int(size)))
+        n = len(lat)
+        u, v, dist = geometry.geometric_edges(lat, lon, args.distance / 1000)
+        G = Graph(Stations(np.arange(n), lat, lon), u, v, dist / BIKE_SPEED)
+        network = flow.FlowNetwork(G)
+        bikes, docks = status(n)
+
+        for required in args.required:
+            rb, rd = map(int, required.split(','))
+            demand, capacity = network.status(bikes, docks, rb, rd)
+            results, times = [], []
+            for solver in solvers:
+                start = time.perf_counter()
+                try:
+                    cost, flow_ = network.solve(demand, capacity, solver)
+                    results.append((cost, worst_move(network, flow_)))
+                except flow.Unfeasible:
+                    results.append(None)
+                times.append(time.perf_counter() - start)
+
+            assert all(r == results[0] for r in results), \
+                'Solvers disagree: %s' % results
+            cost = 'unfeasible' if results[0] is None else '%.3f' % (results[0][0] / 1000)
+            print('%8d %9d %6s %10s' % (n, network.number_of_arcs(), required, cost) +
+                  ''.join(' %13.1f' % (1000 * t) for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+© fergascod & asleix
+Parse time and peak memory of the GBFS feeds, gbfs.py against pandas.
+
+    python benchmarks/bench_gbfs.py [--sizes real 10000 100000] [--repeat 3]
+
+The pandas path is the one the bot used: pd.read_json of the whole feed
+and pd.DataFrame.from_records of its stations, taking the columns needed.
+Both must give the same arrays (pandas reads floats up to an ulp off).
+Peak memory is measured with tracemalloc (allocations made while parsing,
+the content of the feed excluded).
+'''
+
+import argparse
+from io import BytesIO
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+import pandas as pd
+
+import gbfs
+import synthetic
+
+
+def pandas_information(content):
+    bicing = pd.DataFrame.from_records(
+        pd.read_json(BytesIO(content))['data']['stations'], index='station_id')
+    return (bicing.index.to_numpy(), bicing.lat.to_numpy(float),
+            bicing.lon.to_numpy(float))
+
+
+def pandas_status(content):
+    status = pd.DataFrame.from_records(
+        pd.read_json(BytesIO(content))['data']['stations'], index='station_id')
+    return (status.index.to_numpy(), status.num_bikes_available.to_numpy(),
+            status.num_docks_available.to_numpy())
+
+
+def gbfs_status(content):
+    return gbfs.status(content)[2:]
+
+
+def measure(f, content, repeat):
+    ''' Returns the best time (ms), the peak memory (MB) and the result. '''
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = f(content)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    f(content)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return 1000 * best, peak / 2**20, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sizes', nargs='+', default=['real', '10000', '100000'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('%-12s %8s %8s %12s %12s %12s %12s' % (
+        'feed', 'stations', 'MB', 'pandas (ms)', 'gbfs (ms)', 'pandas (MB)',
+        'gbfs (MB)'))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            n = synthetic.REAL_STATIONS if size == 'real' else int(size)
+            path = synthetic.write_gbfs(os.path.join(directory, size), n)
+            for feed, old, new in (
+                    ('information', pandas_information, gbfs.information),
+                    ('status', pandas_status, gbfs_status)):
+                with open(path + 'station_' + feed, 'rb') as file:
+                    content = file.read()
+                t_old, m_old, expected = measure(old, content, args.repeat)
+                t_new, m_new, found = measure(new, content, args.repeat)
+                # pandas can be 1 ulp off in the coordinates, json is exact
+                for a, b in zip(expected, found):
+                    assert np.array_equal(a, b) or np.allclose(a, b, 0, 1e-12)
+                print('%-12s %8d %8.1f %12.1f %12.1f %12.1f %12.1f' % (
+                    feed, n, len(content) / 2**20, t_old, t_new, m_old, m_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+© fergascod & asleix
+Benchmark of the construction of the geometric graph.
+
+    python benchmarks/bench_graph.py [--distance 1000] [--sizes real 10000]
+
+Compares the original builder (pure Python grid into a networkx graph)
+with geometry.Grid, both alone (edge arrays) and building a graph.Graph.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import networkx as nx
+import numpy as np
+
+import geometry
+from graph import Graph, Stations
+import legacy
+import synthetic
+
+
+def timed(f, *args, repeat=1):
+    ''' Returns the best time (s) of repeat runs and the last result. '''
+    best = float('inf')
+    for i in range(repeat):
+        t = time.perf_counter()
+        result = f(*args)
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+
+def build_legacy(nodes, d):
+    G = nx.Graph()
+    G.add_nodes_from(nodes)
+    legacy.geometric_graph(G, nodes, d)
+    return G
+
+
+def build(stations, d):
+    u, v, dist = geometry.geometric_edges(stations.lat, stations.lon, d)
+    return Graph(stations, u, v, dist / 10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--distance', type=int, default=1000, help='meters')
+    parser.add_argument('--sizes', nargs='+', default=['real', '10000', '100000'])
+    parser.add_argument('--legacy-limit', type=int, default=100000,
+                        help='largest size run with the original builder')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    d = args.distance / 1000
+
+    print('%8s %10s %12s %12s %12s %8s' % ('stations', 'edges', 'legacy (s)',
+          'arrays (s)', 'graph (s)', 'speedup'))
+    for size in args.sizes:
+        lat, lon = (synthetic.bicing() if size == 'real'
+                    else synthetic.stations(int(size)))
+        stations = Stations(np.arange(len(lat)), lat, lon)
+        nodes = stations.nodes()
+
+        t_arrays, (u, v, dist) = timed(geometry.geometric_edges, lat, lon, d,
+                                       repeat=args.repeat)
+        t_new, G = timed(build, stations, d, repeat=args.repeat)
+
+        t_old = float('nan')
+        if len(nodes) <= args.legacy_limit:
+            t_old, G_old = timed(build_legacy, nodes, d)
+            old = {frozenset((a.id, b.id)) for a, b in G_old.edges}
+            new = {frozenset(e) for e in zip(*G.edges()[:2])}
+            missing, extra = len(old - new), len(new - old)
+            assert missing == 0, '%d edges of the original graph are missing' % missing
+            if extra:
+                # The original loop skipped the last row and column of cells
+                print('  note: %d edges in the last grid column were '
+                      'not built by the original builder' % extra)
+
+        print('%8d %10d %12.3f %12.3f %12.3f %8.1f' % (
+            len(nodes), len(u), t_old, t_arrays, t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+'''
+© fergascod & asleix
+Storage and query latency of the history of the station status.
+
+    python benchmarks/bench_history.py [--stations 520] [--days 7] [--interval 30] [--changes 0.03] [--queries 200]
+
+Records a synthetic status every interval seconds for some days, where
+each station changes its bikes with probability changes, into a
+recorder.HistoryFile. Reports the bytes per day against storing every
+status whole, and the latency of the queries of a station over windows of
+1, 24 and 168 hours, with the chunks cached and after reopening the file.
+Every query is checked against the statuses recorded.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+from graph import Stations
+from poller import StationStatus
+import recorder
+import synthetic
+
+
+START = 1700000000
+
+
+def statuses(n, polls, interval, changes, seed=0):
+    ''' Generates (time, bikes, docks) of a random walk of the stations. '''
+    rng = np.random.default_rng(seed)
+    capacity = rng.integers(15, 35, n)
+    bikes = rng.integers(0, capacity + 1)
+    for poll in range(polls):
+        move = rng.random(n) < changes
+        bikes = np.clip(bikes + move * rng.integers(-3, 4, n), 0, capacity)
+        missing = rng.random(n) < 0.001   # Out of the feed for a while
+        yield (START + poll * interval, np.where(missing, -1, bikes),
+               np.where(missing, -1, capacity - bikes))
+
+
+def check(H, states, times, station, start, end):
+    ''' Asserts that the query gives the recorded bikes of every status. '''
+    t, bikes, docks = H.query(station, start, end)
+    polls = np.flatnonzero((times >= start) & (times <= end))
+    at = np.searchsorted(t, times[polls], 'right') - 1
+    assert (at >= 0).all()
+    assert np.array_equal(bikes[at], states[polls, station])
+
+
+def latency(H, n, hours, end, queries, rng):
+    ''' Mean ms of the queries of random stations over the last hours. '''
+    stations = rng.integers(0, n, queries).tolist()
+    start = time.perf_counter()
+    for s in stations:
+        H.query(s, end - hours * 3600, end)
+    return 1000 * (time.perf_counter() - start) / queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--stations', type=int, default=synthetic.REAL_STATIONS)
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--interval', type=int, default=30, help='seconds')
+    parser.add_argument('--changes', type=float, default=0.03)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    n = args.stations
+    polls = int(args.days * 24 * 3600 / args.interval)
+    lat, lon = synthetic.stations(n)
+    stations = Stations(np.arange(n), lat, lon)
+    states = np.empty((polls, n), np.int16)
+    times = START + args.interval * np.arange(polls)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'history.bin')
+        H = recorder.HistoryFile(path)
+        start = time.perf_counter()
+        last = None
+        for poll, (t, bikes, docks) in enumerate(
+                statuses(n, polls, args.interval, args.changes)):
+            states[poll] = bikes
+            changed = np.arange(n) if last is None else np.flatnonzero(
+                (bikes != last[0]) | (docks != last[1]))   # As the poller
+            last = bikes, docks
+            H.append(StationStatus(poll, stations, int(t), args.interval,
+                                   bikes, docks, changed))
+        H.close()
+        elapsed = time.perf_counter() - start
+
+        records = sum(chunk[4] for chunk in H._chunks)
+        print('%d statuses of %d stations in %d chunks, %.3f ms each' % (
+            polls, n, len(H._chunks), 1000 * elapsed / polls))
+        print('records per day: %d (%.1f per status)' % (
+            records / args.days, records / polls))
+        print('bytes per day: %.0f KB on disk, %.0f KB of records, '
+              '%.0f KB storing every status' % (
+                  H.nbytes / args.days / 1024,
+                  records * recorder.RECORD_BYTES / args.days / 1024,
+                  polls * n * recorder.RECORD_BYTES / args.days / 1024))
+
+        rng = np.random.default_rng(1)
+        end = int(times[-1])
+        for i in range(args.queries):
+            station = int(rng.integers(n))
+            a, b = sorted(rng.integers(START - 3600, end + 3600, 2).tolist())
+            check(H, states, times, station, a, b)
+
+        print('\n%8s %12s %12s' % ('hours', 'cached (ms)', 'reopened (ms)'))
+        for hours in (1, 24, 168):
+            if hours > args.days * 24:
+                continue
+            cached = latency(H, n, hours, end, args.queries, rng)
+            reopened = latency(recorder.HistoryFile(path), n, hours, end, 1, rng)
+            print('%8d %12.3f %12.3f' % (hours, cached, reopened))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+© fergascod & asleix
+Memory used by one geometric graph.
+
+    python benchmarks/bench_memory.py [--distance 1000] [--sizes real 10000]
+
+Compares the original networkx graph of Node objects with graph.Graph.
+'''
+
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import networkx as nx
+import numpy as np
+
+import geometry
+import legacy
+import synthetic
+from graph import Graph, Stations
+
+
+def allocated(f, *args):
+    ''' Returns the memory (bytes) still allocated by f and its result. '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = f(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def build_legacy(lat, lon, d):
+    nodes = [legacy.Node(la, lo, i) for i, (la, lo) in
+             enumerate(zip(lat.tolist(), lon.tolist()))]
+    G = nx.Graph()
+    G.add_nodes_from(nodes)
+    legacy.geometric_graph(G, nodes, d)
+    return G
+
+
+def build(lat, lon, d):
+    stations = Stations(np.arange(len(lat)), lat, lon)
+    u, v, dist = geometry.geometric_edges(lat, lon, d)
+    return Graph(stations, u, v, dist / 10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--distance', type=int, default=1000, help='meters')
+    parser.add_argument('--sizes', nargs='+', default=['real', '10000'])
+    args = parser.parse_args()
+    d = args.distance / 1000
+
+    print('%8s %10s %14s %14s %14s' % ('stations', 'edges', 'networkx (KB)',
+          'csr (KB)', 'stations (KB)'))
+    for size in args.sizes:
+        lat, lon = (synthetic.bicing() if size == 'real'
+                    else synthetic.stations(int(size)))
+        old, G_old = allocated(build_legacy, lat, lon, d)
+        new, G = allocated(build, lat, lon, d)
+        print('%8d %10d %14.1f %14.1f %14.1f' % (
+            len(lat), G.number_of_edges(), old / 1024, G.nbytes / 1024,
+            G.stations.nbytes / 1024))
+
+
+if __name__ == '__main__':
+    main()
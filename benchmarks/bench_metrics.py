@@ -0,0 +1,59 @@
+'''
+© fergascod & asleix
+Overhead of the instrumentation of metrics.py, disabled and enabled.
+
+    python benchmarks/bench_metrics.py [--calls 200000]
+
+Times the calls made on every request (metrics.request, metrics.phase,
+metrics.hit) and prints a sample of the Prometheus exposition.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import metrics
+
+
+def per_call(fn, calls):
+    ''' Mean microseconds of fn(). '''
+    start = time.perf_counter()
+    for i in range(calls):
+        fn()
+    return 1e6 * (time.perf_counter() - start) / calls
+
+
+def phase():
+    with metrics.phase('solve'):
+        pass
+
+
+def request():
+    with metrics.request('get_route'):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+
+    print('%-10s %14s %14s' % ('call', 'disabled (us)', 'enabled (us)'))
+    for name, fn in (('phase', phase), ('hit', lambda: metrics.hit('graph')),
+                     ('request', request)):
+        times = []
+        for enabled in (False, True):
+            metrics.ENABLED = enabled
+            times.append(per_call(fn, args.calls))
+        print('%-10s %14.3f %14.3f' % (name, *times))
+
+    print()
+    print('\n'.join(line for line in metrics.exposition().split('\n')
+                    if '_bucket' not in line))
+
+
+if __name__ == '__main__':
+    main()
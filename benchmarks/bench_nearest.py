@@ -0,0 +1,78 @@
+'''
+© fergascod & asleix
+Latency of k nearest and radius queries of the spatial index of stations.
+
+    python benchmarks/bench_nearest.py [--sizes real 10000 100000] [--k 5] [--radius 0.5]
+
+Compares geometry.SpatialIndex with a linear scan (vectorized haversine
+to every station). Both must find the same stations.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+import geometry
+import synthetic
+
+
+def scan_nearest(lat, lon, qlat, qlon, k):
+    dist = geometry.haversine(qlat, qlon, lat, lon)
+    idx = np.argpartition(dist, k - 1)[:k] if k < len(dist) else np.arange(len(dist))
+    idx = idx[np.argsort(dist[idx], kind='stable')]
+    return idx, dist[idx]
+
+
+def scan_within(lat, lon, qlat, qlon, radius):
+    dist = geometry.haversine(qlat, qlon, lat, lon)
+    idx = np.flatnonzero(dist <= radius)
+    idx = idx[np.argsort(dist[idx], kind='stable')]
+    return idx, dist[idx]
+
+
+def timed(fn, queries):
+    ''' Returns the results of fn for every query and the mean ms. '''
+    start = time.perf_counter()
+    results = [fn(*q) for q in queries]
+    return results, 1000 * (time.perf_counter() - start) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sizes', nargs='+', default=['real', '10000', '100000'])
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--radius', type=float, default=0.5, help='km')
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    print('%8s %10s %8s %12s %12s %8s' % ('stations', 'build (ms)', 'query',
+                                          'scan (ms)', 'index (ms)', 'speedup'))
+    for size in args.sizes:
+        lat, lon = (synthetic.bicing() if size == 'real'
+                    else synthetic.stations(int(size)))
+        start = time.perf_counter()
+        index = geometry.SpatialIndex(lat, lon)
+        build = 1000 * (time.perf_counter() - start)
+
+        rng = np.random.default_rng(0)
+        points = list(zip(rng.uniform(lat.min(), lat.max(), args.queries).tolist(),
+                          rng.uniform(lon.min(), lon.max(), args.queries).tolist()))
+
+        for name, scan, query, param in (
+                ('k=%d' % args.k, scan_nearest, index.nearest, args.k),
+                ('r=%gkm' % args.radius, scan_within, index.within, args.radius)):
+            expected, t_scan = timed(lambda a, b: scan(lat, lon, a, b, param), points)
+            found, t_index = timed(lambda a, b: query(a, b, param), points)
+            for (i1, d1), (i2, d2) in zip(expected, found):
+                assert np.allclose(d1, d2) and set(i1) == set(i2)
+            print('%8d %10.1f %8s %12.3f %12.3f %8.1f' % (
+                len(lat), build, name, t_scan, t_index, t_scan / t_index))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''
+© fergascod & asleix
+Build time, memory and query latency of the distance oracle of a graph.
+
+    python benchmarks/bench_oracle.py [--sizes real 1000 3000] [--distance 1000] [--queries 200] [--km 2]
+
+The oracle (graph.DistanceOracle) keeps the shortest bike distances
+between every pair of stations. Station-to-station queries are compared
+with nx.dijkstra_path on the same graph, and the stations within km of a
+station (/reach) with a Dijkstra up to km (Graph.distances). All of them
+must give the same distances.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import networkx as nx
+import numpy as np
+
+from graph import BIKE_SPEED, DistanceOracle, Graph, Stations
+import geometry
+import synthetic
+
+
+def per_call(f, args):
+    ''' Returns the mean time (us) of f(*a) for every a in args, and the
+        results. '''
+    start = time.perf_counter()
+    results = [f(*a) for a in args]
+    return 1e6 * (time.perf_counter() - start) / len(args), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sizes', nargs='+', default=['real', '1000', '3000'])
+    parser.add_argument('--distance', type=int, default=1000, help='meters')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--km', type=float, default=2)
+    args = parser.parse_args()
+
+    print('%8s %10s %10s %10s %12s %12s %12s %12s' % (
+        'stations', 'build (s)', 'MB', 'oracle (us)', 'nx path (us)',
+        'speedup', 'reach (us)', 'bounded (us)'))
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        if size == 'real':
+            lat, lon = synthetic.bicing()
+        else:
+            lat, lon = synthetic.stations(int(size))
+        stations = Stations(np.arange(len(lat)), lat, lon)
+        u, v, dist = geometry.geometric_edges(lat, lon, args.distance / 1000)
+        G = Graph(stations, u, v, dist / BIKE_SPEED)
+
+        start = time.perf_counter()
+        oracle = DistanceOracle(G)
+        build = time.perf_counter() - start
+
+        H = nx.Graph()
+        H.add_nodes_from(range(len(stations)))
+        u, v, w = G.edges()
+        H.add_weighted_edges_from(zip(u.tolist(), v.tolist(),
+                                      (w.astype(float) * BIKE_SPEED).tolist()))
+
+        def nx_distance(i, j):
+            try:
+                path = nx.dijkstra_path(H, i, j)
+            except nx.NetworkXNoPath:
+                return np.inf
+            return sum(H[a][b]['weight'] for a, b in zip(path, path[1:]))
+
+        pairs = rng.integers(0, len(stations), (args.queries, 2)).tolist()
+        t_oracle, found = per_call(oracle.query, pairs)
+        t_nx, expected = per_call(nx_distance, pairs)
+        assert np.allclose(found, expected, rtol=1e-5, atol=1e-6)
+
+        sources = [(i, args.km) for i, j in pairs]
+        t_reach, found = per_call(oracle.within, sources)
+        t_bounded, expected = per_call(
+            lambda i, km: G.distances([i], km)[0], sources)
+        for (idx, d), row in zip(found, expected):
+            assert set(idx.tolist()) == set(np.flatnonzero(row <= args.km).tolist())
+            assert np.allclose(d, row[idx], rtol=1e-5, atol=1e-6)
+
+        print('%8d %10.3f %10.1f %10.2f %12.1f %12.0f %12.1f %12.1f' % (
+            len(stations), build, oracle.nbytes / 2**20, t_oracle, t_nx,
+            t_nx / t_oracle, t_reach, t_bounded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+© fergascod & asleix
+Time to output a /distribute plan: top moves, CSV document and map.
+
+    python benchmarks/bench_plan.py [--moves 100 1000 10000 100000] [--top 5]
+
+Random plans over a synthetic network, with the moves as the arrays that
+the solver gives. The top moves (data.top_moves, with a heap) are
+compared with sorting all the moves, and the CSV document (data.plan_csv,
+streamed from the arrays) with a pandas DataFrame of the moves written
+with to_csv. Both must give the same moves. The map is drawn over a blank
+tile.
+'''
+
+import argparse
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('BICING_CPU_WORKERS', '0')
+
+import numpy as np
+import pandas as pd
+
+from graph import BIKE_SPEED, Graph, Stations
+import synthetic
+
+
+def timed(f, *args):
+    ''' Returns the time (ms) of f(*args) and its result. '''
+    start = time.perf_counter()
+    result = f(*args)
+    return 1000 * (time.perf_counter() - start), result
+
+
+def sorted_moves(G, moves, k):
+    src, dst, bikes, dist = moves
+    ids = G.stations.ids.tolist()
+    moves = list(zip([ids[i] for i in src.tolist()],
+                     [ids[j] for j in dst.tolist()], bikes.tolist(),
+                     dist.tolist()))
+    return sorted(moves, key=lambda x: x[2] * x[3], reverse=True)[:k]
+
+
+def pandas_csv(G, moves):
+    import data
+    src, dst, bikes, dist = moves
+    st = G.stations
+    plan = pd.DataFrame({
+        'origin': st.ids[src], 'destination': st.ids[dst], 'bikes': bikes,
+        'distance_m': dist, 'cost_km': bikes * dist / 1000,
+        'origin_lat': st.lat[src], 'origin_lon': st.lon[src],
+        'destination_lat': st.lat[dst], 'destination_lon': st.lon[dst]})
+    plan = plan.sort_values('cost_km', ascending=False, kind='stable')
+    return plan[list(data.PLAN_FIELDS)].to_csv(index=False).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--moves', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000])
+    parser.add_argument('--top', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['BICING_TILE_URL'] = synthetic.write_tile(
+            os.path.join(directory, 'tile.png'))
+        os.environ['BICING_TILE_CACHE'] = os.path.join(directory, 'tiles')
+        import data
+
+        print('%8s %10s %10s %10s %10s %10s' % ('moves', 'heap (ms)',
+              'sort (ms)', 'csv (ms)', 'pandas (ms)', 'map (ms)'))
+        rng = np.random.default_rng(0)
+        for m in args.moves:
+            n = max(synthetic.REAL_STATIONS, m // 10)
+            lat, lon = synthetic.stations(n)
+            G = Graph(Stations(np.arange(n), lat, lon), np.empty(0, int),
+                      np.empty(0, int), np.empty(0) / BIKE_SPEED)
+            moves = (rng.integers(0, n, m), rng.integers(0, n, m),
+                     rng.integers(1, 10, m), rng.integers(0, 1000, m))
+
+            t_heap, top = timed(data.top_moves, G, moves, args.top)
+            t_sort, expected = timed(sorted_moves, G, moves, args.top)
+            assert top == expected
+            t_csv, document = timed(data.plan_csv, G, moves)
+            t_pandas, expected = timed(pandas_csv, G, moves)
+            rows = list(csv.reader(io.StringIO(document.decode())))
+            assert rows == list(csv.reader(io.StringIO(expected.decode())))
+            t_map = timed(data.draw_plan, G, moves)[0] if m <= 10000 else None
+
+            print('%8d %10.2f %10.2f %10.1f %10.1f %10s' % (
+                m, t_heap, t_sort, t_csv, t_pandas,
+                '-' if t_map is None else '%.0f' % t_map))
+
+
+if __name__ == '__main__':
+    main()
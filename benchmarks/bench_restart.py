@@ -0,0 +1,78 @@
+'''
+© fergascod & asleix
+Time until the first request can be served after a restart, cold and warm.
+
+    python benchmarks/bench_restart.py [--sizes real 20000] [--users 1000]
+
+Cold: the stations are downloaded (local synthetic feeds) and the graphs
+of the users are built. Warm: they are restored from the state saved by
+data.save_state. Both must give the same graphs.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+import synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sizes', nargs='+', default=['real', '20000'])
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('BICING_CPU_WORKERS', '0')
+    import bot
+    import data
+
+    print('%8s %10s %10s %10s %10s %10s' % ('stations', 'edges', 'cold (ms)',
+          'save (ms)', 'warm (ms)', 'file (MB)'))
+    for size in args.sizes:
+        n = synthetic.REAL_STATIONS if size == 'real' else int(size)
+        rng = np.random.default_rng(0)
+        users = dict(zip(range(args.users),
+                         rng.choice([300, 500, 700, 1000], args.users).tolist()))
+        with tempfile.TemporaryDirectory() as directory:
+            data.GBFS_URL = synthetic.write_gbfs(directory, n)
+            path = os.path.join(directory, 'state.npz')
+
+            data.snapshots, data.graphs = data.SnapshotStore(), data.GraphCache()
+            data._saved = None
+            start = time.perf_counter()
+            cold = bot.BicingBot(users)
+            for user in users:
+                cold.graph(user)
+            cold_ms = 1000 * (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            data.save_state(cold.sessions.distances(), path)
+            save_ms = 1000 * (time.perf_counter() - start)
+
+            data.snapshots, data.graphs = data.SnapshotStore(), data.GraphCache()
+            data._saved = None
+            start = time.perf_counter()
+            warm = bot.BicingBot(data.restore_state(path))
+            for user in users:
+                warm.graph(user)
+            warm_ms = 1000 * (time.perf_counter() - start)
+
+            for user in users:
+                G, H = cold.graph(user), warm.graph(user)
+                assert (np.array_equal(G.offsets, H.offsets) and
+                        np.array_equal(G.indices, H.indices) and
+                        np.array_equal(G.weights, H.weights))
+                assert G.number_of_components() == H.number_of_components()
+            print('%8d %10d %10.1f %10.1f %10.1f %10.1f' % (
+                n, len(data.snapshots.current().edges[0]), cold_ms, save_ms,
+                warm_ms, os.path.getsize(path) / 2**20))
+
+
+if __name__ == '__main__':
+    main()
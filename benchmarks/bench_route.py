@@ -0,0 +1,85 @@
+'''
+© fergascod & asleix
+Latency of a /route query on the Barcelona network.
+
+    python benchmarks/bench_route.py [--distances 1000 500] [--queries 50]
+
+Compares the original model (copy of the networkx graph, walking edges to
+every node and nx.dijkstra_path) with graph.Graph.route (A* on the CSR
+arrays). Both must find routes of the same cost.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import networkx as nx
+import numpy as np
+from haversine import haversine
+
+import geometry
+import legacy
+import synthetic
+from graph import BIKE_SPEED, WALK_SPEED, Graph, Stations
+
+
+def cost(points):
+    ''' Hours to go through points, walking the first and last legs. '''
+    legs = len(points) - 1
+    return sum(haversine(points[i], points[i + 1]) /
+               (WALK_SPEED if i in (0, legs - 1) else BIKE_SPEED)
+               for i in range(legs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--distances', type=int, nargs='+', default=[1000, 500])
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--stations', default='real',
+                        help="'real' or a number of synthetic stations")
+    args = parser.parse_args()
+
+    lat, lon = (synthetic.bicing() if args.stations == 'real'
+                else synthetic.stations(int(args.stations)))
+    stations = Stations(np.arange(len(lat)), lat, lon)
+    nodes = [legacy.Node(la, lo, i) for i, (la, lo) in
+             enumerate(zip(lat.tolist(), lon.tolist()))]
+
+    rng = np.random.default_rng(0)
+    queries = [((rng.uniform(lat.min(), lat.max()), rng.uniform(lon.min(), lon.max())),
+                (rng.uniform(lat.min(), lat.max()), rng.uniform(lon.min(), lon.max())))
+               for i in range(args.queries)]
+
+    print('%9s %10s %14s %14s %8s' % ('distance', 'edges', 'networkx (ms)',
+          'a* (ms)', 'speedup'))
+    for d in args.distances:
+        u, v, dist = geometry.geometric_edges(lat, lon, d / 1000)
+        G = Graph(stations, u, v, dist / BIKE_SPEED)
+        N = nx.Graph()
+        N.add_nodes_from(nodes)
+        legacy.geometric_graph(N, nodes, d / 1000)
+        G.route(*queries[0])   # Builds the spatial index
+
+        t_old = t_new = 0
+        for a, b in queries:
+            t = time.perf_counter()
+            old = legacy.shortest_route(N, a, b)
+            t_old += time.perf_counter() - t
+            t = time.perf_counter()
+            new = G.route(a, b)
+            t_new += time.perf_counter() - t
+
+            old = [(n.lat, n.lon) for n in old]
+            new = [a] + [(lat[i], lon[i]) for i in new] + [b]
+            assert abs(cost(old) - cost(new)) < 1e-9, 'Different route cost'
+
+        print('%9d %10d %14.2f %14.2f %8.1f' % (
+            d, G.number_of_edges(), 1000 * t_old / len(queries),
+            1000 * t_new / len(queries), t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
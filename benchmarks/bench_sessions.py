@@ -0,0 +1,84 @@
+'''
+© fergascod & asleix
+Memory and latency of the session stores of sessions.py.
+
+    python benchmarks/bench_sessions.py [--users 100000] [--lookups 20000]
+
+Measures the memory of a session in memory (sessions.SESSION_BYTES is an
+estimate of it), checks that the least recently used sessions are evicted
+within the budget, and times lookups in memory and in SQLite. A second
+process must see the sessions written to SQLite by the first one.
+'''
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sessions
+
+
+def fill(store, users):
+    for user in range(users):
+        store.set(10**9 + user, 1000 - user % 1000, 1)
+
+
+def per_lookup(store, users, lookups):
+    ''' Mean microseconds of a lookup of a random user. '''
+    rng = random.Random(0)
+    keys = [10**9 + rng.randrange(users) for i in range(lookups)]
+    start = time.perf_counter()
+    for user in keys:
+        store.get(user)
+    return 1e6 * (time.perf_counter() - start) / lookups
+
+
+def other_process(path, user):
+    return sessions.SQLiteSessions(path).get(user)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    store = sessions.MemorySessions(max_bytes=1 << 40)
+    fill(store, args.users)
+    size = tracemalloc.get_traced_memory()[0] / args.users
+    tracemalloc.stop()
+    print('memory of a session: %.0f bytes (estimate %d)' %
+          (size, sessions.SESSION_BYTES))
+
+    budget = sessions.MemorySessions(max_bytes=args.users // 10 *
+                                     sessions.SESSION_BYTES)
+    fill(budget, args.users)
+    assert len(budget) == args.users // 10
+    assert budget.get(10**9) is None and budget.get(10**9 + args.users - 1)
+    print('budget of %d sessions: %d kept, the most recent' %
+          (args.users // 10, len(budget)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sessions.sqlite')
+        db = sessions.SQLiteSessions(path)
+        start = time.perf_counter()
+        fill(db, min(args.users, 5000))
+        write = 1e6 * (time.perf_counter() - start) / min(args.users, 5000)
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            assert pool.apply(other_process, (path, 10**9 + 1)) == (999, 1)
+        print('%-8s %12s %12s' % ('store', 'get (us)', 'set (us)'))
+        print('%-8s %12.2f' % ('memory', per_lookup(store, args.users,
+                                                    args.lookups)))
+        print('%-8s %12.2f %12.1f' % ('sqlite', per_lookup(
+            db, min(args.users, 5000), args.lookups), write))
+
+
+if __name__ == '__main__':
+    main()
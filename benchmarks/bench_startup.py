@@ -0,0 +1,108 @@
+'''
+© fergascod & asleix
+Startup time of the bot: import times and time to the first /help reply.
+
+    python benchmarks/bench_startup.py [--runs 5] [--top 15]
+
+Prints the slowest imports of bot.py (python -X importtime) and the time
+from starting a new interpreter until the reply to /help has been sent,
+through the dispatcher with a fake Telegram bot. It is measured with the
+subsystems imported on first use (lazy) and imported before the reply,
+as when everything was imported with data.py (eager).
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+EAGER = '''
+import networkx, PIL.Image, staticmap, geopy.geocoders, requests
+import data, flow, render
+flow.solver()
+'''
+
+FIRST_HELP = '''
+import sys
+sys.path.insert(0, %(root)r)
+sys.path.insert(0, %(benchmarks)r)
+import time
+from datetime import datetime
+from queue import Queue
+
+import bot
+%(eager)s
+from load_test import FakeBot
+from telegram import Chat, Message, MessageEntity, Update, User
+from telegram.ext import Dispatcher
+import workers
+
+fakebot = FakeBot(0)
+dispatcher = Dispatcher(fakebot, Queue(), workers=1)
+bot.add_handlers(dispatcher, bot.BicingBot(), workers.Serializer())
+message = Message(1, User(1, 'User', False, username='user'), datetime.now(),
+                  Chat(1, 'private', username='user'), text='/help',
+                  bot=fakebot,
+                  entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, 5)])
+dispatcher.process_update(Update(1, message=message))
+while fakebot.messages == 0:
+    time.sleep(0.001)
+print('replied')
+'''
+
+
+def import_times():
+    ''' Returns [(module, self us, cumulative us, depth)] of importing bot. '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import bot'], cwd=ROOT, capture_output=True,
+                            text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), int(own), int(cumulative), depth))
+    return times
+
+
+def first_help(eager):
+    ''' Seconds from starting python until the reply to /help is sent. '''
+    code = FIRST_HELP % {'root': ROOT, 'benchmarks': os.path.join(ROOT,
+                         'benchmarks'), 'eager': EAGER if eager else ''}
+    env = dict(os.environ, BICING_PRELOAD='0', BICING_CPU_WORKERS='0')
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-W', 'ignore', '-c', code],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if 'replied' not in result.stdout:
+        raise RuntimeError(result.stderr)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    times = import_times()
+    total = next(c for name, own, c, depth in times if name == 'bot')
+    print('import bot: %.0f ms. Slowest imports (ms):' % (total / 1000))
+    top = sorted((t for t in times if 1 <= t[3] <= 2), key=lambda t: -t[2])
+    for name, own, cumulative, depth in top[:args.top]:
+        print('  %-40s %8.1f' % ('  ' * (depth - 1) + name, cumulative / 1000))
+
+    print('\nfirst /help reply (ms), median of %d runs:' % args.runs)
+    for mode, eager in (('lazy', False), ('eager', True)):
+        runs = [first_help(eager) for i in range(args.runs)]
+        print('  %-6s %8.0f' % (mode, 1000 * statistics.median(runs)))
+
+
+if __name__ == '__main__':
+    main()
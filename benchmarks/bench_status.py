@@ -0,0 +1,113 @@
+'''
+© fergascod & asleix
+Cost of reading station_status, per request and with the poller.
+
+    python benchmarks/bench_status.py [--stations 520] [--requests 50] [--changes 10]
+
+The GBFS feeds of synthetic stations are served over HTTP from localhost.
+Compares downloading and parsing the status with pandas on every request
+(as /distribute did) with data.statuses (see poller.py): a poll of an
+unchanged feed, a poll after some stations change (which must be reported
+as changed) and reading the status while the poller runs in background.
+'''
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+
+def change(directory, stations, updated):
+    '''
+    Moves a bike from or to the given stations (indices) of the status feed
+    in directory and sets its last_updated.
+    '''
+    path = os.path.join(directory, 'station_status')
+    with open(path) as file:
+        feed = json.load(file)
+    for i in stations:
+        record = feed['data']['stations'][i]
+        step = 1 if record['num_docks_available'] > 0 else -1
+        record['num_bikes_available'] += step
+        record['num_docks_available'] -= step
+    feed['last_updated'] = updated
+    with open(path, 'w') as file:
+        json.dump(feed, file)
+
+
+def timed(fn, repeat):
+    ''' Mean milliseconds of fn(). '''
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn()
+    return 1000 * (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--stations', type=int, default=synthetic.REAL_STATIONS)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--changes', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic.write_gbfs(directory, args.stations, ttl=1)
+        server, url = synthetic.serve(directory)
+
+        import data
+        import poller
+        data.GBFS_URL = url
+        poller.STATUS_MIN_INTERVAL = 0.1
+        data.snapshots.get()
+
+        def pandas_status():
+            bikes = pd.DataFrame.from_records(
+                pd.read_json(data.feed_url('station_status'))['data']['stations'],
+                index='station_id')
+            return bikes[['num_bikes_available', 'num_docks_available']]
+
+        statuses = data.statuses
+        print('%-40s %10.2f ms' % ('pandas download and parse',
+                                   timed(pandas_status, args.requests)))
+        first = statuses.poll()
+        print('%-40s %10.2f ms' % ('poll, unchanged feed',
+                                   timed(statuses.poll, args.requests)))
+        assert statuses.get() is first and statuses.parses == 1
+
+        rng = np.random.default_rng(0)
+        moved = np.sort(rng.choice(args.stations, args.changes, replace=False))
+        change(directory, moved, first.last_updated + 1)
+        start = time.perf_counter()
+        status = statuses.poll()
+        print('%-40s %10.2f ms' % ('poll, %d stations changed' % args.changes,
+                                   1000 * (time.perf_counter() - start)))
+        assert status.version == first.version + 1
+        assert status.changed.tolist() == moved.tolist(), status.changed
+
+        # Concurrent requests while the poller runs in background
+        statuses.start()
+        before = server.requests
+        with ThreadPoolExecutor(16) as pool:
+            start = time.perf_counter()
+            list(pool.map(lambda i: statuses.get(), range(100 * args.requests)))
+            elapsed = time.perf_counter() - start
+        statuses.stop()
+        print('%-40s %10.4f ms' % ('get with the poller running',
+                                   1000 * elapsed / (100 * args.requests)))
+        print('%d requests downloaded the feed %d times (%d parsed in total)' % (
+            100 * args.requests, server.requests - before, statuses.parses))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
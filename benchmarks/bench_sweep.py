@@ -0,0 +1,66 @@
+'''
+© fergascod & asleix
+Time of a /distribute sweep against the same targets run one by one.
+
+    python benchmarks/bench_sweep.py [--stations 520] [--bikes 1..5] [--docks 1..5]
+
+Runs data.sweep_distribution for every pair of required bikes and docks,
+and data.distribute_bikes once for every pair, on local synthetic feeds.
+Both must give the same costs.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import synthetic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--stations', type=int, default=synthetic.REAL_STATIONS)
+    parser.add_argument('--bikes', default='1..5')
+    parser.add_argument('--docks', default='1..5')
+    parser.add_argument('--distance', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['BICING_GBFS_URL'] = synthetic.write_gbfs(directory,
+                                                             args.stations)
+        import bot
+        import data
+        import workers
+        bikeTargets, dockTargets = bot.targets(args.bikes), bot.targets(args.docks)
+        G = data.create_graph(args.distance)
+        data.statuses.get()
+
+        start = time.perf_counter()
+        independent = []
+        for rb in bikeTargets:
+            row = []
+            for rd in dockTargets:
+                try:
+                    row.append(data.distribute_bikes(G, rb, rd)[0])
+                except data.BotException as err:
+                    row.append(0.0 if 'No transportation' in str(err) else None)
+            independent.append(row)
+        one_by_one = time.perf_counter() - start
+
+        costs, sweep = data.sweep_distribution(G, bikeTargets, dockTargets)
+        workers.shutdown()
+
+    assert [[c if c is None else round(c, 3) for c in row] for row in costs] == \
+        [[c if c is None else round(c, 3) for c in row]
+         for row in independent], (costs, independent)
+    n = len(bikeTargets) * len(dockTargets)
+    print('%d targets, %d stations' % (n, args.stations))
+    print('%-14s %8.2f s' % ('one by one', one_by_one))
+    print('%-14s %8.2f s (%.1fx)' % ('sweep', sweep, one_by_one / sweep))
+
+
+if __name__ == '__main__':
+    main()
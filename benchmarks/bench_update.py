@@ -0,0 +1,134 @@
+'''
+© fergascod & asleix
+Updating the graph of a new snapshot from the previous one, against a rebuild.
+
+    python benchmarks/bench_update.py [--stations 100000] [--changes 1 10 100 1000 2000] [--steps 5] [--shuffle]
+
+Starts from a synthetic network and applies random sequences of changes
+(stations added, removed or moved). Every new snapshot is made by
+data.SnapshotStore.following, which updates the grid and the edges of the
+previous snapshot, and its 1000 m graph by data.GraphCache, which updates
+the graph of the previous snapshot. Both are checked against a full
+rebuild: the same edges with the same distances, the same Graph (CSR) and
+the same components. The feed keeps the order of the stations, as the
+Bicing one does, unless --shuffle: then graphs are built again.
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('BICING_CPU_WORKERS', '0')
+
+import numpy as np
+
+import data
+import geometry
+from graph import BIKE_SPEED, Graph, Stations
+import synthetic
+
+
+def change(stations, k, rng, next_id, shuffle=False):
+    '''
+    Returns new stations with k random changes: every change adds a station
+    (at the end), removes one or moves one to a random place of the
+    network. With shuffle, the stations are listed in a random order.
+    '''
+    n = len(stations)
+    kinds = rng.integers(0, 3, k)
+    removed = rng.choice(n, (kinds == 1).sum(), replace=False)
+    keep = np.ones(n, bool)
+    keep[removed] = False
+    ids, lat, lon = (stations.ids[keep], stations.lat[keep].copy(),
+                     stations.lon[keep].copy())
+
+    moved = rng.choice(len(ids), (kinds == 2).sum(), replace=False)
+    new_lat, new_lon = synthetic.stations(n, rng.integers(1 << 30))
+    lat[moved], lon[moved] = new_lat[:len(moved)], new_lon[:len(moved)]
+
+    added = (kinds == 0).sum()
+    ids = np.concatenate([ids, np.arange(next_id, next_id + added)])
+    lat = np.concatenate([lat, new_lat[-added:] if added else []])
+    lon = np.concatenate([lon, new_lon[-added:] if added else []])
+    order = rng.permutation(len(ids)) if shuffle else np.arange(len(ids))
+    return Stations(ids[order], lat[order], lon[order]), next_id + added
+
+
+def canonical(edges):
+    ''' Edges (u, v, dist) with u < v, sorted. '''
+    u, v, dist = edges
+    u, v = np.minimum(u, v), np.maximum(u, v)
+    order = np.lexsort((v, u))
+    return u[order], v[order], dist[order]
+
+
+def check(snapshot, edges, G, H):
+    '''
+    Asserts that snapshot has the rebuilt edges, and that its graph G is
+    the rebuilt graph H.
+    '''
+    for a, b in zip(canonical(snapshot.edges), canonical(edges)):
+        assert np.array_equal(a, b)
+    stations = snapshot.stations
+    for a, b in ((G.offsets, H.offsets), (G.indices, H.indices),
+                 (G.weights, H.weights)):
+        assert np.array_equal(a, b)
+    rebuilt = data.Connectivity(len(stations), *edges)
+    for distance in (100, 300, 500, 1000):
+        assert np.array_equal(snapshot.connectivity.components(distance),
+                              rebuilt.components(distance))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--stations', type=int, default=100000)
+    parser.add_argument('--changes', type=int, nargs='+',
+                        default=[1, 10, 100, 1000, 2000])
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--shuffle', action='store_true')
+    args = parser.parse_args()
+    d = data.MAX_DISTANCE / 1000
+    data.UPDATE_FRACTION = 1   # Always update, to compare at every size
+
+    rng = np.random.default_rng(0)
+    lat, lon = synthetic.stations(args.stations)
+    stations = Stations(np.arange(args.stations), lat, lon)
+    store, graphs = data.SnapshotStore(), data.GraphCache()
+    snapshot = store.following(None, stations)
+    graphs.get(snapshot, data.MAX_DISTANCE)
+    next_id = args.stations
+
+    print('%8s %8s %12s %12s %12s %12s %8s' % (
+        'stations', 'changes', 'update (ms)', 'graph (ms)', 'rebuild (ms)',
+        'graph (ms)', 'speedup'))
+    for k in args.changes:
+        updates, rebuilds = [], []
+        for step in range(args.steps):
+            stations, next_id = change(snapshot.stations, k, rng, next_id,
+                                       args.shuffle)
+            start = time.perf_counter()
+            snapshot = store.following(snapshot, stations)
+            middle = time.perf_counter()
+            G = graphs.get(snapshot, data.MAX_DISTANCE)
+            updates.append((middle - start, time.perf_counter() - middle))
+
+            start = time.perf_counter()
+            edges = geometry.geometric_edges(stations.lat, stations.lon, d)
+            middle = time.perf_counter()
+            H = Graph(stations, *edges[:2], edges[2] / BIKE_SPEED)
+            rebuilds.append((middle - start, time.perf_counter() - middle))
+            check(snapshot, edges, G, H)
+        update, rebuild = np.median(updates, 0), np.median(rebuilds, 0)
+        print('%8d %8d %12.1f %12.1f %12.1f %12.1f %8.1f' % (
+            len(stations), k, *(1000 * update), *(1000 * rebuild),
+            rebuild.sum() / update.sum()))
+
+    same = store.following(snapshot, snapshot.stations)
+    assert same is snapshot   # Same stations, same version
+    print('Same stations keep version %d' % snapshot.version)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+© fergascod & asleix
+Original pure Python implementations, kept as a reference for benchmarks.
+'''
+
+from math import ceil, floor
+
+from haversine import haversine
+
+
+class Node:
+    ''' Original node of the networkx geometric graph. '''
+    def __init__(self, lat_, lon_, station_id=None):
+        self.lat = lat_
+        self.lon = lon_
+        self.id = station_id
+
+    def coords(self):
+        return (self.lon, self.lat)
+
+    def distance_to(self, next):
+        return haversine((self.lat, self.lon), (next.lat, next.lon))
+
+
+def create_grid(G, P, d):
+    ''' Grid of cells of distance d + EPS, as a matrix of lists of nodes. '''
+    EPS = 0.01
+    d_ = d + EPS
+    minlat, minlon, maxlat, maxlon = P[0].lat, P[0].lon, P[0].lat, P[0].lon
+    for node in P:
+        minlat = min(minlat, node.lat)
+        minlon = min(minlon, node.lon)
+        maxlat = max(maxlat, node.lat)
+        maxlon = max(maxlon, node.lon)
+
+    ll, lr = Node(minlat-EPS, minlon-EPS), Node(minlat-EPS, maxlon+EPS)
+    ul, ur = Node(maxlat+EPS, minlon-EPS), Node(maxlat+EPS, maxlon+EPS)
+    n, m = ceil(ll.distance_to(lr)/d_), ceil(ll.distance_to(ul)/d_)
+    grid = [[[] for i in range(m)] for j in range(n)]
+
+    for node in P:
+        aux_x, aux_y = Node(ll.lat, node.lon), Node(node.lat, ll.lon)
+        x, y = floor(ll.distance_to(aux_x)/d_), floor(ll.distance_to(aux_y)/d_)
+        grid[x][y].append(node)
+
+    return grid
+
+
+def geometric_graph(G, P, d):
+    ''' Adds to G the edges of the geometric graph with distance d (km). '''
+    grid = create_grid(G, P, d)
+
+    def create_edges(G, cur, next):
+        for n1 in cur:
+            for n2 in next:
+                dist = n1.distance_to(n2)
+                if dist <= d and n1 is not n2:
+                    G.add_edge(n1, n2, weight=dist/10)
+
+    n, m = len(grid), len(grid[0])
+    for i in range(n-1):
+        for j in range(m-1):
+            create_edges(G, grid[i][j], grid[i][j])
+            create_edges(G, grid[i][j], grid[i+1][j])
+            create_edges(G, grid[i][j], grid[i][j+1])
+            create_edges(G, grid[i][j], grid[i+1][j+1])
+            if j >= 1:
+                create_edges(G, grid[i][j], grid[i+1][j-1])
+
+
+def shortest_route(G_, cood1, cood2):
+    '''
+    Shortest route between two coordinates over a networkx geometric graph,
+    connecting both walking to every node. Returns the list of nodes.
+    '''
+    import networkx as nx
+    G = G_.copy()
+    add1, add2 = Node(cood1[0], cood1[1]), Node(cood2[0], cood2[1])
+    G.add_node(add1)
+    G.add_node(add2)
+    for node in G.nodes():
+        if node is not add1:
+            G.add_edge(add1, node, weight=node.distance_to(add1)/4)
+        if node is not add2:
+            G.add_edge(add2, node, weight=node.distance_to(add2)/4)
+    return nx.dijkstra_path(G, add1, add2)
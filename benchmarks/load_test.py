@@ -0,0 +1,193 @@
+'''
+© fergascod & asleix
+Load test of the bot: replays synthetic updates through the dispatcher.
+
+    python benchmarks/load_test.py [--users 20] [--requests 200] [--latency 0.05]
+
+Telegram is replaced by a fake bot that takes --latency seconds for every
+message, and the Bicing feeds, geocoder and map tiles by local fixtures.
+The same updates are run serially (one thread, no processes, as with the
+original dispatcher) and concurrently (see workers.py), and the latency of
+every command is reported. The order of the requests of each user is checked.
+'''
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import synthetic
+
+
+COMMANDS = [('/nodes', 4), ('/edges', 4), ('/components', 3), ('/summary', 2),
+            ('/help', 2), ('/graph', 3), ('/plotgraph', 2), ('/route', 3),
+            ('/reach', 2), ('/distribute', 2)]
+
+
+class FakeMessage:
+    ''' What the bot methods return: only the photo sizes are used. '''
+    def __init__(self, file_id):
+        self.photo = [type('PhotoSize', (), {'file_id': file_id})]
+
+
+class FakeBot:
+    ''' Stands for telegram.Bot, answering after latency seconds. '''
+    username = 'PyBicingBot'
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.messages = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+        self.messages += 1
+        return FakeMessage(None)
+
+    def send_document(self, chat_id, document, **kwargs):
+        document.read()
+        time.sleep(self.latency)
+        self.messages += 1
+        return FakeMessage(None)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        if not isinstance(photo, str):
+            photo.read()
+        time.sleep(self.latency)
+        self.messages += 1
+        return FakeMessage('file-%d' % self.messages)
+
+
+def fixtures(directory, stations):
+    ''' Writes the local fixtures and points the bot to them. '''
+    os.environ['BICING_GBFS_URL'] = synthetic.write_gbfs(
+        os.path.join(directory, 'gbfs'), stations)
+    gazetteer = os.path.join(directory, 'gazetteer.json')
+    places = synthetic.write_gazetteer(gazetteer)
+    os.environ['BICING_GAZETTEER'] = gazetteer
+    os.environ['BICING_GEOCODE_DB'] = os.path.join(directory, 'geocode.sqlite')
+    os.environ['BICING_TILE_URL'] = synthetic.write_tile(
+        os.path.join(directory, 'tile.png'))
+    return places
+
+
+def updates(fakebot, users, requests, places, seed=0):
+    ''' Returns a list of random command updates from the given users. '''
+    from telegram import Chat, Message, MessageEntity, Update, User
+    rng = random.Random(seed)
+    names = [c for c, w in COMMANDS for i in range(w)]
+    result = []
+    for i in range(requests):
+        user = rng.randrange(users) + 1
+        text = rng.choice(names)
+        if text == '/graph':
+            text += ' %d' % rng.choice([300, 500, 700, 1000])
+        elif text == '/route':
+            text += ' %s, %s' % tuple(rng.sample(places, 2))
+        elif text == '/reach':
+            text += ' %s %d' % (rng.choice(places), rng.choice([1, 2, 5]))
+        elif text == '/distribute':
+            text += ' %d %d' % (rng.randint(0, 3), rng.randint(0, 3))
+            if rng.random() < 0.5:
+                text += ' plan'
+        command = text.split()[0]
+        message = Message(
+            i + 1, User(user, 'User', False, username='user%d' % user),
+            datetime.now(), Chat(user, 'private', username='user%d' % user),
+            text=text, bot=fakebot,
+            entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, len(command))])
+        result.append(Update(i + 1, message=message))
+    return result
+
+
+def run(updates_, fakebot, threads, processes):
+    ''' Runs the updates and returns the latencies (s) by command. '''
+    from queue import Queue
+    from telegram.ext import Dispatcher
+    import bot
+    import data
+    import render
+    import workers
+
+    # Start from empty caches, as after a restart
+    data.snapshots = data.SnapshotStore()
+    data.graphs = data.GraphCache()
+    render.images = render.ImageCache()
+    workers.CPU_WORKERS = processes
+
+    latencies = defaultdict(list)
+    order = defaultdict(list)
+
+    class TimedSerializer(workers.Serializer):
+        def submit(self, user, fn, bot_, update, **kwargs):
+            command = update.message.text.split()[0]
+            queued = time.perf_counter()
+
+            def timed(*args, **kwargs):
+                order[user].append(update.update_id)
+                try:
+                    fn(*args, **kwargs)
+                finally:
+                    latencies[command].append(time.perf_counter() - queued)
+            super().submit(user, timed, bot_, update, **kwargs)
+
+    pool = ThreadPoolExecutor(threads)
+    serializer = TimedSerializer(pool)
+    dispatcher = Dispatcher(fakebot, Queue(), workers=1)
+    bot.add_handlers(dispatcher, bot.BicingBot(), serializer)
+
+    start = time.perf_counter()
+    for update in updates_:
+        dispatcher.process_update(update)
+    while serializer.pending():
+        time.sleep(0.01)
+    total = time.perf_counter() - start
+    pool.shutdown()
+
+    for user, ids in order.items():
+        assert ids == sorted(ids), 'Requests of user %s out of order' % user
+    return total, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--stations', type=int, default=synthetic.REAL_STATIONS)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds taken by Telegram for every message')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        places = fixtures(directory, args.stations)
+        fakebot = FakeBot(args.latency)
+        updates_ = updates(fakebot, args.users, args.requests, places)
+
+        import workers
+        results = [('serial', run(updates_, fakebot, 1, 0)),
+                   ('concurrent', run(updates_, fakebot, args.threads,
+                                      args.processes))]
+        workers.shutdown()
+
+    print('\n%-12s %10s %10s %10s %10s' % ('command', 'mode', 'mean (ms)',
+                                           'p95 (ms)', 'max (ms)'))
+    for command in sorted(results[0][1][1]):
+        for mode, (total, latencies) in results:
+            lat = sorted(latencies[command])
+            print('%-12s %10s %10.1f %10.1f %10.1f' % (
+                command, mode, 1000 * sum(lat) / len(lat),
+                1000 * lat[int(0.95 * (len(lat) - 1))], 1000 * lat[-1]))
+    for mode, (total, latencies) in results:
+        print('%s: %d requests in %.2f s' % (mode, args.requests, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+'''
+© fergascod & asleix
+Records the live Bicing GBFS feeds as fixtures for the benchmarks.
+
+    python benchmarks/record.py [--url https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/]
+
+Writes station_information and station_status to benchmarks/fixtures/gbfs,
+which benchmarks/suite.py uses for the real network instead of synthetic
+stations. Run it again to record a newer state.
+'''
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import poller
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures', 'gbfs')
+FEEDS = ('station_information', 'station_status')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--url', default='https://api.bsmsa.eu/ext/api/bsm/'
+                                         'gbfs/v2/en/')
+    args = parser.parse_args()
+
+    os.makedirs(FIXTURES, exist_ok=True)
+    for feed in FEEDS:
+        content = poller.fetch(args.url + feed)
+        with open(os.path.join(FIXTURES, feed), 'wb') as file:
+            file.write(content)
+        print('%s: %d bytes' % (feed, len(content)))
+
+
+if __name__ == '__main__':
+    main()
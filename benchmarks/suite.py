@@ -0,0 +1,232 @@
+'''
+© fergascod & asleix
+Benchmark suite of the hot paths of data.py, offline.
+
+    python benchmarks/suite.py [--sizes real 1000 10000 100000] [--out results.json] [--compare old.json]
+
+Every size is a network of stations: real uses the feeds recorded by
+benchmarks/record.py (benchmarks/fixtures/gbfs) if there are any, and a
+synthetic network of the same size otherwise, labelled synthetic-<n> in
+the results. Addresses are geocoded with a gazetteer and maps are drawn
+over a blank tile, so nothing is downloaded. Every repeat of a benchmark
+starts from empty caches: snapshots, graphs, geocoded addresses, tiles,
+base map, spatial index, flow networks and images. Work run in processes
+(BICING_CPU_WORKERS, 0 by default here) keeps the caches of those
+processes. Results are saved as JSON, and --compare prints the ratio
+against a previous run.
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+
+import record
+import synthetic
+
+
+DISTANCES = (100, 300, 500, 1000)
+
+
+def timed(f, repeat, setup=None):
+    ''' Runs setup() and f() repeat times. Returns the times (s) of f and
+        its last result. '''
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def fixtures(directory, size):
+    '''
+    Points data.py to the feeds of size. Returns the size of its results:
+    synthetic-<n> for real when there are no recorded feeds.
+    '''
+    import data
+    if size == 'real' and os.path.exists(os.path.join(record.FIXTURES,
+                                                      record.FEEDS[0])):
+        data.GBFS_URL = os.path.join(record.FIXTURES, '')
+        return size
+    n = synthetic.REAL_STATIONS if size == 'real' else int(size)
+    data.GBFS_URL = synthetic.write_gbfs(os.path.join(directory, size), n)
+    if size == 'real':
+        print('No feeds in %s, real is a synthetic network of %d stations' %
+              (record.FIXTURES, n))
+        return 'synthetic-%d' % n
+    return size
+
+
+def reset():
+    ''' Empties the caches of data.py, as after a restart. '''
+    import data
+    import flow
+    import poller
+    import render
+    data.snapshots, data.graphs = data.SnapshotStore(), data.GraphCache()
+    data.oracles = data.OracleCache()
+    data.statuses = poller.StatusPoller(
+        lambda: data.feed_url('station_status'),
+        lambda: data.snapshots.get().stations)
+    render.images = render.ImageCache()
+    flow._networks.clear()
+    cold()
+
+
+def cold(stations=None):
+    '''
+    Empties the caches that the benchmarks of a snapshot share: geocoded
+    addresses, tiles and base map, and the spatial index of stations.
+    '''
+    import geocode
+    import render
+    with geocode._geocoder_lock:
+        if geocode._geocoder is not None:
+            geocode._geocoder._db.close()
+            os.unlink(geocode.GEOCODE_DB)
+            geocode._geocoder = None
+    render.renderer = render.Renderer()
+    if stations is not None:
+        stations._spatial = None
+
+
+def run_size(size, places, args):
+    ''' Yields (benchmark, parameter, times) for a network of stations. '''
+    import data
+    import flow
+    import render
+
+    def snapshot():
+        reset()
+        return data.snapshots.get()
+    yield 'snapshot', None, timed(snapshot, args.repeat)[0]
+
+    for d in DISTANCES:
+        times, G = timed(lambda: data.create_graph(d), args.repeat,
+                         lambda: setattr(data, 'graphs', data.GraphCache()))
+        yield 'create_graph', d, times
+
+    rng = np.random.default_rng(0)
+    routes = [list(rng.choice(places, 2, replace=False))
+              for i in range(args.routes)]
+    times, image = timed(lambda: [data.create_route(G, [a + ',', b])
+                                  for a, b in routes], args.repeat,
+                         lambda: cold(G.stations))
+    yield 'create_route', len(routes), [t / len(routes) for t in times]
+
+    def components():
+        G.connectivity._joins = None   # Found again every time
+        return data.get_connected_components(G)
+    yield 'get_connected_components', None, timed(components, args.repeat)[0]
+
+    if len(G.stations) <= args.max_flow:
+        bikes, docks = data.station_status(G)
+        times, (network, demand, capacity) = timed(
+            lambda: data.create_flow_network(G, bikes, docks, 2, 2),
+            args.repeat, flow._networks.clear)
+        yield 'create_flow_network', None, times
+        yield 'solve', flow.solver().name, timed(
+            lambda: network.solve(demand, capacity), args.repeat)[0]
+
+    def cold_images():
+        cold()
+        render.images = render.ImageCache()
+
+    if len(G.stations) <= args.max_plot:
+        yield 'plot_graph', None, timed(lambda: data.plot_graph(G),
+                                        args.repeat, cold_images)[0]
+
+
+def metadata():
+    ''' Describes the machine and the code of a run. '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+def compare(results, path):
+    ''' Prints the ratio of the best times against the results in path. '''
+    with open(path) as file:
+        old = {(r['benchmark'], r['parameter'], r['stations']): r['best']
+               for r in json.load(file)['results']}
+    print('\n%-26s %10s %8s %10s %10s %8s' % ('benchmark', 'parameter',
+          'stations', 'old (ms)', 'new (ms)', 'ratio'))
+    for r in results:
+        key = (r['benchmark'], r['parameter'], r['stations'])
+        if key in old:
+            print('%-26s %10s %8d %10.2f %10.2f %8.2f' % (
+                *key, 1000 * old[key], 1000 * r['best'], r['best'] / old[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sizes', nargs='+',
+                        default=['real', '1000', '10000', '100000'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--routes', type=int, default=5)
+    parser.add_argument('--max-flow', type=int, default=20000,
+                        help='largest network solved with /distribute')
+    parser.add_argument('--max-plot', type=int, default=20000,
+                        help='largest network drawn with /plotgraph')
+    parser.add_argument('--out', default='results.json')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        gazetteer = os.path.join(directory, 'gazetteer.json')
+        places = synthetic.write_gazetteer(gazetteer)
+        os.environ['BICING_GAZETTEER'] = gazetteer
+        os.environ['BICING_GEOCODE_DB'] = os.path.join(directory,
+                                                       'geocode.sqlite')
+        os.environ['BICING_TILE_URL'] = synthetic.write_tile(
+            os.path.join(directory, 'tile.png'))
+        os.environ['BICING_TILE_CACHE'] = os.path.join(directory, 'tiles')
+        os.environ.setdefault('BICING_CPU_WORKERS', '0')
+        import data
+        import workers
+
+        print('%-26s %10s %8s %10s %10s' % ('benchmark', 'parameter',
+                                            'stations', 'best (ms)', 'mean (ms)'))
+        for size in args.sizes:
+            label = fixtures(directory, size)
+            reset()
+            stations = len(data.snapshots.get().stations)
+            for name, parameter, times in run_size(size, places, args):
+                results.append({'benchmark': name, 'parameter': parameter,
+                                'stations': stations, 'size': label,
+                                'best': min(times),
+                                'mean': sum(times) / len(times),
+                                'times': times})
+                print('%-26s %10s %8d %10.2f %10.2f' % (
+                    name, parameter, stations, 1000 * min(times),
+                    1000 * sum(times) / len(times)))
+        workers.shutdown()
+
+    with open(args.out, 'w') as file:
+        json.dump({'metadata': metadata(), 'results': results}, file, indent=1)
+    print('Results saved to ' + args.out)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
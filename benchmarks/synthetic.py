@@ -0,0 +1,123 @@
+'''© fergascod & asleix'''
+
+import numpy as np
+
+
+# Approximate extent of the Bicing network (about 520 stations).
+CENTER = (41.395, 2.165)
+SPAN = (0.10, 0.12)
+REAL_STATIONS = 520
+
+
+def stations(n, seed=0):
+    '''
+    Returns the coordinates (lat, lon) of n random stations around Barcelona.
+    The covered area grows with n so the density of stations (and so the
+    number of neighbours of each station) is the same as in Bicing.
+    '''
+    rng = np.random.default_rng(seed)
+    scale = np.sqrt(n / REAL_STATIONS)
+    lat = CENTER[0] + (rng.random(n) - 0.5) * SPAN[0] * scale
+    lon = CENTER[1] + (rng.random(n) - 0.5) * SPAN[1] * scale
+    return lat, lon
+
+
+def bicing():
+    '''
+    Returns the coordinates (lat, lon) of the real Bicing stations, read from
+    the GBFS feed (see data.GBFS_URL). Falls back to a synthetic set of the
+    same size when the feed is not available.
+    '''
+    import data
+    import gbfs
+    import poller
+    try:
+        ids, lat, lon = gbfs.information(
+            poller.fetch(data.feed_url('station_information')))
+        return lat, lon
+    except Exception:
+        print('(station_information not available, using synthetic data)')
+        return stations(REAL_STATIONS)
+
+
+def write_gbfs(directory, n=REAL_STATIONS, seed=0, updated=1700000000, ttl=5):
+    '''
+    Writes the feeds station_information and station_status of n random
+    stations into directory, with the format of the Bicing GBFS feeds.
+    Returns the path to use as data.GBFS_URL.
+    '''
+    import json
+    import os
+    rng = np.random.default_rng(seed)
+    lat, lon = stations(n, seed)
+    capacity = rng.integers(15, 36, n)
+    bikes = rng.integers(0, capacity + 1)
+    info, status = [], []
+    for i in range(n):
+        info.append({'station_id': i + 1, 'name': 'Station %d' % (i + 1),
+                     'physical_configuration': 'REGULAR',
+                     'lat': float(lat[i]), 'lon': float(lon[i]),
+                     'altitude': 10.0, 'address': 'Street %d' % (i + 1),
+                     'post_code': '08001', 'capacity': int(capacity[i]),
+                     'nearby_distance': 1000.0})
+        status.append({'station_id': i + 1,
+                       'num_bikes_available': int(bikes[i]),
+                       'num_bikes_available_types': {
+                           'mechanical': int(bikes[i]), 'ebike': 0},
+                       'num_docks_available': int(capacity[i] - bikes[i]),
+                       'last_reported': updated, 'is_charging_station': False,
+                       'status': 'IN_SERVICE', 'is_installed': 1,
+                       'is_renting': 1, 'is_returning': 1})
+
+    os.makedirs(directory, exist_ok=True)
+    for feed, stations_ in (('station_information', info),
+                            ('station_status', status)):
+        with open(os.path.join(directory, feed), 'w') as file:
+            json.dump({'last_updated': updated, 'ttl': ttl,
+                       'data': {'stations': stations_}}, file)
+    return os.path.join(directory, '')
+
+
+def write_gazetteer(path, n=20, seed=0):
+    '''
+    Writes a gazetteer (see geocode.Gazetteer) with n random addresses
+    around Barcelona, named 'Place i'. Returns the list of names.
+    '''
+    import json
+    lat, lon = stations(n, seed + 1)
+    places = {'Place %d, Barcelona' % i: [float(lat[i]), float(lon[i])]
+              for i in range(n)}
+    with open(path, 'w') as file:
+        json.dump(places, file)
+    return ['Place %d' % i for i in range(n)]
+
+
+def write_tile(path):
+    ''' Writes a blank map tile, usable as the only tile of render.TILE_URL. '''
+    from PIL import Image
+    Image.new('RGB', (256, 256), (230, 230, 230)).save(path)
+    return path
+
+
+def serve(directory):
+    '''
+    Serves the files of directory over HTTP on localhost, from a daemon
+    thread. Returns the server (see server.requests) and its base url.
+    '''
+    import functools
+    import http.server
+    import threading
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.server.requests += 1
+            super().do_GET()
+
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(Handler, directory=directory))
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
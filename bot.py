@@ -3,68 +3,71 @@
 from telegram.ext import *
 import data
 from data import BotException
-import os
-import random
-import string
+import metrics
+import sessions
+import workers
+from io import BytesIO
 import logging
-from datetime import datetime
+import time
 
 
 def ErrorHandler(func):
     '''
     Decorator that handles the possible exceptions during a request.
     It distinguishes between user mistakes, using the class
-    BotException, and internal mistakes.
+    BotException, and internal mistakes, which are logged here with
+    their traceback and not raised again. Requests are timed by command
+    (see metrics.py).
     '''
-    red, blue, end = '\033[91m', '\033[94m', '\033[0m' # Unix Terminal colors
+    command = func.__name__
 
     def Request(self, bot, update, **kwargs):
-        user_ = str(update.message.from_user.id)
-        user = blue +  update.message.chat.username + end
-        print(user, 'is putting a request')
-        print('    time:', datetime.now())
+        user = update.message.chat.username
+        bot = metrics.timed_bot(bot)
+        logging.info('%s is putting a request: %s', user, command)
+        start = time.perf_counter()
 
         try:
-            func(self, bot, update, **kwargs)
-            print(user, 'request is fulfilled')
-
-        except KeyError as err:  # Case graph has not been created
-            if str(err) != user_:
-                print(red + 'EXCEPTION' + end)
-                bot.send_message(chat_id=update.message.chat_id,
-                                 text="I can't fulfill your desires!")
-                bot.send_message(chat_id=update.message.chat_id, text=str(err))
-                raise err
-
-            self.start(bot, update)
-            func(self, bot, update, **kwargs)
-            print(user, 'request is fulfilled')
+            with metrics.request(command):
+                func(self, bot, update, **kwargs)
+            logging.info('%s request is fulfilled in %.3f s', user,
+                         time.perf_counter() - start)
 
         except BotException as err:  # General handled case
-            print(red + 'EXCEPTION' + end)
-            print(user, 'request is not fulfilled\n', err)
+            logging.info('%s request is not fulfilled: %s', user, err)
             bot.send_message(chat_id=update.message.chat_id,
                              text="I can't fulfill your desires!")
             bot.send_message(chat_id=update.message.chat_id, text=str(err))
 
         except Exception as err:  # Unexpected error
-            print(red + 'EXCEPTION' + end)
-            print(user, 'request is not fulfilled')
+            logging.exception('%s request is not fulfilled', user)
             bot.send_message(chat_id=update.message.chat_id,
                              text="I can't fulfill your desires!")
             bot.send_message(chat_id=update.message.chat_id,
                              text="Some weird error happened:\n" + str(err))
-            raise err
 
     return Request
 
 
 class BicingBot(object):
     ''' Main driver class for the BicingBot. Contains all bot functions. '''
-    def __init__(self):
-        self.G = {}
-        self.rand_gen = lambda: ''.join([random.choice(string.ascii_letters)
-                                         for i in range(10)]) + '.png'
+    def __init__(self, distances=None):
+        self.sessions = sessions.store()
+        self.sessions.restore(distances or {})
+
+    def graph(self, user):
+        '''
+        Returns the graph of user. Users without a session (new ones, or
+        whose session was evicted) get the graph with distance 1000m.
+        '''
+        session = self.sessions.get(user)
+        if session is None:
+            G = data.start_graph()
+        else:
+            G = data.user_graph(session.distance, session.version)
+        if session != (G.distance, G.version):
+            self.sessions.set(user, G.distance, G.version)
+        return G
 
     @ErrorHandler
     def start(self, bot, update):
@@ -77,9 +80,8 @@ class BicingBot(object):
                  "on the bot, use the command /help")
 
         user = update.message.from_user.id
-        username = update.message.chat.username
-        self.G[user] = data.start_graph()
-        self.G[user].name = username
+        G = data.start_graph()
+        self.sessions.set(user, G.distance, G.version)
 
     @ErrorHandler
     def get_help(self, bot, update):
@@ -94,7 +96,7 @@ class BicingBot(object):
     def get_authors(self, bot, update):
         ''' Sends a message with the names and emails of the authors. '''
         user = update.message.from_user.id
-        if user not in self.G.keys():
+        if user not in self.sessions:
             self.start(bot, update)
 
         bot.send_message(
@@ -120,28 +122,48 @@ class BicingBot(object):
         except Exception as err:
             raise BotException('Invalid argument. Not a distance!')
 
-        self.G[user] = data.create_graph(self.G[user], distance)
+        G = data.create_graph(distance)
+        self.sessions.set(user, G.distance, G.version)
         bot.send_message(chat_id=update.message.chat_id, text='OK')
 
     @ErrorHandler
     def get_nodes(self, bot, update):
         '''Sends a message with the number of nodes of the graph.'''
         user = update.message.from_user.id
-        nodes = data.number_of_nodes(self.G[user])
+        nodes = data.number_of_nodes(self.graph(user))
         bot.send_message(chat_id=update.message.chat_id, text=nodes)
 
     @ErrorHandler
     def get_edges(self, bot, update):
         ''' Sends a message with the number of edges of the graph. '''
         user = update.message.from_user.id
-        edges = data.number_of_edges(self.G[user])
+        edges = data.number_of_edges(self.graph(user))
         bot.send_message(chat_id=update.message.chat_id, text=edges)
 
     @ErrorHandler
-    def get_components(self, bot, update):
-        ''' Sends a message with the number of connected components. '''
+    def get_components(self, bot, update, args):
+        '''
+        Sends a message with the number of connected components, of the
+        graph or for the given distance. With curve, sends a chart of the
+        number of components against the distance.
+        '''
         user = update.message.from_user.id
-        CC = data.get_connected_components(self.G[user])
+        G = self.graph(user)
+        if args == ['curve']:
+            bot.send_photo(chat_id=update.message.chat_id,
+                           photo=data.plot_components(G))
+            return
+
+        distance = None
+        if args:
+            try:
+                distance = int(args[0])
+                if not 0 <= distance <= data.MAX_DISTANCE or len(args) > 1:
+                    raise ValueError
+            except ValueError:
+                raise BotException('Invalid input. Give a distance in range ' +
+                                   '0 - 1000 (meters) or curve.')
+        CC = data.get_connected_components(G, distance)
         bot.send_message(chat_id=update.message.chat_id, text=CC)
 
     @ErrorHandler
@@ -151,11 +173,99 @@ class BicingBot(object):
         the route between two given addresses.
         '''
         user = update.message.from_user.id
-        filename = self.rand_gen()
-        data.create_route(self.G[user], args, filename)
-        bot.send_photo(chat_id=update.message.chat_id,
-                       photo=open(filename, 'rb'))
-        os.remove(filename)
+        image = data.create_route(self.graph(user), args)
+        bot.send_photo(chat_id=update.message.chat_id, photo=image)
+
+    @ErrorHandler
+    def get_nearest(self, bot, update, args):
+        '''
+        Displays the k closest stations to an address (5 by default),
+        with their bikes and docks. k goes after the address: as k=3, after
+        a comma, or as a last number in range 1 - MAX_NEAREST. A larger last
+        number is taken as the house number of the address.
+        '''
+        user = update.message.from_user.id
+        address, k = ' '.join(args), 5
+        head, _, last = address.rpartition(' ')
+        if last.startswith('k='):   # Explicit k
+            k = int(last[2:]) if last[2:].isdigit() else 0
+            if not 0 < k <= MAX_NEAREST:
+                raise BotException('Invalid input. k must be in range ' +
+                                   '1 - %d.' % MAX_NEAREST)
+            address = head
+        else:
+            head, comma, last = address.rpartition(',')
+            if not (comma and last.strip().isdigit()):
+                head, _, last = address.rpartition(' ')
+            if head.strip() and last.strip().isdigit() and \
+                    0 < int(last) <= MAX_NEAREST:
+                k, address = int(last), head
+        address = address.strip()
+        if not address:
+            raise BotException('No address was given.')
+
+        location, stations = data.nearest_stations(self.graph(user), address, k)
+        lines = ['%s: %d m, %s bikes, %s docks' % (
+            station, dist, '?' if bikes is None else bikes,
+            '?' if docks is None else docks)
+            for station, dist, bikes, docks in stations]
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='Closest stations to ' + address + ':\n' +
+                              '\n'.join(lines) + data.status_note())
+
+    @ErrorHandler
+    def get_reach(self, bot, update, args):
+        '''
+        Displays the map of the stations that can be reached by bike within
+        some km from the station closest to an address.
+        '''
+        user = update.message.from_user.id
+        try:
+            if len(args) < 2:
+                raise ValueError
+            km = float(args[-1])
+            if not 0 < km <= MAX_REACH:
+                raise ValueError
+        except ValueError:
+            raise BotException('Invalid input. Give an address and a ' +
+                               'distance in range (0, %d] (km).' % MAX_REACH)
+
+        address = ' '.join(args[:-1])
+        G = self.graph(user)
+        start, walk, idx, dist = data.reachable_stations(G, address, km)
+        message = bot.send_photo(
+            chat_id=update.message.chat_id,
+            photo=data.plot_reach(G, start, km, idx, dist),
+            caption='%d stations within %g km by bike from station %s, ' %
+                    (len(idx), km, G.stations.ids[start].item()) +
+                    '%d m walking from %s.' % (walk, address))
+        data.reach_plotted(G, start, km, message.photo[-1].file_id)
+
+    @ErrorHandler
+    def get_history(self, bot, update, args):
+        '''
+        Displays a chart of the bikes and docks of a station over the
+        last hours, from the recorded history of the status.
+        '''
+        try:
+            if len(args) != 2:
+                raise ValueError
+            station, hours = args[0], float(args[1])
+            if not 0 < hours <= MAX_HISTORY:
+                raise ValueError
+        except ValueError:
+            raise BotException('Invalid input. Give a station id and a ' +
+                               'number of hours in range 0 - %d.' % MAX_HISTORY)
+
+        id, times, bikes, docks, end = data.station_history(station, hours)
+        known = bikes >= 0
+        bot.send_photo(
+            chat_id=update.message.chat_id,
+            photo=data.plot_history(times, bikes, docks, hours, end),
+            caption='Station %s over the last %g hours until %s: ' % (
+                id, hours, time.strftime('%H:%M', time.localtime(end))) +
+                ('%d - %d bikes.' % (bikes[known].min(), bikes[known].max())
+                 if known.any() else 'not in the feed.'))
 
     @ErrorHandler
     def get_map(self, bot, update):
@@ -165,11 +275,10 @@ class BicingBot(object):
         and the edges that connect them
         '''
         user = update.message.from_user.id
-        filename = self.rand_gen()
-        data.plot_graph(self.G[user], filename)
-        bot.send_photo(chat_id=update.message.chat_id,
-                       photo=open(filename, 'rb'))
-        os.remove(filename)
+        G = self.graph(user)
+        message = bot.send_photo(chat_id=update.message.chat_id,
+                                 photo=data.plot_graph(G))
+        data.graph_plotted(G, message.photo[-1].file_id)
 
     @ErrorHandler
     def get_summary(self, bot, update):
@@ -179,7 +288,7 @@ class BicingBot(object):
         as the edge with highest cost.
         '''
         user = update.message.from_user.id
-        summary = data.graph_summary(self.G[user])
+        summary = data.graph_summary(self.graph(user))
         bot.send_message(
             chat_id=update.message.chat_id,
             text=summary)
@@ -190,27 +299,88 @@ class BicingBot(object):
         '''
         Distribute the unbalanced bikes in the Bicing network.
         The total cost of transportation is displayed, as well
-        as the edge with highest cost.
+        as the edge with highest cost. With plan, the whole plan is sent.
         '''
         user = update.message.from_user.id
 
         try:
-            if len(args) != 2:
+            plan = args[2:] == ['plan']
+            if len(args) != 2 and not plan:
                 raise Exception('2 arguments are needed!')
-            requiredBikes, requiredDocks = int(args[0]), int(args[1])
-            if requiredBikes < 0 or requiredDocks < 0:
-                raise Exception('Values must be non-negative!')
+            bikeTargets, dockTargets = targets(args[0]), targets(args[1])
+            if len(bikeTargets) * len(dockTargets) > MAX_SWEEP:
+                raise Exception('At most %d pairs of values!' % MAX_SWEEP)
+            if plan and len(bikeTargets) * len(dockTargets) > 1:
+                raise Exception('A plan is only given for one pair of values!')
 
         except Exception as err:
             raise BotException('Invalid input. ' + str(err))
 
-        cost, move = data.distribute_bikes(self.G[user],
+        if plan:
+            self.send_plan(bot, update, bikeTargets[0], dockTargets[0])
+            return
+
+        if len(bikeTargets) * len(dockTargets) > 1:
+            self.sweep_distribute(bot, update, bikeTargets, dockTargets)
+            return
+
+        requiredBikes, requiredDocks = bikeTargets[0], dockTargets[0]
+        cost, move = data.distribute_bikes(self.graph(user),
                                      requiredBikes, requiredDocks)
         bot.send_message(
             chat_id=update.message.chat_id,
             text="Total cost of transferring bicycles: " + str(cost) + " km.\n" +
                  "Highest cost edge:\n" + str(move[0]) + ' -> ' + str(move[1]) +
-                 ', ' + str(move[2]) + ' bikes, distance ' + str(move[3]) + ' m.')
+                 ', ' + str(move[2]) + ' bikes, distance ' + str(move[3]) + ' m.' +
+                 data.status_note())
+
+    def send_plan(self, bot, update, requiredBikes, requiredDocks):
+        '''
+        Sends the whole distribution plan: the total cost and the moves
+        with the highest cost, the CSV document with all the moves and the
+        map of the moves.
+        '''
+        user = update.message.from_user.id
+        G = self.graph(user)
+        cost, moves = data.distribution_plan(G, requiredBikes, requiredDocks)
+        top = data.top_moves(G, moves, PLAN_TOP)
+        bot.send_message(
+            chat_id=update.message.chat_id,
+            text="Total cost of transferring bicycles: " + str(cost) + " km, " +
+                 "%d moves.\nHighest cost moves:\n" % len(moves[0]) +
+                 '\n'.join('%s -> %s, %d bikes, distance %d m.' % move
+                           for move in top) + data.status_note())
+        bot.send_document(chat_id=update.message.chat_id,
+                          document=BytesIO(data.plan_csv(G, moves)),
+                          filename='plan.csv')
+        bot.send_photo(chat_id=update.message.chat_id,
+                       photo=data.plot_plan(G, moves))
+
+    def sweep_distribute(self, bot, update, bikeTargets, dockTargets):
+        '''
+        Sends the cost of distributing the bikes for every pair of
+        required bikes and docks, as a table and as a heatmap.
+        '''
+        user = update.message.from_user.id
+        costs, seconds = data.sweep_distribution(self.graph(user), bikeTargets,
+                                                 dockTargets)
+        cells = [['-' if c is None else '%.3f' % c for c in row] for row in costs]
+        width = max(len(c) for row in cells + [list(map(str, dockTargets))]
+                    for c in row)
+        lines = ['b \\ d ' + ' '.join(str(d).rjust(width) for d in dockTargets)]
+        for b, row in zip(bikeTargets, cells):
+            lines.append(str(b).rjust(5) + ' ' +
+                         ' '.join(c.rjust(width) for c in row))
+        bot.send_message(
+            chat_id=update.message.chat_id,
+            text="Total cost (km) by required bikes (rows) and docks " +
+                 "(columns), - if there is no solution:\n" +
+                 '\n'.join(lines) + '\n' +
+                 "%d targets solved in %.2f s." % (len(costs) * len(dockTargets),
+                                                   seconds) +
+                 data.status_note())
+        bot.send_photo(chat_id=update.message.chat_id,
+                       photo=data.plot_sweep(bikeTargets, dockTargets, costs))
 
     @ErrorHandler
     def unknown(self, bot, update):
@@ -226,6 +396,61 @@ class BicingBot(object):
             text='I didn\'t catch that! Try /help for more info.')
 
 
+def targets(arg):
+    '''
+    Values of a /distribute argument: a number or a range such as 1..5, as
+    a range, so it can be counted before any value is made.
+    '''
+    first, dots, last = arg.partition('..')
+    first, last = int(first), int(last if dots else first)
+    if first < 0 or last < 0:
+        raise Exception('Values must be non-negative!')
+    if first > last:
+        raise Exception('Empty range ' + arg + '!')
+    return range(first, last + 1)
+
+
+def Serialized(serializer, handler):
+    '''
+    Handler that queues the request to be run by serializer, so the
+    dispatcher can take the next update while it runs.
+    '''
+    def Request(bot, update, **kwargs):
+        serializer.submit(update.message.from_user.id,
+                          handler, bot, update, **kwargs)
+
+    return Request
+
+
+def add_handlers(dispatcher, PyBot, serializer):
+    ''' Registers the commands of PyBot, run through serializer. '''
+    def command(name, handler, **kwargs):
+        dispatcher.add_handler(CommandHandler(
+            name, Serialized(serializer, handler), **kwargs))
+
+    # When the bot receives the command (first parameter)
+    # the function (second parameter) is executed
+    command('start', PyBot.start)
+    command('help', PyBot.get_help)
+    command('authors', PyBot.get_authors)
+    command('graph', PyBot.get_graph, pass_args=True)
+    command('nodes', PyBot.get_nodes)
+    command('edges', PyBot.get_edges)
+    command('components', PyBot.get_components, pass_args=True)
+    command('plotgraph', PyBot.get_map)
+    command('route', PyBot.get_route, pass_args=True)
+    command('nearest', PyBot.get_nearest, pass_args=True)
+    command('reach', PyBot.get_reach, pass_args=True)
+    command('history', PyBot.get_history, pass_args=True)
+    command('distribute', PyBot.get_distribute, pass_args=True)
+    command('summary', PyBot.get_summary)
+
+    dispatcher.add_handler(MessageHandler(
+        Filters.command, Serialized(serializer, PyBot.unknown)))
+    dispatcher.add_handler(MessageHandler(
+        Filters.text, Serialized(serializer, PyBot.NoCommand)))
+
+
 def main():
     # Using the logger to display uncatched exceptions in stdout.
     logging.basicConfig(
@@ -234,32 +459,53 @@ def main():
 
     # Declaration of objects used to work with Telegram bots
     updater = Updater(token=TOKEN)
-    dispatcher = updater.dispatcher
 
-    PyBot = BicingBot()
-    # When the bot receives the command (first parameter)
-    # the function (second parameter) is executed
-    dispatcher.add_handler(CommandHandler('start', PyBot.start))
-    dispatcher.add_handler(CommandHandler('help', PyBot.get_help))
-    dispatcher.add_handler(CommandHandler('authors', PyBot.get_authors))
-    dispatcher.add_handler(CommandHandler('graph', PyBot.get_graph, pass_args=True))
-    dispatcher.add_handler(CommandHandler('nodes', PyBot.get_nodes))
-    dispatcher.add_handler(CommandHandler('edges', PyBot.get_edges))
-    dispatcher.add_handler(CommandHandler('components', PyBot.get_components))
-    dispatcher.add_handler(CommandHandler('plotgraph', PyBot.get_map))
-    dispatcher.add_handler(CommandHandler('route', PyBot.get_route, pass_args=True))
-    dispatcher.add_handler(CommandHandler('distribute', PyBot.get_distribute, pass_args=True))
-    dispatcher.add_handler(CommandHandler('summary', PyBot.get_summary))
-
-    dispatcher.add_handler(MessageHandler(Filters.command, PyBot.unknown))
-    dispatcher.add_handler(MessageHandler(Filters.text, PyBot.NoCommand))
+    # The stations, graphs and users saved by the last run are restored,
+    # and saved again periodically and on shutdown
+    PyBot = BicingBot(data.restore_state())
+    data.autosave(PyBot.sessions.distances)
+
+    # Requests run in a thread pool, in order for each user. CPU heavy
+    # work is sent to a process pool (see workers.py).
+    add_handlers(updater.dispatcher, PyBot, workers.Serializer())
+
+    # The status of the stations is polled in background for /distribute,
+    # and every status is recorded for /history
+    data.record_history()
+    data.statuses.start()
+
+    if metrics.ENABLED:
+        metrics.serve()
 
     print('Bot is ON')
     updater.start_polling()
 
+    # Maps, flow solvers and the geocoder are imported on first use, or
+    # here in background
+    if data.PRELOAD:
+        data.preload()
+    updater.idle()
+    data.save_state(PyBot.sessions.distances())
+    data.close_history()
+
 
 # Declaration of some constants used throughout the code
 
+# Maximum number of stations given by /nearest
+MAX_NEAREST = 20
+
+# Maximum distance (km) of /reach
+MAX_REACH = 50
+
+# Maximum hours of /history
+MAX_HISTORY = 7 * 24
+
+# Moves listed in the message of a /distribute plan
+PLAN_TOP = 5
+
+# Maximum number of (bikes, docks) pairs of a /distribute sweep
+MAX_SWEEP = 100
+
 # Bot's token
 TOKEN = "Here you should copy your token"
 
@@ -274,13 +520,26 @@ distance between stations. It must be in range (0, 1000).\n\
 - /nodes: Get the number of nodes of the graph \
 (number of active Bicing stations).\n\
 - /edges: Get a message with the number of edges.\n\
-- /components: Get the number of connected components.\n\
+- /components [distance]: Get the number of connected components, of your \
+graph or of the graph with the given distance. /components curve draws the \
+number of components against the distance.\n\
 - /plotgraph: Get a drawing of the graph over the map of Barcelona.\n\
 - /route (address, address): Get a drawing of the route between two given addresses. \n\
+- /nearest (address) [k]: Get the k closest stations to an address (5 by \
+default, at most 20), with their bikes and docks. A last number above 20 is \
+a house number: give k as k=3 or after a comma, as in \
+/nearest Carrer de Mallorca 15, 3. \n\
+- /reach (address) (km): Get a drawing of the stations that can be reached \
+by bike within the given km (at most 50) from the station closest to an \
+address. \n\
+- /history (station) (hours): Get a chart of the bikes and docks of a \
+station over the last hours. \n\
 - /summary: Get assorted info from the graph. \n\
 - /distribute (int, int): Calculate the cost of transporting bikes \
 in order to guarantee a minimum number of bikes (first parameter) and docks \
-(second parameter) per station. \n\n\
+(second parameter) per station. Ranges such as 1..5 give the cost of \
+every pair of values, as a table and a heatmap. /distribute (int) (int) plan \
+sends the whole plan: a CSV document with every move and a map of them. \n\n\
 For additional information on the bot check out the following link: \n\
 https://github.com/jordi-petit/ap2-bicingbot-2019/blob/master/README.md"
 
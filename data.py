@@ -1,11 +1,77 @@
 '''© fergascod & asleix'''
 
-from staticmap import StaticMap, CircleMarker, Line
-import networkx as nx
-import pandas as pd
-from haversine import haversine
-from geopy.geocoders import Nominatim
-from math import ceil, floor
+import numpy as np
+import flow
+import gbfs
+import geocode
+import geometry
+import metrics
+import persist
+import poller
+import recorder
+from graph import (BIKE_SPEED, Connectivity, DistanceOracle, Graph, Node,
+                   Stations)
+import workers
+from collections import OrderedDict
+import csv
+import heapq
+import io
+from io import BytesIO
+import logging
+import os
+import threading
+import time
+
+
+# Base location of the GBFS feeds. It can point to a local directory holding
+# the feeds as JSON files (station_information, station_status) for testing.
+GBFS_URL = os.environ.get('BICING_GBFS_URL',
+                          'https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/')
+
+# Seconds a station snapshot is considered fresh.
+SNAPSHOT_TTL = float(os.environ.get('BICING_SNAPSHOT_TTL', 300))
+
+# Seconds the stale snapshot is served after a failed refresh before
+# downloading the stations again.
+SNAPSHOT_RETRY = float(os.environ.get('BICING_SNAPSHOT_RETRY', 30))
+
+# Maximum distance (m) of the geometric graphs.
+MAX_DISTANCE = 1000
+
+# Largest fraction of the stations that can be added or moved for a new
+# snapshot to update the edges of the previous one instead of searching
+# them all again (see benchmarks/bench_update.py).
+UPDATE_FRACTION = 0.1
+
+# Columns of the CSV document of a /distribute plan.
+PLAN_FIELDS = ('origin', 'destination', 'bikes', 'distance_m', 'cost_km',
+               'origin_lat', 'origin_lon', 'destination_lat',
+               'destination_lon')
+
+# Memory (bytes) for the cached graphs.
+GRAPH_CACHE_BYTES = int(os.environ.get('BICING_GRAPH_CACHE_BYTES', 256 << 20))
+
+# Largest graph (stations) with a distance oracle, and memory (bytes) for
+# the cached oracles. An oracle takes 4 bytes per pair of stations.
+ORACLE_STATIONS = int(os.environ.get('BICING_ORACLE_STATIONS', 3000))
+ORACLE_CACHE_BYTES = int(os.environ.get('BICING_ORACLE_CACHE_BYTES', 64 << 20))
+
+# File where the snapshot, its graphs and the distance of every user are
+# saved for warm restarts, seconds between saves, and maximum age (s) of
+# a saved snapshot to be restored.
+STATE_FILE = os.environ.get('BICING_STATE_FILE',
+                            os.path.join('cache', 'state.npz'))
+STATE_INTERVAL = float(os.environ.get('BICING_STATE_INTERVAL', 600))
+STATE_MAX_AGE = float(os.environ.get('BICING_STATE_MAX_AGE', 24 * 3600))
+
+# File where every polled status is recorded (see recorder.py), '' to not
+# record them.
+HISTORY_FILE = os.environ.get('BICING_HISTORY_FILE',
+                              os.path.join('cache', 'history.bin'))
+
+# Whether the subsystems imported on first use (maps, flow solver and
+# geocoder) are imported in background once the bot is polling.
+PRELOAD = os.environ.get('BICING_PRELOAD', '1') != '0'
 
 
 class BotException(Exception):
@@ -13,125 +79,443 @@ class BotException(Exception):
     pass
 
 
-class Node:
-    ''' Main class for the nodes in the geometric graph. '''
-    def __init__(self, lat_, lon_, station_id=None):
-        ''' Defines latitude and longitude for the node. '''
-        self.lat = lat_
-        self.lon = lon_
-        self.id = station_id
-
-    def coords(self):
-        ''' Returns a tuple of the coordinates. Reversed order than init. '''
-        return (self.lon, self.lat)
-
-    def distance_to(self, next):
-        ''' Calculates distance (km) in the sphere using haversine.
-            Returns a float, the distance between self and next in km. '''
-        c1 = (self.lat, self.lon)
-        c2 = (next.lat, next.lon)
-        return haversine(c1, c2)
-
-
-def create_grid(G, P, d):
-    '''
-    Create a grid that divides the plane in cells of distance d + EPS.
-    We use an error parameter EPS because the points are in a sphere. Returns a
-    matrix where each cells contains the stations in that position of the grid.
-    '''
-    EPS = 0.01
-    d_ = d + EPS
-    # Find boundary points
-    minlat, minlon, maxlat, maxlon = P[0].lat, P[0].lon, P[0].lat, P[0].lon
-    for node in P:
-        minlat = min(minlat, node.lat)
-        minlon = min(minlon, node.lon)
-        maxlat = max(maxlat, node.lat)
-        maxlon = max(maxlon, node.lon)
-
-    # Find vertices of the bounding box
-    ll, lr = Node(minlat-EPS, minlon-EPS), Node(minlat-EPS, maxlon+EPS)
-    ul, ur = Node(maxlat+EPS, minlon-EPS), Node(maxlat+EPS, maxlon+EPS)
-    n, m = ceil(ll.distance_to(lr)/d_), ceil(ll.distance_to(ul)/d_)
-    grid = [[[] for i in range(m)] for j in range(n)]
-
-    # Insert points to the grid
-    for node in P:
-        aux_x, aux_y = Node(ll.lat, node.lon), Node(node.lat, ll.lon)
-        x, y = floor(ll.distance_to(aux_x)/d_), floor(ll.distance_to(aux_y)/d_)
-        grid[x][y].append(node)
-
-    return grid
-
-
-def geometric_graph(G, P, d):
-    '''
-    Function that creates the geometric graph.
-    A grid is generated so all nodes in a cell can only be connected to nodes
-    in its neighbouring cells.
-    Linear with respect to edges when assuming the points are
-    uniformly distributed over the plane.
-    '''
-    grid = create_grid(G, P, d)
-
-    def create_edges(G, cur, next):
-        ''' Create edges between cells 'cur' and 'next'. '''
-        for n1 in cur:
-            for n2 in next:
-                dist = n1.distance_to(n2)
-                if dist <= d and n1 is not n2:
-                    G.add_edge(n1, n2, weight=dist/10)
-
-    n, m = len(grid), len(grid[0])
-    for i in range(n-1):
-        for j in range(m-1):
-            create_edges(G, grid[i][j], grid[i][j])
-            create_edges(G, grid[i][j], grid[i+1][j])
-            create_edges(G, grid[i][j], grid[i][j+1])
-            create_edges(G, grid[i][j], grid[i+1][j+1])
-            if j >= 1:
-                create_edges(G, grid[i][j], grid[i+1][j-1])
+def feed_url(feed, base=None):
+    ''' Returns the location of a GBFS feed (station_information, ...). '''
+    return (base or GBFS_URL) + feed
 
 
-def start_graph():
+def load_stations(url=None):
     '''
-    Retrieve data from the web.
-    Returns a geometric graph with distance 1000m.
+    Retrieve station information from url, the GBFS feed by default.
+    Returns the table of stations.
     '''
     try:
-        url = 'https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/station_information'
-        print('Retrieving data...')
-
-        bicing = pd.DataFrame.from_records(
-            pd.read_json(url)['data']['stations'], index='station_id')
+        url = url or feed_url('station_information')
+        logging.info('Retrieving data...')
 
-        G = nx.Graph()
-        for station in bicing.itertuples():
-            n = Node(station.lat, station.lon, station.Index)
-            G.add_node(n)
+        with metrics.phase('fetch'):
+            content = poller.fetch(url)
+        with metrics.phase('parse'):
+            return Stations(*gbfs.information(content))
 
     except Exception as err:
         raise BotException('Could not retrieve Bicing data. ' +
                            'Data might be inaccessible.')
 
-    return create_graph(G, 1000)
 
+class StationSnapshot:
+    '''
+    Immutable state of the Bicing stations at a given moment.
+    Keeps the edges of the geometric graph with the maximum distance,
+    the graphs with smaller distances only filter them. The edges are
+    searched unless they are given (updated from another snapshot). base
+    is (version, kept) of the snapshot this one was updated from, if the
+    stations kept their order, so its graphs can be updated too.
+    '''
+    def __init__(self, version, stations, edges=None, base=None):
+        self.version = version
+        self.stations = stations
+        self.base = base
+        if edges is None:
+            with metrics.phase('graph'):
+                edges = workers.cpu(geometry.geometric_edges, stations.lat,
+                                    stations.lon, MAX_DISTANCE / 1000)
+        self.edges = edges
+        self.connectivity = Connectivity(len(stations), *self.edges)
+        self.taken = time.time()
+        self.created = time.monotonic()
+
+    @classmethod
+    def restored(cls, version, stations, edges, joins, taken):
+        ''' Snapshot read from a saved state, with its edges and joins. '''
+        snapshot = cls.__new__(cls)
+        snapshot.version, snapshot.stations = version, stations
+        snapshot.edges, snapshot.base = edges, None
+        snapshot.connectivity = Connectivity(len(stations), *edges, joins)
+        snapshot.taken = taken
+        snapshot.created = time.monotonic()
+        return snapshot
+
+    def age(self):
+        ''' Seconds since the snapshot was taken. '''
+        return time.monotonic() - self.created
+
+    def graph(self, distance, previous=None):
+        '''
+        Returns a new geometric graph with distance (m). previous is the
+        graph with the same distance of the base snapshot: if given, it is
+        updated with the edges of the added and moved stations.
+        '''
+        u, v, dist = self.edges
+        keep = dist <= distance / 1000
+        if previous is not None:
+            kept = self.base[1]
+            new = np.ones(len(self.stations), bool)
+            new[kept[kept >= 0]] = False
+            keep &= new[u] | new[v]
+            return previous.updated(self.stations, kept, u[keep], v[keep],
+                                    dist[keep] / BIKE_SPEED, self.version,
+                                    self.connectivity)
+        return Graph(self.stations, u[keep], v[keep], dist[keep] / BIKE_SPEED,
+                     self.version, distance, self.connectivity)
+
+
+class SnapshotStore:
+    '''
+    Process-wide store of the current station snapshot, shared by all users.
+    The snapshot is refreshed once it is older than ttl seconds. Concurrent
+    requests during a refresh wait for a single download instead of starting
+    their own. If a refresh fails, the previous snapshot is kept and served
+    for retry seconds before the next download, so the requests waiting for
+    the failed one do not download it again.
+    '''
+    def __init__(self, url=None, ttl=None, retry=None):
+        self.url = url
+        self.ttl = SNAPSHOT_TTL if ttl is None else ttl
+        self.retry = SNAPSHOT_RETRY if retry is None else retry
+        self.version = 0
+        self._snapshot = None
+        self._retry_after = 0   # Time (monotonic) of the next download
+        self._refreshing = threading.Lock()
+
+    def current(self):
+        ''' Returns the current snapshot as it is, or None. '''
+        return self._snapshot
+
+    def restore(self, snapshot):
+        ''' Serves snapshot (restored from disk) until it expires. '''
+        with self._refreshing:
+            self.version = max(self.version, snapshot.version)
+            self._snapshot = snapshot
+
+    def fresh(self, snapshot):
+        ''' Tells whether snapshot can still be served. '''
+        return snapshot is not None and (snapshot.age() < self.ttl or
+                                         time.monotonic() < self._retry_after)
+
+    def get(self):
+        ''' Returns the current snapshot, refreshing it when expired. '''
+        snapshot = self._snapshot
+        if self.fresh(snapshot):
+            metrics.hit('snapshot')
+            return snapshot
+
+        metrics.miss('snapshot')
+        with self._refreshing:
+            snapshot = self._snapshot
+            if self.fresh(snapshot):  # Refreshed while we were waiting
+                return snapshot
+            try:
+                stations = load_stations(self.url)
+            except BotException:
+                if snapshot is None:
+                    raise
+                self._retry_after = time.monotonic() + self.retry
+                return snapshot   # Serve stale data rather than nothing
+
+            self._snapshot = self.following(snapshot, stations)
+            return self._snapshot
+
+    def following(self, previous, stations):
+        '''
+        Returns the snapshot of stations that follows previous. If the
+        stations did not change, previous is kept and fresh again. If few
+        of them were added or moved (UPDATE_FRACTION), the grid of previous
+        (its spatial index) and its edges are updated around them instead
+        of searched again, and so are its graphs when they are asked for.
+        '''
+        edges = base = None
+        if previous is not None:
+            kept = stations.kept(previous.stations)
+            changed = len(stations) - int((kept >= 0).sum())
+            if changed == 0 and len(kept) == len(stations):
+                previous.created = time.monotonic()   # Same stations
+                return previous
+            if 0 < len(stations) and 0 < len(previous.stations) and \
+                    changed <= UPDATE_FRACTION * len(stations):
+                with metrics.phase('graph'):
+                    grid = stations.spatial_from(previous.stations, kept).grid
+                    if grid.d != MAX_DISTANCE / 1000:
+                        grid = geometry.Grid(stations.lat, stations.lon,
+                                             MAX_DISTANCE / 1000)
+                    edges = geometry.updated_edges(previous.edges, kept, grid)
+                alive = kept[kept >= 0]
+                if (alive[1:] > alive[:-1]).all():   # Same order
+                    base = (previous.version, kept)
+
+        self.version += 1
+        return StationSnapshot(self.version, stations, edges, base)
+
+
+class LRUCache:
+    '''
+    Values by key, shared by all users. The least recently used values are
+    evicted when the sum of their nbytes exceeds max_bytes (the last one
+    added is always kept).
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find(self, key):
+        ''' Returns the value of key, or None. '''
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+            return value
+
+    def add(self, key, value):
+        ''' Adds the value of key, unless there is one already (added by
+            another request meanwhile). Returns the value kept. '''
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            self._values[key] = value
+            self.bytes += value.nbytes
+            while self.bytes > self.max_bytes and len(self._values) > 1:
+                old = self._values.popitem(last=False)[1]
+                self.bytes -= old.nbytes
+        return value
+
+
+class GraphCache(LRUCache):
+    '''
+    Cache of read-only geometric graphs by (snapshot version, distance).
+    The least recently used graphs are evicted when the memory of their
+    adjacency arrays exceeds max_bytes.
+    '''
+    def __init__(self, max_bytes=None):
+        super().__init__(GRAPH_CACHE_BYTES if max_bytes is None else max_bytes)
+
+    def lookup(self, version, distance):
+        ''' Returns the cached graph with distance (m) of the snapshot
+            version, or None. '''
+        return self.find((version, distance))
+
+    def get(self, snapshot, distance):
+        ''' Returns the geometric graph with distance (m) of snapshot. '''
+        G = self.lookup(snapshot.version, distance)
+        if G is not None:
+            metrics.hit('graph')
+            return G
+
+        metrics.miss('graph')
+        previous = None
+        if snapshot.base is not None:
+            previous = self.lookup(snapshot.base[0], distance)
+        with metrics.phase('graph'):
+            G = snapshot.graph(distance, previous)   # Built out of the lock
+
+        return self.put(G)
+
+    def put(self, G):
+        ''' Adds the graph G of a snapshot, unless there is one already.
+            Returns the graph kept. '''
+        return self.add((G.version, G.distance), G)
+
+
+class OracleCache(LRUCache):
+    '''
+    Distance oracles of the graphs by (snapshot version, distance). Only
+    graphs of at most ORACLE_STATIONS stations get one. The least recently
+    used oracles are evicted when the memory of their matrices exceeds
+    max_bytes.
+    '''
+    def __init__(self, max_bytes=None):
+        super().__init__(ORACLE_CACHE_BYTES if max_bytes is None else max_bytes)
+
+    def get(self, G):
+        ''' Returns the oracle of G, built on first use, or None if G has
+            too many stations. '''
+        if len(G.stations) > ORACLE_STATIONS:
+            return None
+        key = (G.version, G.distance)
+        oracle = self.find(key)
+        if oracle is not None:
+            metrics.hit('oracle')
+            return oracle
+
+        metrics.miss('oracle')
+        with metrics.phase('oracle'):
+            oracle = workers.cpu(DistanceOracle, G)   # Built out of the lock
+        return self.add(key, oracle)
+
+
+snapshots = SnapshotStore()
+graphs = GraphCache()
+oracles = OracleCache()
+statuses = poller.StatusPoller(lambda: feed_url('station_status'),
+                               lambda: snapshots.get().stations)
 
-def create_graph(G_, distance):
+
+_saved = None   # (version, distances) of the last saved state
+
+
+def save_state(distances, path=None):
+    '''
+    Saves the current snapshot, its graphs with the distances in use and
+    the distance (m) of every user ({user: distance}) to path, STATE_FILE
+    by default. Stations, edges and adjacency arrays are written as they
+    are, so they can be mapped from the file (see persist.py).
+    Returns whether the state was written: it is not if nothing changed.
+    '''
+    global _saved
+    snapshot = snapshots.current()
+    if snapshot is None:
+        return False
+    if _saved == (snapshot.version, distances):
+        return False
+
+    st = snapshot.stations
+    u, v, dist = snapshot.edges
+    arrays = dict(version=snapshot.version, taken=snapshot.taken,
+                  ids=st.ids.astype(str) if st.ids.dtype.hasobject else st.ids,
+                  lat=st.lat, lon=st.lon, u=u, v=v, dist=dist,
+                  joins=snapshot.connectivity.joins(),
+                  users=np.array(list(distances), dtype=np.int64),
+                  distances=np.array(list(distances.values()), dtype=np.int64))
+    for distance in sorted(set(distances.values())):
+        G = graphs.get(snapshot, distance)
+        arrays['offsets_%d' % distance] = G.offsets
+        arrays['indices_%d' % distance] = G.indices
+        arrays['weights_%d' % distance] = G.weights
+
+    with metrics.phase('save'):
+        persist.save(path or STATE_FILE, arrays)
+    _saved = (snapshot.version, dict(distances))
+    logging.info('State saved: snapshot %d, %d users.', snapshot.version,
+                 len(distances))
+    return True
+
+
+def restore_state(path=None):
+    '''
+    Restores the snapshot and graphs saved by save_state, mapped from the
+    file, unless the snapshot is older than STATE_MAX_AGE. It is served as
+    if it had just been downloaded.
+    Returns the distance of every user, empty if nothing was restored.
+    '''
+    path = path or STATE_FILE
+    if not os.path.exists(path):
+        return {}
+    try:
+        state = persist.load(path)
+        taken = float(state['taken'])
+        if time.time() - taken > STATE_MAX_AGE:
+            logging.info('Saved state is too old, not restored.')
+            return {}
+
+        version = int(state['version'])
+        stations = Stations(state['ids'], state['lat'], state['lon'])
+        snapshot = StationSnapshot.restored(
+            version, stations, (state['u'], state['v'], state['dist']),
+            state['joins'], taken)
+        distances = dict(zip(state['users'].tolist(),
+                             state['distances'].tolist()))
+        for distance in set(distances.values()):
+            graphs.put(Graph.from_csr(
+                stations, state['offsets_%d' % distance],
+                state['indices_%d' % distance], state['weights_%d' % distance],
+                version, distance, snapshot.connectivity))
+
+    except Exception as err:   # A bad state must not stop the bot
+        logging.warning('Could not restore the saved state: %s', err)
+        return {}
+
+    snapshots.restore(snapshot)
+    global _saved
+    _saved = (version, dict(distances))
+    logging.info('State restored: snapshot %d, %d users.', version,
+                 len(distances))
+    return distances
+
+
+def autosave(distances, interval=None):
+    '''
+    Saves the state every interval seconds (STATE_INTERVAL by default) from
+    a daemon thread. distances is called to get the distance of every user.
+    '''
+    interval = STATE_INTERVAL if interval is None else interval
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                save_state(distances())
+            except Exception:
+                logging.exception('Could not save the state')
+
+    thread = threading.Thread(target=run, name='autosave', daemon=True)
+    thread.start()
+    return thread
+
+
+def warm():
+    ''' Imports the subsystems used in the processes: maps and flows. '''
+    import render
+    flow.solver()
+
+
+def preload():
+    '''
+    Imports from a daemon thread the subsystems that are otherwise imported
+    on first use, in this process and in the process pool, so the first
+    commands that need them do not wait.
+    '''
+    def run():
+        start = time.perf_counter()
+        try:
+            warm()
+            geocode.geocoder()
+            if workers.CPU_WORKERS > 0:
+                pool = workers.cpu_pool()
+                for future in [pool.submit(warm)
+                               for i in range(workers.CPU_WORKERS)]:
+                    future.result()
+        except Exception:
+            logging.exception('Could not preload')
+            return
+        logging.info('Preloaded in %.2f s', time.perf_counter() - start)
+
+    thread = threading.Thread(target=run, name='preload', daemon=True)
+    thread.start()
+    return thread
+
+
+def start_graph():
+    '''
+    Returns the shared geometric graph with distance 1000m
+    of the current station snapshot.
     '''
-    Returns a geometric graph given a distance d,
+    return create_graph(MAX_DISTANCE)
+
+
+def create_graph(distance):
+    '''
+    Returns a geometric graph given a distance d (m),
     using Bicing stations in Barcelona as vertices.
+    The graph is read-only and shared with other users.
     '''
-    if distance < 0 or distance > 1000:
+    if distance < 0 or distance > MAX_DISTANCE:
         raise BotException('Invalid distance. Input must be in range ' +
                            '0 - 1000 (meters).')
 
-    distance /= 1000
+    return graphs.get(snapshots.get(), distance)
 
-    G = nx.create_empty_copy(G_, with_data=True)
-    geometric_graph(G, list(G.nodes()), distance)
 
-    return G
+def user_graph(distance, version=None):
+    '''
+    Returns the graph with distance (m) of the snapshot version while it is
+    cached, so users keep the same graph, or else of the current snapshot.
+    '''
+    if version is not None:
+        G = graphs.lookup(version, distance)
+        if G is not None:
+            return G
+    return create_graph(distance)
 
 
 def number_of_nodes(G):
@@ -145,166 +529,253 @@ def number_of_edges(G):
 
 def graph_summary(G):
     ''' Returns a summary of the graph '''
-    return nx.info(G)
+    return G.summary()
 
 def addressesTOcoordinates(addresses):
     '''
     Returns the two coordinates of two addresses of Barcelona
     Given their addresses in a single string separated by a comma.
-    In case of failure, returns None.
+    Both addresses are looked up at the same time, see geocode.locate.
     '''
     try:
-        geolocator = Nominatim(user_agent="PyBicing_bot")
         address1, address2 = addresses.split(',')
-        location1 = geolocator.geocode(address1 + ', Barcelona')
-        location2 = geolocator.geocode(address2 + ', Barcelona')
-        return ((location1.latitude, location1.longitude),
-                (location2.latitude, location2.longitude))
-
     except ValueError:
         raise BotException('A comma between addresses is required!')
 
-    except AttributeError:
+    with metrics.phase('geocode'):
+        location1, location2 = geocode.locate([address1 + ', Barcelona',
+                                               address2 + ', Barcelona'])
+    if location1 is None or location2 is None:
         msg = ['Address/es could not be found.']
         if location1 is None: msg.append('\n  -> ' + address1)
         if location2 is None: msg.append('\n  -> ' + address2)
         raise BotException(''.join(msg))
 
+    return location1, location2
+
+
+def locate(address):
+    ''' Returns the coordinates of an address of Barcelona. '''
+    with metrics.phase('geocode'):
+        location, = geocode.locate([address + ', Barcelona'])
+    if location is None:
+        raise BotException('Address could not be found.\n  -> ' + address)
+    return location
+
+
+def nearest_stations(G, address, k):
+    '''
+    Returns the coordinates of address and its k closest stations, as a list
+    of (station id, distance (m), bikes, docks). Bikes and docks are None
+    if the station is missing from the status.
+    '''
+    location = locate(address)
+    idx, dist = G.stations.spatial().nearest(location[0], location[1], k)
+    bikes, docks = station_status(G)
+    ids = G.stations.ids
+    return location, [(ids[i].item(), int(round(1000 * d)),
+                       None if bikes[i] < 0 else int(bikes[i]),
+                       None if docks[i] < 0 else int(docks[i]))
+                      for i, d in zip(idx.tolist(), dist.tolist())]
+
 
-def plot_route(path, filename):
-    ''' Creates a file with the map of Barcelona
+def reachable_stations(G, address, km):
+    '''
+    Returns the station closest to address and the walking distance (m) to
+    it, and the stations reachable by bike from it within km (km) with
+    their distances, from the closest. Distances are looked up in the
+    oracle of G, or found with a Dijkstra up to km if G is too large.
+    '''
+    location = locate(address)
+    if len(G.stations) == 0:
+        raise BotException('There are no stations.')
+    (start,), (walk,) = G.stations.spatial().nearest(*location)
+
+    oracle = oracles.get(G)
+    with metrics.phase('route'):
+        if oracle is not None:
+            idx, dist = oracle.within(start, km)
+        else:
+            row = G.distances([start], km)[0]
+            idx = np.flatnonzero(row <= km)
+            idx = idx[np.argsort(row[idx], kind='stable')]
+            dist = row[idx]
+    return int(start), int(round(1000 * walk)), idx, dist
+
+
+def plot_reach(G, start, km, idx, dist):
+    '''
+    Returns a PNG buffer with the map of the stations idx reachable from
+    station start within km, coloured by their distances dist, or the
+    Telegram file_id of the same map if it was already sent. Maps are
+    cached by graph, station and km.
+    '''
+    import render
+    key = (G.version, G.distance, render.SIZE, 'reach', start, km)
+    if G.version is not None:
+        image = render.images.get(key)
+        if image is not None:
+            metrics.hit('image')
+            return image
+        metrics.miss('image')
+
+    with metrics.phase('render'):
+        png = workers.cpu(draw_reach, G, start, km, idx, dist)
+    if G.version is not None:
+        render.images.put(key, png)
+    return BytesIO(png)
+
+
+def draw_reach(G, start, km, idx, dist):
+    ''' Returns the PNG image of the map of /reach, see plot_reach. '''
+    from staticmap import CircleMarker
+    import render
+    lon, lat = G.stations.lon, G.stations.lat
+    scale = 1 / km if km else 0
+    markers = [CircleMarker((lon[i], lat[i]), render.gradient(d * scale), 6)
+               for i, d in zip(idx.tolist(), dist.tolist())]
+    markers.append(CircleMarker((lon[start], lat[start]), 'black', 10))
+    return render.png([], markers)
+
+
+def reach_plotted(G, start, km, file_id):
+    ''' Keeps the Telegram file_id of a /reach map once it has been sent. '''
+    import render
+    if G.version is not None:
+        render.images.sent((G.version, G.distance, render.SIZE, 'reach',
+                            start, km), file_id)
+
+
+def plot_route(path):
+    ''' Returns a PNG buffer with the map of Barcelona
         showing the route indicated in path.'''
-    mapa = StaticMap(800, 800)
+    from staticmap import CircleMarker, Line
+    import render
+    lines, markers = [], []
     last = path[0]
     for node in path:
         if node.coords() != last.coords():
-            mapa.add_marker(CircleMarker(last.coords(), 'blue', 6))
+            markers.append(CircleMarker(last.coords(), 'blue', 6))
             coord = [list(node.coords()), list(last.coords())]
             if(node == path[1] or node == path[-1]):
                 line = Line(coord, 'red', 3)
             else:
                 line = Line(coord, 'blue', 3)
-            mapa.add_line(line)
+            lines.append(line)
             last = node
-    mapa.add_marker(CircleMarker(path[0].coords(), 'red', 8))
-    mapa.add_marker(CircleMarker(path[-1].coords(), 'red', 8))
-    imatge = mapa.render()
-    imatge.save(filename)
+    markers.append(CircleMarker(path[0].coords(), 'red', 8))
+    markers.append(CircleMarker(path[-1].coords(), 'red', 8))
+    with metrics.phase('render'):
+        return BytesIO(workers.cpu(render.png, lines, markers, True))
 
 
-def create_route(G_, args, filename):
+def create_route(G, args):
     '''
-    Creates a file (map.png) with the map of Barcelona showing all Bicing
+    Returns a PNG buffer with the map of Barcelona showing the Bicing
     stations and edges of the shortest route that connect two given adresses.
     '''
     # Getting coordinates from input string
-    G = G_.copy()
     if len(args) == 0:
         raise BotException('No addresses were given.')
     adresses = ''.join([s + ' ' for s in args])
     cood1, cood2 = addressesTOcoordinates(adresses)
 
-    add1, add2 = Node(cood1[0], cood1[1]), Node(cood2[0], cood2[1])
-    G.add_node(add1)
-    G.add_node(add2)
-    for node in G.nodes():
-        if node is not add1:
-            G.add_edge(add1, node, weight=node.distance_to(add1)/4)
-        if node is not add2:
-            G.add_edge(add2, node, weight=node.distance_to(add2)/4)
-    path = nx.dijkstra_path(G, add1, add2)
-    plot_route(path, filename)
+    with metrics.phase('route'):
+        path = G.route(cood1, cood2)
+    return plot_route([Node(cood1[0], cood1[1])] +
+                      [G.stations.node(i) for i in path] +
+                      [Node(cood2[0], cood2[1])])
 
 
-def get_connected_components(G):
+def get_connected_components(G, distance=None):
     '''
-    Returns the number of connected components of the Graph. If the number
+    Returns the number of connected components of the Graph, or of the
+    graph of its snapshot with the given distance (m). If the number
     is 1, every node is accessible from any starting point.
     '''
-    return len(list(nx.connected_components(G)))
+    if distance is None:
+        return G.number_of_components()
+    return G.connectivity.components(distance)
 
 
-def plot_graph(G, filename):
+def plot_components(G):
+    ''' Returns a buffer with the chart of the number of connected components
+        of the graphs of the snapshot of G against their distance. '''
+    import render
+    distances, counts = G.connectivity.curve()
+    with metrics.phase('render'):
+        return BytesIO(render.steps(distances.tolist(), counts.tolist(),
+                                    MAX_DISTANCE, G.distance,
+                                    ('distance (m)', 'components')))
+
+
+def plot_graph(G):
     '''
-    Creates a file (filename) with the map of Barcelona showing all
+    Returns a PNG buffer with the map of Barcelona showing all
     Bicing stations and the edges of the graph that connect them.
+    Maps are cached by graph (snapshot version and distance). If the map
+    was already sent, its Telegram file_id is returned instead.
     '''
-    mapa = StaticMap(800, 800)
-    for node in list(G.nodes):
-        mapa.add_marker(CircleMarker(node.coords(), 'red', 5))
-    for node1, node2 in list(G.edges):
-        coord = [list(node1.coords()), list(node2.coords())]
-        line = Line(coord, 'blue', 1)
-        mapa.add_line(line)
-    imatge = mapa.render()
-    imatge.save(filename)
-
-
-def create_flow_network(G_, stations, bikes, requiredBikes, requiredDocks):
-    ''' Create flow graph according to our model. The geometric graph is copied.
-        Returns a directed flow network Graph. '''
-    G = nx.DiGraph()
-    G.add_node('TOP')  # The green node
-    demand = 0
-
-    for st in bikes.itertuples():
-        idx = st.Index
-        if idx not in stations.index: continue
-        stridx = str(idx)
-
-        b_idx, k_idx, r_idx = 'b'+stridx, 'k'+stridx, 'r'+stridx
-        G.add_nodes_from([b_idx, k_idx, r_idx])
-
-        b, d = st.num_bikes_available, st.num_docks_available
-        req_bikes = max(0, requiredBikes - b)
-        req_docks = max(0, requiredDocks - d)
-
-        # Connect nodes and set boundary capacities
-        G.add_edge('TOP', b_idx)
-        G.add_edge(r_idx, 'TOP')
-        G.add_edge(b_idx, k_idx, capacity=max(0, b-requiredBikes))
-        G.add_edge(k_idx, r_idx, capacity=max(0, d-requiredDocks))
-
-        # Set demand to source and sink nodes
-        if req_bikes > 0:
-            demand += req_bikes
-            G.nodes[r_idx]['demand'] = +req_bikes
-        elif req_docks > 0:
-            demand -= req_docks
-            G.nodes[b_idx]['demand'] = -req_docks
-
-    G.nodes['TOP']['demand'] = -demand    # Compensate demand from nodes
-
-    # Copy edges from geometric graph
-    for u, v in G_.edges:
-        idx1, idx2 = u.id, v.id
-        dist = int(G_[u][v]['weight'] * 1e4)
-        # The edges must be bidirectional: k_idx1 <--> k_idx2
-        G.add_edge('k'+str(idx1), 'k'+str(idx2), weight=dist)
-        G.add_edge('k'+str(idx2), 'k'+str(idx1), weight=dist)
-
-    return G
-
-def update_stations(G, flowDict, bikes, requiredBikes, requiredDocks):
+    import render
+    key = (G.version, G.distance, render.SIZE)
+    if G.version is not None:
+        image = render.images.get(key)
+        if image is not None:
+            metrics.hit('image')
+            return image
+        metrics.miss('image')
+
+    with metrics.phase('render'):
+        png = workers.cpu(draw_graph, G)
+    if G.version is not None:
+        render.images.put(key, png)
+    return BytesIO(png)
+
+
+def draw_graph(G):
+    ''' Returns the PNG image of the map of G. '''
+    from staticmap import CircleMarker, Line
+    import render
+    lon, lat = G.stations.lon.tolist(), G.stations.lat.tolist()
+    markers = [CircleMarker(coords, 'red', 5) for coords in zip(lon, lat)]
+    u, v, w = G.edges()
+    lines = [Line([[lon[i], lat[i]], [lon[j], lat[j]]], 'blue', 1)
+             for i, j in zip(u.tolist(), v.tolist())]
+    return render.png(lines, markers)
+
+
+def graph_plotted(G, file_id):
+    ''' Keeps the Telegram file_id of the map of G once it has been sent. '''
+    import render
+    if G.version is not None:
+        render.images.sent((G.version, G.distance, render.SIZE), file_id)
+
+
+def create_flow_network(G_, bikes, docks, requiredBikes, requiredDocks):
+    ''' Flow network of the geometric graph, built once per graph (see flow.py),
+        with the demands and capacities of the given status.
+        Returns the network, the demands and the capacities. '''
+    G = flow.network(G_)
+    demand, capacity = G.status(bikes, docks, requiredBikes, requiredDocks)
+    return G, demand, capacity
+
+def update_stations(G, flow, bikes, docks, requiredBikes, requiredDocks):
     ''' Update stations according to the transportation of bicycles.
-        Returns a list with all the moves, with bike num. and distance. '''
-    nbikes = 'num_bikes_available'
-    ndocks = 'num_docks_available'
-    moves = []
-    for src in flowDict:
-        if src[0] != 'k': continue
-        idx_src = int(src[1:])
-        for dst, b in flowDict[src].items():
-            if dst[0] == 'k' and b > 0:
-                idx_dst = int(dst[1:])
-                print(idx_src, "->", idx_dst, " ", b, "bikes, distance",
-                      G.edges[src, dst]['weight'])
-                moves.append((idx_src, idx_dst, b, G.edges[src, dst]['weight']))
-                bikes.at[idx_src, nbikes] -= b
-                bikes.at[idx_dst, nbikes] += b
-                bikes.at[idx_src, ndocks] += b
-                bikes.at[idx_dst, ndocks] -= b
-
+        Returns the moves as arrays: origin and destination stations
+        (indices in the graph), bikes and distance (m) of every move. '''
+    arcs = np.flatnonzero(flow[G.first_edge:]) + G.first_edge
+    src, dst = G.tail[arcs] - G.n, G.head[arcs] - G.n
+    b = np.asarray(flow[arcs], dtype=np.int64)
+    np.subtract.at(bikes, src, b)
+    np.add.at(bikes, dst, b)
+    np.add.at(docks, src, b)
+    np.subtract.at(docks, dst, b)
+
+    moves = (src, dst, b, G.cost[arcs])
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for move in zip(G.ids[src].tolist(), G.ids[dst].tolist(), b.tolist(),
+                        G.cost[arcs].tolist()):
+            logging.debug('%s -> %s  %d bikes, distance %d', *move)
     return moves
 
 
@@ -312,43 +783,243 @@ def distribute_bikes(G_, requiredBikes, requiredDocks):
     '''
     Use a flow network approach to compute the redistribution of bikes.
     returns: Minimum distribution cost.
-             List of moves: (source, destination, num_of_bikes)
+             Move with the highest cost: (source, destination, bikes, distance)
+    '''
+    cost, moves = distribution_plan(G_, requiredBikes, requiredDocks)
+    return cost, top_moves(G_, moves, 1)[0]
+
+
+def distribution_plan(G_, requiredBikes, requiredDocks):
+    ''' Minimum distribution cost (km) and all the moves of the solution,
+        as arrays (see update_stations). '''
+    bikes, docks = station_status(G_)
+    with metrics.phase('solve'):
+        return workers.cpu(solve_distribution, G_, bikes, docks,
+                           requiredBikes, requiredDocks)
+
+
+def top_moves(G_, moves, k):
     '''
+    Returns the k moves with the highest cost (bikes by distance), from the
+    highest, as (source, destination, bikes, distance). They are taken with
+    a heap, without sorting all the moves.
+    '''
+    src, dst, bikes, dist = moves
+    cost = (bikes * dist).tolist()
+    ids = G_.stations.ids
+    return [(ids[src[i]].item(), ids[dst[i]].item(), int(bikes[i]),
+             int(dist[i]))
+            for i in heapq.nlargest(k, range(len(cost)), key=cost.__getitem__)]
+
+
+def plan_csv(G_, moves):
+    '''
+    Returns the CSV document (bytes) with all the moves of a plan, from the
+    highest cost. The rows are written straight from the arrays of moves.
+    '''
+    src, dst, bikes, dist = moves
+    cost = bikes * dist
+    order = np.argsort(-cost, kind='stable')
+    src, dst = src[order], dst[order]
+    st = G_.stations
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator='\n')
+    writer.writerow(PLAN_FIELDS)
+    writer.writerows(zip(
+        st.ids[src].tolist(), st.ids[dst].tolist(), bikes[order].tolist(),
+        dist[order].tolist(), (cost[order] / 1000).tolist(),
+        st.lat[src].tolist(), st.lon[src].tolist(), st.lat[dst].tolist(),
+        st.lon[dst].tolist()))
+    return text.getvalue().encode()
+
+
+def plot_plan(G_, moves):
+    ''' Returns a PNG buffer with the map of the moves of a plan. '''
+    with metrics.phase('render'):
+        return BytesIO(workers.cpu(draw_plan, G_, moves))
+
+
+def draw_plan(G_, moves):
+    '''
+    Returns the PNG image of the map of the moves of a plan: a line from the
+    origin (red) to the destination (blue) of every move, wider with more
+    bikes and from green to red with its cost.
+    '''
+    from staticmap import CircleMarker, Line
+    import render
+    src, dst, bikes, dist = moves
+    cost = bikes * dist
+    high = max(cost.max(), 1) if len(cost) else 1
+    lon, lat = G_.stations.lon, G_.stations.lat
+    lines = [Line([[lon[i], lat[i]], [lon[j], lat[j]]], render.gradient(c / high),
+                  min(b, 5) + 1)
+             for i, j, b, c in zip(src.tolist(), dst.tolist(), bikes.tolist(),
+                                   cost.tolist())]
+    markers = [CircleMarker((lon[i], lat[i]), 'red', 5)
+               for i in np.unique(src).tolist()]
+    markers += [CircleMarker((lon[j], lat[j]), 'blue', 5)
+                for j in np.unique(dst).tolist()]
+    return render.png(lines, markers)
+
+
+def station_status(G_):
+    ''' Latest bikes and docks published by the poller, for the stations
+        of the graph. '''
+    try:
+        return statuses.get().aligned(G_.stations)
+    except (OSError, ValueError, KeyError):
+        raise BotException('Could not retrieve Bicing data. ' +
+                           'Data might be inaccessible.')
+
 
-    # retrieve bike data
-    url_info = 'https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/station_information'
-    url_status = 'https://api.bsmsa.eu/ext/api/bsm/gbfs/v2/en/station_status'
-    stations = pd.DataFrame.from_records(
-        pd.read_json(url_info)['data']['stations'], index='station_id')
-    bikes = pd.DataFrame.from_records(
-        pd.read_json(url_status)['data']['stations'], index='station_id')
+def status_note():
+    ''' Returns a line telling how old the status is if it is stale (the
+        feed could not be polled for a while), or else an empty string. '''
+    if not statuses.stale():
+        return ''
+    age = statuses.age()
+    return ('\n(The status of the stations is from %s ago: Bicing data '
+            'might be inaccessible.)' % ('%d min' % (age // 60) if age >= 60
+                                        else '%d s' % age))
 
-    nbikes = 'num_bikes_available'
-    ndocks = 'num_docks_available'
-    bikes = bikes[[nbikes, ndocks]]  # We only select the interesting columns
 
+def solve_distribution(G_, bikes, docks, requiredBikes, requiredDocks):
+    '''
+    Solves the flow network of the geometric graph G_ for the given status.
+    returns: Minimum distribution cost.
+             Moves of the solution (see update_stations).
+    '''
     try:
-        G = create_flow_network(G_, stations, bikes, requiredBikes, requiredDocks)
-        print('Graph with', G.number_of_nodes(),
-              "nodes and", G.number_of_edges(), "edges.")
+        G, demand, capacity = create_flow_network(G_, bikes, docks,
+                                                  requiredBikes, requiredDocks)
+        logging.info('Flow network with %d nodes and %d edges.',
+                     G.number_of_nodes(), G.number_of_arcs())
     except Exception as err:
         raise BotException('Could not create graph: \n' + str(err))
 
     try:
-        flowCost, flowDict = nx.network_simplex(G)
+        flowCost, flow_ = G.solve(demand, capacity)
 
-    except nx.NetworkXUnfeasible:
+    except flow.Unfeasible:
         raise BotException('No solution was found.')
 
     except Exception as err:
         raise Exception('Internal error. Error with the model.\n' + str(err))
 
-    print("The total cost of transferring bikes is", flowCost/1000, "km.")
+    logging.info('The total cost of transferring bikes is %g km.',
+                 flowCost/1000)
 
-    moves = update_stations(G, flowDict, bikes, requiredBikes, requiredDocks)
-    if len(moves) == 0:
+    bikes, docks = bikes.copy(), docks.copy()   # The status is read-only
+    moves = update_stations(G, flow_, bikes, docks, requiredBikes,
+                            requiredDocks)
+    if len(moves[0]) == 0:
         raise BotException('No transportation of bikes is needed.')
 
-    cost = lambda x: x[2]*x[3]  # Cost function
+    return flowCost/1000, moves
 
-    return flowCost/1000, max(moves, key=cost)
+
+def sweep_distribution(G_, bikeTargets, dockTargets):
+    '''
+    Minimum distribution cost for every pair of required bikes and docks,
+    with the same status and flow network.
+    returns: Matrix of costs (km) by bikes (rows) and docks (columns),
+             None where there is no solution.
+             Seconds taken.
+    '''
+    start = time.perf_counter()
+    bikes, docks = station_status(G_)
+    with metrics.phase('solve'):
+        costs = workers.cpu(solve_sweep, G_, bikes, docks, bikeTargets,
+                            dockTargets)
+    return costs, time.perf_counter() - start
+
+
+def solve_sweep(G_, bikes, docks, bikeTargets, dockTargets):
+    ''' Costs of sweep_distribution. Only the costs are needed, so ties
+        between flows are not broken. '''
+    G = flow.network(G_)
+    costs = [[None] * len(dockTargets) for rb in bikeTargets]
+    for i, rb in enumerate(bikeTargets):
+        for j, rd in enumerate(dockTargets):
+            demand, capacity = G.status(bikes, docks, rb, rd)
+            if not demand.any():
+                costs[i][j] = 0.0   # Nothing to move
+                continue
+            try:
+                cost, flow_ = G.solve(demand, capacity, canonical=False)
+                costs[i][j] = cost / 1000
+            except flow.Unfeasible:
+                pass
+    return costs
+
+
+def plot_sweep(bikeTargets, dockTargets, costs):
+    ''' Returns a buffer with the heatmap of the costs of a sweep. '''
+    import render
+    with metrics.phase('render'):
+        return BytesIO(render.heatmap(bikeTargets, dockTargets, costs))
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def history():
+    ''' Returns the HistoryFile of the station status, opened on first use. '''
+    global _history
+    if not HISTORY_FILE:
+        raise BotException('The history of the stations is not recorded.')
+    with _history_lock:
+        if _history is None:
+            _history = recorder.HistoryFile(HISTORY_FILE)
+        return _history
+
+
+def record_history():
+    ''' Records every status published by the poller, unless HISTORY_FILE
+        is empty. '''
+    if HISTORY_FILE:
+        statuses.record = history().append
+
+
+def close_history():
+    ''' Writes the records kept in memory to the history file. '''
+    if _history is not None:
+        _history.close()
+
+
+def station_history(station, hours):
+    '''
+    Returns the id of station (given as text), the times (s), bikes and
+    docks of its status over the last hours of the history, and the time
+    of the last status recorded.
+    '''
+    H = history()
+    end = H.last_time()
+    if end is None:
+        raise BotException('No status has been recorded yet.')
+    id = H.station_id(station)
+    if id is None:
+        raise BotException('Unknown station ' + station + '.')
+    with metrics.phase('history'):
+        times, bikes, docks = H.query(id, end - hours * 3600, end)
+    if len(times) == 0:
+        raise BotException('No status of station %s in the last %g hours.' %
+                           (station, hours))
+    return id, times, bikes, docks, end
+
+
+def plot_history(times, bikes, docks, hours, end):
+    ''' Returns a PNG buffer with the chart of the bikes and docks of a
+        station against the hours from the start of the window. Missing
+        values (the station was not in the feed) are drawn as 0. '''
+    import render
+    start = end - hours * 3600
+    xs = ((times - start) / 3600).tolist()
+    with metrics.phase('render'):
+        return BytesIO(render.steps(
+            xs, np.maximum(bikes, 0).tolist(), hours,
+            labels=('hours since ' + time.strftime('%Y-%m-%d %H:%M',
+                                                   time.localtime(start)),
+                    'bikes'),
+            series=[(np.maximum(docks, 0).tolist(), 'red', 'docks')]))
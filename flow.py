@@ -0,0 +1,277 @@
+'''© fergascod & asleix'''
+
+from collections import OrderedDict
+import importlib.util
+import os
+import threading
+
+import numpy as np
+
+
+# Flow networks kept in memory, by graph (snapshot version and distance).
+FLOW_CACHE = 4
+
+# Min cost flow solver: 'networkx' (the reference), 'highs' (SciPy's HiGHS)
+# or 'auto' (highs when SciPy is installed, networkx otherwise).
+FLOW_SOLVER = os.environ.get('BICING_FLOW_SOLVER', 'auto')
+
+# Range of the priorities that break ties between optimal flows.
+PRIORITIES = 1 << 16
+
+
+class Unfeasible(Exception):
+    ''' No flow satisfies all the demands. '''
+    pass
+
+
+class FlowNetwork:
+    '''
+    Topology of the flow network of a geometric graph, with integer nodes.
+    For station i: b_i = i (blue), k_i = n + i (black), r_i = 2n + i (red),
+    and TOP = 3n (green). Arcs are kept in arrays (tail, head, cost):
+        [0, n)      TOP -> b_i
+        [n, 2n)     r_i -> TOP
+        [2n, 3n)    b_i -> k_i, capacity: bikes that can be given
+        [3n, 4n)    k_i -> r_i, capacity: docks that can be given
+        [4n, ...)   k_u <-> k_v for every edge, cost: distance (m)
+    Only the demands and the capacities of the stations depend on the
+    status, the rest is built once per graph.
+
+    There can be several flows of minimum cost. All the solvers return the
+    one of lowest priority (a fixed random number of every arc), so they
+    give the same moves.
+    '''
+    def __init__(self, G):
+        n = G.number_of_nodes()
+        u, v, w = G.edges()
+        dist = (w.astype(np.float64) * 1e4).astype(np.int64)
+        st = np.arange(n)
+
+        self.n = n
+        self.ids = G.stations.ids
+        self.top = 3 * n
+        self.tail = np.concatenate([np.full(n, self.top), 2 * n + st, st,
+                                    n + st, n + u, n + v])
+        self.head = np.concatenate([st, np.full(n, self.top), n + st,
+                                    2 * n + st, n + v, n + u])
+        self.cost = np.concatenate([np.zeros(4 * n, np.int64), dist, dist])
+        self.first_edge = 4 * n
+        self.priority = np.random.default_rng(0).integers(
+            1, PRIORITIES, len(self.tail))
+
+        # Structures of the solvers, built on first use
+        self.solver_data = {}
+        self.lock = threading.Lock()
+
+    def number_of_nodes(self):
+        return 3 * self.n + 1
+
+    def number_of_arcs(self):
+        return len(self.tail)
+
+    def upper_bounds(self, capacity):
+        ''' Capacity of every arc (inf if it has none). '''
+        upper = np.full(len(self.tail), np.inf)
+        upper[2 * self.n:4 * self.n] = capacity
+        return upper
+
+    def status(self, bikes, docks, requiredBikes, requiredDocks):
+        '''
+        Returns the demand of every node and the capacity of the arcs
+        b_i -> k_i and k_i -> r_i for the given bikes and docks of every
+        station (aligned to the graph, negative if unknown).
+        '''
+        known = (bikes >= 0) & (docks >= 0)
+        bikes, docks = np.where(known, bikes, 0), np.where(known, docks, 0)
+        req_bikes = np.where(known, np.maximum(0, requiredBikes - bikes), 0)
+        req_docks = np.where(known, np.maximum(0, requiredDocks - docks), 0)
+        req_docks[req_bikes > 0] = 0   # Stations lacking bikes ask for bikes
+
+        n = self.n
+        demand = np.zeros(3 * n + 1, np.int64)
+        demand[2 * n:3 * n] = req_bikes
+        demand[:n] = -req_docks
+        demand[self.top] = req_docks.sum() - req_bikes.sum()
+
+        capacity = np.concatenate([
+            np.where(known, np.maximum(0, bikes - requiredBikes), 0),
+            np.where(known, np.maximum(0, docks - requiredDocks), 0)])
+        return demand, capacity
+
+    def solve(self, demand, capacity, solver_=None, canonical=True):
+        '''
+        Minimum cost flow for the given demands and capacities, with the
+        given solver (see FLOW_SOLVER). Returns the cost and the flow of
+        every arc. Raises Unfeasible if there is no solution.
+        Without canonical, ties are not broken: the cost is the same but
+        the flow can depend on the solver.
+        '''
+        flow = (solver_ or solver()).solve(self, demand, capacity, canonical)
+        return int(self.cost @ flow), flow
+
+
+class NetworkXSolver:
+    '''
+    nx.network_simplex on a networkx graph of the network, built once and
+    whose demands and capacities are set for every solve. Ties are broken
+    by solving with cost * K + priority, with K large enough for the
+    priorities not to change the cost (an optimal flow of lowest priority
+    has no cycles, so every bike goes through less than N arcs).
+    '''
+    name = 'networkx'
+
+    def __init__(self):
+        import networkx
+        self.nx = networkx
+
+    def graph(self, network):
+        ''' Returns the graph of network, its node and arc attributes. '''
+        with network.lock:
+            if self.name not in network.solver_data:
+                network.solver_data[self.name] = self.build(network)
+            return network.solver_data[self.name]
+
+    def build(self, network):
+        # The simplex pivots depend on the order of the nodes and arcs, so
+        # they are added station by station, then the edges in both ways.
+        n, edges = network.n, (network.number_of_arcs() - network.first_edge) // 2
+        st = np.arange(n)
+        order = np.concatenate([st.reshape(-1, 1) + np.arange(4) * n,
+                                network.first_edge + np.arange(edges).reshape(-1, 1)
+                                + np.array([0, edges])], axis=None)
+        G = self.nx.DiGraph()
+        G.add_node(network.top, demand=0)
+        G.add_nodes_from((st.reshape(-1, 1) + np.array([0, n, 2 * n]))
+                         .ravel().tolist(), demand=0)
+        for t, h in zip(network.tail[order].tolist(),
+                        network.head[order].tolist()):
+            G.add_edge(t, h)
+        nodes = [G.nodes[i] for i in range(network.number_of_nodes())]
+        arcs = [G[t][h] for t, h in zip(network.tail.tolist(),
+                                        network.head.tolist())]
+        return G, nodes, arcs, threading.Lock()
+
+    def solve(self, network, demand, capacity, canonical=True):
+        G, nodes, arcs, lock = self.graph(network)
+        if canonical:
+            supply = int(np.maximum(0, -demand).sum())
+            K = (PRIORITIES - 1) * supply * network.number_of_nodes() + 1
+            weights = (network.cost.astype(object) * K +
+                       network.priority.astype(object)).tolist()
+        else:
+            weights = network.cost.tolist()
+        n = network.n
+
+        with lock:
+            for attrs, d in zip(nodes, demand.tolist()):
+                attrs['demand'] = d
+            for attrs, w in zip(arcs, weights):
+                attrs['weight'] = w
+            for attrs, c in zip(arcs[2 * n:4 * n], capacity.tolist()):
+                attrs['capacity'] = c
+            try:
+                cost, flowDict = self.nx.network_simplex(G)
+            except self.nx.NetworkXUnfeasible as err:
+                raise Unfeasible(str(err))
+
+        return np.array([flowDict[t][h] for t, h in zip(
+            network.tail.tolist(), network.head.tolist())], np.int64)
+
+
+class HighsSolver:
+    '''
+    Linear program of the network solved with the dual simplex of HiGHS
+    (scipy.optimize.linprog). The solutions of the simplex are integer.
+    Ties are broken by a second program on the flows of minimum cost: with
+    the potentials (duals) of the first one, arcs of negative reduced cost
+    are saturated, arcs of positive reduced cost are empty and the rest
+    are free, and the priority is minimized.
+    '''
+    name = 'highs'
+
+    def __init__(self):
+        from scipy import optimize, sparse
+        self.optimize = optimize
+        self.sparse = sparse
+
+    def incidence(self, network):
+        ''' Node-arc incidence matrix of network: -1 at tails, +1 at heads. '''
+        with network.lock:
+            if self.name not in network.solver_data:
+                m = network.number_of_arcs()
+                arcs = np.arange(m)
+                network.solver_data[self.name] = self.sparse.csr_matrix(
+                    (np.repeat([-1.0, 1.0], m), (np.r_[network.tail, network.head],
+                                                 np.r_[arcs, arcs])),
+                    shape=(network.number_of_nodes(), m))
+            return network.solver_data[self.name]
+
+    def linprog(self, cost, A, demand, lower, upper):
+        result = self.optimize.linprog(cost, A_eq=A, b_eq=demand,
+                                       bounds=np.c_[lower, upper],
+                                       method='highs-ds')
+        if result.status == 2:
+            raise Unfeasible('no flow satisfies all node demands')
+        if result.status != 0:
+            raise RuntimeError(result.message)
+        return result
+
+    def solve(self, network, demand, capacity, canonical=True):
+        A = self.incidence(network)
+        lower = np.zeros(network.number_of_arcs())
+        upper = network.upper_bounds(capacity)
+        first = self.linprog(network.cost, A, demand, lower, upper)
+        if not canonical:
+            return np.rint(first.x).astype(np.int64)
+
+        potential = np.rint(first.eqlin.marginals)
+        reduced = network.cost - (potential[network.head] -
+                                  potential[network.tail])
+        lower = np.where(reduced < 0, upper, 0)
+        upper = np.where(reduced > 0, 0, upper)
+        second = self.linprog(network.priority, A, demand, lower, upper)
+
+        flow = np.rint(second.x).astype(np.int64)
+        if int(network.cost @ flow) != round(first.fun):
+            raise RuntimeError('HiGHS flows of different cost')
+        return flow
+
+
+SOLVERS = {'networkx': NetworkXSolver, 'highs': HighsSolver}
+_solvers = {}
+
+
+def solver(name=None):
+    ''' Returns the solver with name (FLOW_SOLVER by default). '''
+    name = name or FLOW_SOLVER
+    if name == 'auto':   # Without importing SciPy, which is slow
+        name = 'highs' if importlib.util.find_spec('scipy') else 'networkx'
+    if name not in SOLVERS:
+        raise ValueError('Unknown flow solver %r, use one of: auto, %s' %
+                         (name, ', '.join(SOLVERS)))
+    if name not in _solvers:
+        _solvers[name] = SOLVERS[name]()
+    return _solvers[name]
+
+
+_networks = OrderedDict()
+_networks_lock = threading.Lock()
+
+
+def network(G):
+    ''' Returns the flow network of G, cached by snapshot version and distance. '''
+    key = (G.version, G.distance)
+    if G.version is None:
+        return FlowNetwork(G)
+
+    with _networks_lock:
+        if key in _networks:
+            _networks.move_to_end(key)
+            return _networks[key]
+
+    net = FlowNetwork(G)
+    with _networks_lock:
+        net = _networks.setdefault(key, net)
+        while len(_networks) > FLOW_CACHE:
+            _networks.popitem(last=False)
+    return net
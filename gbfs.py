@@ -0,0 +1,100 @@
+'''© fergascod & asleix'''
+
+import json
+import operator
+
+import numpy as np
+
+
+class FeedError(ValueError):
+    ''' The content of a feed does not follow the GBFS schema. '''
+    pass
+
+
+# Fields read from the station records of every feed, with their checks.
+NUMBER = (int, float)
+INFORMATION = {'station_id': None, 'lat': NUMBER, 'lon': NUMBER}
+STATUS = {'station_id': None, 'num_bikes_available': (int,),
+          'num_docks_available': (int,)}
+
+
+def read(content, fields):
+    '''
+    Parses a GBFS feed keeping only the given fields of its stations.
+    Every station record is reduced to a tuple of those fields as soon as
+    it is decoded, so the records are never all in memory as dicts.
+    Returns the feed (whose stations are None) and the lists of fields.
+    '''
+    names = list(fields)
+    get = operator.itemgetter(*names)
+    rows = []
+
+    def station(record):
+        if 'station_id' not in record:
+            return record   # Not a station (the feed, or nested in one)
+        try:
+            rows.append(get(record))
+        except KeyError as err:
+            raise FeedError('Station %r without %s' %
+                            (record['station_id'], err))
+        return None
+
+    try:
+        feed = json.loads(content, object_hook=station)
+    except json.JSONDecodeError as err:
+        raise FeedError('Invalid JSON: ' + str(err))
+    try:
+        stations = feed['data']['stations']
+    except (KeyError, TypeError):
+        raise FeedError('No data.stations in the feed')
+    if not isinstance(stations, list) or stations.count(None) != len(stations):
+        raise FeedError('Records of data.stations without station_id')
+
+    columns = dict(zip(names, map(list, zip(*rows)))) if rows else \
+        {name: [] for name in names}
+    for name, types in fields.items():
+        wrong = set(map(type, columns[name])).difference(types or ())
+        if types is not None and wrong:   # bool is not accepted as int
+            raise FeedError('Wrong type of %s: %s' % (
+                name, ', '.join(sorted(t.__name__ for t in wrong))))
+    return feed, columns
+
+
+def station_ids(ids):
+    ''' Array of station ids, which must be all integers or all strings. '''
+    kinds = set(map(type, ids))
+    if kinds <= {int}:
+        return np.array(ids, dtype=np.int64)
+    if kinds == {str}:
+        return np.array(ids, dtype=str)
+    raise FeedError('Station ids must be all integers or all strings')
+
+
+def information(content):
+    '''
+    Parses station_information. Returns the arrays of station ids,
+    latitudes and longitudes.
+    '''
+    feed, columns = read(content, INFORMATION)
+    ids = station_ids(columns['station_id'])
+    lat = np.array(columns['lat'], dtype=np.float64)
+    lon = np.array(columns['lon'], dtype=np.float64)
+    if len(np.unique(ids)) != len(ids):
+        raise FeedError('Repeated station ids')
+    if ((np.abs(lat) > 90) | (np.abs(lon) > 180)).any():
+        raise FeedError('Coordinates out of range')
+    return ids, lat, lon
+
+
+def status(content):
+    '''
+    Parses station_status. Returns last_updated, ttl (None if missing) and
+    the arrays of station ids, bikes and docks available.
+    '''
+    feed, columns = read(content, STATUS)
+    ids = station_ids(columns['station_id'])
+    bikes = np.array(columns['num_bikes_available'], dtype=np.int64)
+    docks = np.array(columns['num_docks_available'], dtype=np.int64)
+    if (bikes < 0).any() or (docks < 0).any():
+        raise FeedError('Negative bikes or docks')
+    return feed.get('last_updated'), feed.get('ttl'), ids, bikes, docks
@@ -0,0 +1,138 @@
+'''© fergascod & asleix'''
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import metrics
+
+
+# File of the geocoding cache.
+GEOCODE_DB = os.environ.get('BICING_GEOCODE_DB',
+                            os.path.join('cache', 'geocode.sqlite'))
+
+# Seconds that found addresses (positive) and not found ones (negative)
+# are kept in the cache.
+GEOCODE_TTL = float(os.environ.get('BICING_GEOCODE_TTL', 30 * 24 * 3600))
+GEOCODE_NEGATIVE_TTL = float(os.environ.get('BICING_GEOCODE_NEGATIVE_TTL',
+                                            24 * 3600))
+
+# JSON file with addresses and their coordinates ({address: [lat, lon]}).
+# When given, it replaces Nominatim, so addresses can be found offline.
+GAZETTEER = os.environ.get('BICING_GAZETTEER')
+
+
+def normalize(address):
+    ''' Returns the key of an address: lower case and single spaces. '''
+    address = unicodedata.normalize('NFKC', address).casefold()
+    parts = (' '.join(part.split()) for part in address.split(','))
+    return ', '.join(part for part in parts if part)
+
+
+class Nominatim:
+    ''' Geocoder backend using the OpenStreetMap Nominatim service. '''
+    def __init__(self, user_agent='PyBicing_bot'):
+        from geopy.geocoders import Nominatim
+        self.geolocator = Nominatim(user_agent=user_agent)
+
+    def locate(self, address):
+        ''' Returns the coordinates (lat, lon) of address, or None. '''
+        location = self.geolocator.geocode(address)
+        if location is None:
+            return None
+        return (location.latitude, location.longitude)
+
+
+class Gazetteer:
+    ''' Geocoder backend reading the coordinates from a local JSON file. '''
+    def __init__(self, path):
+        with open(path) as file:
+            self.places = {normalize(address): tuple(coords)
+                           for address, coords in json.load(file).items()}
+
+    def locate(self, address):
+        ''' Returns the coordinates (lat, lon) of address, or None. '''
+        return self.places.get(normalize(address))
+
+
+class GeocodeCache:
+    '''
+    Geocoder that keeps the coordinates of the addresses already looked up
+    in a SQLite file, by normalized address. Addresses that could not be
+    found are also kept (with a shorter ttl) so they are not looked up again.
+    Errors of the backend are not cached.
+    '''
+    def __init__(self, backend, path=None, ttl=None, negative_ttl=None):
+        self.backend = backend
+        self.ttl = GEOCODE_TTL if ttl is None else ttl
+        self.negative_ttl = (GEOCODE_NEGATIVE_TTL if negative_ttl is None
+                             else negative_ttl)
+        path = path or GEOCODE_DB
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS geocode '
+                         '(address TEXT PRIMARY KEY, lat REAL, lon REAL, '
+                         'created REAL)')
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def cached(self, key):
+        ''' Returns (found, coordinates) for key in the cache. '''
+        with self._lock:
+            row = self._db.execute('SELECT lat, lon, created FROM geocode '
+                                   'WHERE address = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        lat, lon, created = row
+        ttl = self.negative_ttl if lat is None else self.ttl
+        if time.time() - created > ttl:
+            return False, None
+        return True, None if lat is None else (lat, lon)
+
+    def store(self, key, coords):
+        lat, lon = coords if coords is not None else (None, None)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO geocode VALUES '
+                             '(?, ?, ?, ?)', (key, lat, lon, time.time()))
+            self._db.commit()
+
+    def locate(self, address):
+        ''' Returns the coordinates (lat, lon) of address, or None. '''
+        key = normalize(address)
+        found, coords = self.cached(key)
+        if found:
+            metrics.hit('geocode')
+        else:
+            metrics.miss('geocode')
+            coords = self.backend.locate(address)
+            self.store(key, coords)
+        return coords
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='geocode')
+
+
+def geocoder():
+    ''' Returns the process-wide cached geocoder, created on first use. '''
+    global _geocoder
+    with _geocoder_lock:
+        if _geocoder is None:
+            backend = Gazetteer(GAZETTEER) if GAZETTEER else Nominatim()
+            _geocoder = GeocodeCache(backend)
+        return _geocoder
+
+
+def locate(addresses):
+    '''
+    Looks up several addresses concurrently.
+    Returns the list of their coordinates (lat, lon), None if not found.
+    '''
+    geo = geocoder()
+    return list(_pool.map(geo.locate, addresses))
@@ -0,0 +1,329 @@
+'''© fergascod & asleix'''
+
+import numpy as np
+
+
+EARTH_RADIUS = 6371.0088  # Mean earth radius (km), as in haversine
+EPS = 0.01                # Margin of the grid (degrees and km)
+BATCH = 1 << 20           # Maximum candidate pairs measured at once
+SLACK = 0.99              # Safety factor of the distance bounds of the grid
+SCAN = 5000               # Below this many stations, queries scan them all
+
+# Neighbouring cells visited from each cell. Together with the cell itself,
+# they cover the 8 surrounding cells once.
+NEIGHBOURS = ((1, 0), (0, 1), (1, 1), (1, -1))
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''
+    Vectorized haversine. Coordinates are arrays (or scalars) in degrees.
+    Returns the distances in km.
+    '''
+    lat1, lon1 = np.radians(lat1), np.radians(lon1)
+    lat2, lon2 = np.radians(lat2), np.radians(lon2)
+    lat, lon = lat2 - lat1, lon2 - lon1
+    d = (np.sin(lat * 0.5) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin(lon * 0.5) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(d))
+
+
+class Grid:
+    '''
+    Grid that divides the plane in cells of distance d + EPS (wider along
+    the parallels).
+    The stations are projected once to the plane: x is the distance along
+    the lower parallel of the bounding box and y along its left meridian.
+    Stations are sorted by cell, so the stations of a cell are contiguous.
+    '''
+    def __init__(self, lat, lon, d):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.d = d
+        self.side = d + EPS
+
+        # Vertices of the bounding box
+        self.lat0, self.lon0 = self.lat.min() - EPS, self.lon.min() - EPS
+        self.maxlat, self.maxlon = self.lat.max() + EPS, self.lon.max() + EPS
+        # Parallels shrink away from the equator: cells are wider along x so
+        # that stations d apart on any parallel are in neighbouring cells.
+        self.xside = self.side * np.cos(np.radians(self.lat0)) / np.cos(
+            np.radians(max(abs(self.lat0), abs(self.maxlat))))
+        self.n = int(np.ceil(haversine(self.lat0, self.lon0,
+                                       self.lat0, self.maxlon) / self.xside))
+        self.m = int(np.ceil(haversine(self.lat0, self.lon0,
+                                       self.maxlat, self.lon0) / self.side))
+
+        self.x, self.y = self.project(self.lat, self.lon)
+        cx = np.floor(self.x / self.xside).astype(np.int64)
+        cy = np.floor(self.y / self.side).astype(np.int64)
+
+        # Sort stations by cell and find where each cell starts
+        key = cx * self.m + cy
+        self.order = np.argsort(key, kind='stable')
+        key = key[self.order]
+        self.cells, self.starts, self.counts = np.unique(
+            key, return_index=True, return_counts=True)
+        self.cx, self.cy = cx[self.order], cy[self.order]
+
+    def updated(self, lat, lon, kept):
+        '''
+        Returns the grid of a newer table of stations (lat, lon). kept maps
+        every station here to its index in the new table, or -1 if it was
+        removed or moved (see graph.Stations.kept). The kept stations keep
+        their projection and their place in the sorted order, and only the
+        other ones are projected and merged into their cells. Returns None
+        if one of them is out of the bounding box: the grid must be built
+        again.
+        '''
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        new = np.ones(len(lat), bool)
+        new[kept[kept >= 0]] = False
+        new = np.flatnonzero(new)
+        if len(new) and (lat[new].min() <= self.lat0 or
+                         lat[new].max() >= self.maxlat or
+                         lon[new].min() <= self.lon0 or
+                         lon[new].max() >= self.maxlon):
+            return None
+
+        grid = Grid.__new__(Grid)
+        grid.__dict__.update(self.__dict__)
+        grid.lat, grid.lon = lat, lon
+        alive = kept >= 0
+        grid.x, grid.y = np.empty(len(lat)), np.empty(len(lat))
+        grid.x[kept[alive]], grid.y[kept[alive]] = self.x[alive], self.y[alive]
+        x, y = self.project(lat[new], lon[new])
+        grid.x[new], grid.y[new] = x, y
+        cx = np.floor(x / self.xside).astype(np.int64)
+        cy = np.floor(y / self.side).astype(np.int64)
+        key = cx * self.m + cy
+        sort = np.argsort(key, kind='stable')
+        new, cx, cy, key = new[sort], cx[sort], cy[sort], key[sort]
+
+        # Kept stations in their sorted order, and the new ones after the
+        # stations of their cell
+        order = kept[self.order]
+        alive = order >= 0
+        old_cx, old_cy = self.cx[alive], self.cy[alive]
+        at = np.searchsorted(old_cx * self.m + old_cy, key, 'right')
+        grid.order = np.insert(order[alive], at, new)
+        grid.cx = np.insert(old_cx, at, cx)
+        grid.cy = np.insert(old_cy, at, cy)
+
+        key = grid.cx * self.m + grid.cy
+        starts = np.flatnonzero(np.concatenate([[True], key[1:] != key[:-1]]))
+        grid.cells, grid.starts = key[starts], starts
+        grid.counts = np.diff(np.append(starts, len(key)))
+        return grid
+
+    def project(self, lat, lon):
+        ''' Returns the plane coordinates (km) of the given points. '''
+        x = haversine(self.lat0, self.lon0, self.lat0, lon)
+        y = haversine(self.lat0, self.lon0, lat, self.lon0)
+        # Points out of the bounding box (queries) can be west or south of it
+        return (np.where(lon < self.lon0, -x, x),
+                np.where(lat < self.lat0, -y, y))
+
+    def cell(self, cx, cy):
+        '''
+        Returns the start (in sorted order) and the number of stations
+        of each given cell. Cells outside the grid are empty.
+        '''
+        cx, cy = np.asarray(cx), np.asarray(cy)
+        inside = (cx >= 0) & (cx < self.n) & (cy >= 0) & (cy < self.m)
+        key = cx * self.m + cy
+        pos = np.minimum(np.searchsorted(self.cells, key), len(self.cells) - 1)
+        found = inside & (self.cells[pos] == key)
+        return (np.where(found, self.starts[pos], 0),
+                np.where(found, self.counts[pos], 0))
+
+    def candidates(self):
+        '''
+        Generates batches of candidate pairs (u, v), as positions in the
+        sorted order: all pairs of stations in the same or neighbouring cells.
+        Every pair is generated once.
+        '''
+        size = len(self.order)
+        first = np.repeat(self.starts, self.counts)   # Start of own cell
+        own = np.repeat(self.counts, self.counts)
+        pos = np.arange(size)
+
+        # Same cell: pair each station with the ones after it
+        yield from self._expand(pos, pos + 1, first + own - pos - 1)
+
+        for dx, dy in NEIGHBOURS:
+            start, count = self.cell(self.cx + dx, self.cy + dy)
+            yield from self._expand(pos, start, count)
+
+    def _expand(self, u, start, count):
+        ''' Pairs each u with count stations from start, in batches. '''
+        count = np.maximum(count, 0)
+        total = np.cumsum(count)
+        lo = 0
+        while lo < len(u):
+            base = total[lo - 1] if lo > 0 else 0
+            hi = max(lo + 1, int(np.searchsorted(total, base + BATCH,
+                                                 side='right')))
+            c = count[lo:hi]
+            shift = np.repeat(np.cumsum(c) - c, c)
+            uu = np.repeat(u[lo:hi], c)
+            vv = np.repeat(start[lo:hi], c) + np.arange(c.sum()) - shift
+            if len(uu):
+                yield uu, vv
+            lo = hi
+
+    def edges(self):
+        '''
+        Returns the arrays (u, v, dist) of all pairs of stations at a
+        distance (km) of at most d. u and v are indices of the input arrays.
+        '''
+        lat, lon = self.lat[self.order], self.lon[self.order]
+        us, vs, ds = [], [], []
+        for u, v in self.candidates():
+            dist = haversine(lat[u], lon[u], lat[v], lon[v])
+            keep = dist <= self.d
+            us.append(u[keep])
+            vs.append(v[keep])
+            ds.append(dist[keep])
+
+        if not us:
+            return (np.empty(0, np.int64), np.empty(0, np.int64),
+                    np.empty(0, np.float64))
+        u, v = self.order[np.concatenate(us)], self.order[np.concatenate(vs)]
+        return u, v, np.concatenate(ds)
+
+
+def geometric_edges(lat, lon, d):
+    '''
+    Returns the edges (u, v, dist) of the geometric graph with distance d (km)
+    over the stations with coordinates lat, lon.
+    '''
+    if len(lat) == 0:
+        return (np.empty(0, np.int64), np.empty(0, np.int64),
+                np.empty(0, np.float64))
+    return Grid(lat, lon, d).edges()
+
+
+def updated_edges(edges, kept, grid):
+    '''
+    Returns the edges (u, v, dist) of the geometric graph over the stations
+    of grid, from the edges of older stations. kept maps every old station
+    to its index among the new ones, or -1 if it was removed or moved.
+    The edges between kept stations are kept, and only the pairs of the
+    other (added or moved) stations are measured, found in the cells around
+    them as Grid.edges finds them, so the result is the same.
+    '''
+    u, v, dist = edges
+    nu, nv = kept[u], kept[v]
+    keep = (nu >= 0) & (nv >= 0)
+    unchanged = np.zeros(len(grid.order), bool)
+    unchanged[kept[kept >= 0]] = True
+    unchanged = unchanged[grid.order]   # In sorted order, as the cells
+    pos = np.flatnonzero(~unchanged)
+    lat, lon = grid.lat[grid.order], grid.lon[grid.order]
+
+    us, vs, ds = [nu[keep]], [nv[keep]], [dist[keep]]
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            start, count = grid.cell(grid.cx[pos] + dx, grid.cy[pos] + dy)
+            for a, b in grid._expand(pos, start, count):
+                # Pairs of two changed stations are found from the first
+                once = unchanged[b] | (a < b)
+                a, b = a[once], b[once]
+                dist = haversine(lat[a], lon[a], lat[b], lon[b])
+                near = dist <= grid.d
+                us.append(grid.order[a[near]])
+                vs.append(grid.order[b[near]])
+                ds.append(dist[near])
+    return tuple(np.concatenate(x) for x in (us, vs, ds))
+
+
+class SpatialIndex:
+    '''
+    Index of stations over a grid of cells of side d + EPS (km). The stations
+    around a point are visited in rings of cells of growing distance, so
+    the closest ones are found without measuring the distance to all of them.
+    With few stations (SCAN), measuring all of them is faster. The grid
+    can be given (updated from the one of an older table).
+    '''
+    def __init__(self, lat, lon, d=1.0, grid=None):
+        self.grid = Grid(lat, lon, d) if grid is None else grid
+        self.lat = self.grid.lat[self.grid.order]
+        self.lon = self.grid.lon[self.grid.order]
+        # A ring of cells can be closer than its projected distance: the
+        # parallels shrink to the north of the one used to project.
+        self.shrink = (np.cos(np.radians(self.grid.lat.max() + EPS)) /
+                       np.cos(np.radians(self.grid.lat0))) * SLACK
+
+    def rings(self, lat, lon):
+        '''
+        Generates (bound, idx, dist) for the rings of cells around (lat, lon),
+        from the closest outwards: the indices of the stations in the ring,
+        their distances (km), and a lower bound of the distance to any
+        station in this ring or further.
+        '''
+        grid = self.grid
+        x, y = grid.project(lat, lon)
+        cx, cy = int(np.floor(x / grid.xside)), int(np.floor(y / grid.side))
+        first = max(-cx, cx - grid.n + 1, -cy, cy - grid.m + 1, 0)
+        last = max(cx, grid.n - 1 - cx, cy, grid.m - 1 - cy, 0)
+
+        for k in range(first, last + 1):
+            if k == 0:
+                dx, dy = np.zeros(1, np.int64), np.zeros(1, np.int64)
+            else:
+                side = np.arange(-k, k + 1)
+                inner = side[1:-1]
+                dx = np.concatenate([side, side, np.full(len(inner), -k),
+                                     np.full(len(inner), k)])
+                dy = np.concatenate([np.full(len(side), -k),
+                                     np.full(len(side), k), inner, inner])
+            start, count = grid.cell(cx + dx, cy + dy)
+            pos = np.repeat(start, count) + np.arange(count.sum()) - \
+                np.repeat(np.cumsum(count) - count, count)
+            bound = max(0.0, (k - 1) * grid.side * self.shrink)
+            yield (bound, grid.order[pos],
+                   haversine(lat, lon, self.lat[pos], self.lon[pos]))
+
+    def nearest(self, lat, lon, k=1):
+        '''
+        Returns the indices of the k stations closest to (lat, lon) and
+        their distances (km), from the closest.
+        '''
+        if len(self.lat) <= SCAN:
+            dist = haversine(lat, lon, self.grid.lat, self.grid.lon)
+            idx = np.argpartition(dist, k - 1)[:k] if k < len(dist) else \
+                np.arange(len(dist))
+            idx = idx[np.argsort(dist[idx], kind='stable')]
+            return idx, dist[idx]
+
+        idx, dist = np.empty(0, np.int64), np.empty(0)
+        for bound, i, d in self.rings(lat, lon):
+            if len(dist) >= k and dist[k - 1] <= bound:
+                break   # No station further out can be closer
+            idx, dist = np.concatenate([idx, i]), np.concatenate([dist, d])
+            order = np.argsort(dist, kind='stable')[:k]
+            idx, dist = idx[order], dist[order]
+        return idx, dist
+
+    def within(self, lat, lon, radius):
+        '''
+        Returns the indices of the stations at most radius (km) away from
+        (lat, lon) and their distances, from the closest.
+        '''
+        if len(self.lat) <= SCAN:
+            dist = haversine(lat, lon, self.grid.lat, self.grid.lon)
+            idx = np.flatnonzero(dist <= radius)
+            idx = idx[np.argsort(dist[idx], kind='stable')]
+            return idx, dist[idx]
+
+        idxs, dists = [np.empty(0, np.int64)], [np.empty(0)]
+        for bound, i, d in self.rings(lat, lon):
+            if bound > radius:
+                break
+            keep = d <= radius
+            idxs.append(i[keep])
+            dists.append(d[keep])
+        idx, dist = np.concatenate(idxs), np.concatenate(dists)
+        order = np.argsort(dist, kind='stable')
+        return idx[order], dist[order]
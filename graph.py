@@ -0,0 +1,428 @@
+'''© fergascod & asleix'''
+
+import heapq
+
+import numpy as np
+from haversine import haversine
+
+import geometry
+
+
+# Speeds (km/h) of the bike and walking edges. Weights are hours.
+BIKE_SPEED, WALK_SPEED = 10, 4
+
+# The heuristic of A* is slightly underestimated: float32 weights can be
+# a bit smaller than the haversine distance of their edges.
+HEURISTIC = (1 - 1e-6) / BIKE_SPEED
+
+
+class Node:
+    ''' Light view of a station (or an address) in the geometric graph. '''
+    __slots__ = ('lat', 'lon', 'id')
+
+    def __init__(self, lat_, lon_, station_id=None):
+        ''' Defines latitude and longitude for the node. '''
+        self.lat = lat_
+        self.lon = lon_
+        self.id = station_id
+
+    def coords(self):
+        ''' Returns a tuple of the coordinates. Reversed order than init. '''
+        return (self.lon, self.lat)
+
+    def distance_to(self, next):
+        ''' Calculates distance (km) in the sphere using haversine.
+            Returns a float, the distance between self and next in km. '''
+        c1 = (self.lat, self.lon)
+        c2 = (next.lat, next.lon)
+        return haversine(c1, c2)
+
+
+def readonly(*arrays):
+    ''' Marks the given arrays as read-only. '''
+    for a in arrays:
+        a.flags.writeable = False
+
+
+class Stations:
+    '''
+    Table of stations kept in parallel arrays: station ids, latitudes
+    and longitudes. Station i is the i-th entry of every array.
+    '''
+    def __init__(self, ids, lat, lon):
+        self.ids = np.asarray(ids)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        readonly(self.ids, self.lat, self.lon)
+        self.index = {id: i for i, id in enumerate(self.ids.tolist())}
+        self._spatial = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def node(self, i):
+        ''' Returns a Node view of station i. '''
+        return Node(float(self.lat[i]), float(self.lon[i]),
+                    self.ids[i:i + 1].tolist()[0])
+
+    def nodes(self):
+        ''' Returns a Node view of every station. '''
+        return [Node(lat, lon, id) for lat, lon, id in
+                zip(self.lat.tolist(), self.lon.tolist(), self.ids.tolist())]
+
+    def __getstate__(self):
+        # The spatial index is rebuilt where needed instead of being copied
+        state = self.__dict__.copy()
+        state['_spatial'] = None
+        return state
+
+    def spatial(self):
+        ''' Returns the spatial index of the stations, built on first use. '''
+        if self._spatial is None:
+            self._spatial = geometry.SpatialIndex(self.lat, self.lon)
+        return self._spatial
+
+    def spatial_from(self, old, kept):
+        '''
+        Returns the spatial index of the stations, updated from the one of
+        an older table (see kept) instead of built, if it can be.
+        '''
+        grid = old.spatial().grid.updated(self.lat, self.lon, kept)
+        self._spatial = geometry.SpatialIndex(self.lat, self.lon, grid=grid)
+        return self._spatial
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.lat.nbytes + self.lon.nbytes
+
+    def kept(self, old):
+        '''
+        Compares the stations with an older table by station id. Returns the
+        index here of every old station, -1 if it was removed or moved.
+        '''
+        kept = np.full(len(old), -1, np.int64)
+        if not len(old) or not len(self) or old.ids.dtype.kind != \
+                self.ids.dtype.kind:
+            return kept
+        if (old.ids[1:] > old.ids[:-1]).all():
+            idx = np.searchsorted(old.ids, self.ids)   # Ids already sorted
+        else:
+            order = np.argsort(old.ids)
+            idx = order[np.searchsorted(old.ids[order], self.ids)
+                        .clip(max=len(old) - 1)]
+        idx = idx.clip(max=len(old) - 1)
+        same = old.ids[idx] == self.ids
+        same[same] = ((old.lat[idx[same]] == self.lat[same]) &
+                      (old.lon[idx[same]] == self.lon[same]))
+        kept[idx[same]] = np.flatnonzero(same)
+        return kept
+
+
+class Connectivity:
+    '''
+    Number of connected components of the geometric graphs of a station
+    table at every distance. Edges are added from the shortest (Kruskal)
+    joining components with union-find, and the distance of every edge
+    that joins two of them is kept: the graph with distance d has as many
+    components as stations minus joins of at most d. The joins can be
+    given if they are already known (restored from disk).
+    '''
+    def __init__(self, n, u, v, dist, joins=None):
+        self.n = n
+        self.edges = (u, v, dist)
+        self._joins = joins
+
+    def joins(self):
+        ''' Returns the sorted distances (km) that join components. '''
+        if self._joins is None:
+            u, v, dist = self.edges
+            order = np.argsort(dist, kind='stable')
+            parent = list(range(self.n))
+            joins = []
+            for a, b, d in zip(u[order].tolist(), v[order].tolist(),
+                               dist[order].tolist()):
+                while parent[a] != a:
+                    parent[a] = a = parent[parent[a]]
+                while parent[b] != b:
+                    parent[b] = b = parent[parent[b]]
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+                    joins.append(d)
+            self._joins = np.array(joins, dtype=np.float64)
+        return self._joins
+
+    def components(self, distance):
+        ''' Number of components of the graph with distance (m). '''
+        return self.n - int(np.searchsorted(self.joins(), distance / 1000,
+                                            side='right'))
+
+    def curve(self):
+        '''
+        Returns the distances (m) where the number of components changes
+        and the number of components from each of them on, starting at 0 m.
+        '''
+        joins = self.joins()
+        distances, joined = np.unique(joins, return_counts=True)
+        counts = self.n - np.cumsum(joined)
+        if len(distances) and distances[0] == 0:
+            return 1000 * distances, counts
+        return (np.concatenate([[0.0], 1000 * distances]),
+                np.concatenate([[self.n], counts]))
+
+
+class Graph:
+    '''
+    Immutable undirected weighted graph over a station table, in CSR form:
+    the neighbours of station i are indices[offsets[i]:offsets[i+1]], with
+    the weights in the same positions of weights. Every edge is stored in
+    both directions. Graphs of a station snapshot know its version, their
+    distance (m) and the Connectivity of the snapshot.
+    '''
+    def __init__(self, stations, u, v, weight, version=None, distance=None,
+                 connectivity=None):
+        n = len(stations)
+        src = np.concatenate([u, v])
+        dst = np.concatenate([v, u])
+        order = np.lexsort((dst, src))
+
+        self.stations = stations
+        self.version, self.distance = version, distance
+        self.connectivity = connectivity
+        self.offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self.offsets[1:])
+        self.indices = dst[order].astype(np.int32)
+        self.weights = np.concatenate([weight, weight])[order].astype(np.float32)
+        readonly(self.offsets, self.indices, self.weights)
+
+    @classmethod
+    def from_csr(cls, stations, offsets, indices, weights, version=None,
+                 distance=None, connectivity=None):
+        ''' Graph with the given CSR arrays, which are used as they are
+            (they can be read-only maps of a file). '''
+        G = cls.__new__(cls)
+        G.stations = stations
+        G.version, G.distance = version, distance
+        G.connectivity = connectivity
+        G.offsets, G.indices, G.weights = offsets, indices, weights
+        readonly(G.offsets, G.indices, G.weights)
+        return G
+
+    def updated(self, stations, kept, u, v, weight, version=None,
+                connectivity=None):
+        '''
+        Returns the graph with the same distance over a newer table of
+        stations. kept maps every station here to its index in the new
+        table, or -1 (see Stations.kept), and must keep their order.
+        (u, v, weight) are the edges of the new table with an added or
+        moved station. The rows of the kept stations are remapped and the
+        new edges merged into them, so the edges are not sorted again.
+        '''
+        n = len(stations)
+        src = kept[np.repeat(np.arange(len(self.stations)), self.degrees())]
+        dst = kept[self.indices]
+        keep = (src >= 0) & (dst >= 0)
+        src, dst, weights = src[keep], dst[keep], self.weights[keep]
+
+        new_src, new_dst = np.concatenate([u, v]), np.concatenate([v, u])
+        order = np.lexsort((new_dst, new_src))
+        new_src, new_dst = new_src[order], new_dst[order]
+        at = np.searchsorted(src * n + dst, new_src * n + new_dst)
+
+        G = Graph.__new__(Graph)
+        G.stations = stations
+        G.version, G.distance = version, self.distance
+        G.connectivity = connectivity
+        G.offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n) +
+                  np.bincount(new_src, minlength=n), out=G.offsets[1:])
+        G.indices = np.insert(dst.astype(np.int32), at, new_dst)
+        G.weights = np.insert(weights, at, np.concatenate(
+            [weight, weight])[order].astype(np.float32))
+        readonly(G.offsets, G.indices, G.weights)
+        return G
+
+    def number_of_nodes(self):
+        return len(self.stations)
+
+    def number_of_edges(self):
+        return len(self.indices) // 2
+
+    def neighbours(self, i):
+        ''' Returns the arrays of neighbours of station i and their weights. '''
+        a, b = self.offsets[i], self.offsets[i + 1]
+        return self.indices[a:b], self.weights[a:b]
+
+    def degrees(self):
+        return np.diff(self.offsets)
+
+    def edges(self):
+        ''' Returns the arrays (u, v, weight) of the edges, with u < v. '''
+        src = np.repeat(np.arange(len(self.stations), dtype=np.int32),
+                        self.degrees())
+        once = src < self.indices
+        return src[once], self.indices[once], self.weights[once]
+
+    def components(self):
+        '''
+        Returns the component label of every station: the smallest station
+        index of its component. Components are merged by hooking the larger
+        label to the smaller one of every edge and jumping pointers.
+        '''
+        label = np.arange(len(self.stations))
+        u, v, w = self.edges()
+        while True:
+            lu, lv = label[u], label[v]
+            diff = lu != lv
+            if not diff.any():
+                return label
+            np.minimum.at(label, np.maximum(lu, lv)[diff],
+                          np.minimum(lu, lv)[diff])
+            while True:
+                jump = label[label]
+                if (jump == label).all():
+                    break
+                label = jump
+
+    def number_of_components(self):
+        if self.connectivity is not None and self.distance is not None:
+            return self.connectivity.components(self.distance)
+        return len(np.unique(self.components()))
+
+    def __getstate__(self):
+        # Processes that get a graph do not need the edges of the snapshot
+        state = self.__dict__.copy()
+        state['connectivity'] = None
+        return state
+
+    @property
+    def nbytes(self):
+        ''' Memory of the adjacency (the station table is shared). '''
+        return self.offsets.nbytes + self.indices.nbytes + self.weights.nbytes
+
+    def summary(self):
+        ''' Returns a description of the graph. '''
+        n, m = self.number_of_nodes(), self.number_of_edges()
+        return ('Type: Graph\nNumber of nodes: %d\nNumber of edges: %d\n'
+                'Average degree: %8.4f' % (n, m, 2 * m / n if n else 0))
+
+    def route(self, origin, destination):
+        '''
+        Fastest route between two coordinates (lat, lon). Both are connected
+        walking to every station and to each other, the stations are
+        connected by bike through the edges of the graph.
+        A* search with the haversine distance at bike speed as heuristic.
+        The walking edges from the origin are added lazily, closest stations
+        first, and only while they can improve on the best path found.
+        Returns the list of stations in the path (empty if walking directly).
+        '''
+        st = self.stations
+        # Distances (km) from every station to the destination
+        left = geometry.haversine(st.lat, st.lon, *destination).tolist()
+        total = geometry.haversine(*origin, *destination)
+        best, last = total / WALK_SPEED, -1   # Walking directly
+        rings = st.spatial().rings(*origin)
+        bound = 0.0   # Lower bound of the distance of the next ring
+
+        g, pred, heap = {}, {}, []
+
+        def push(idx, cost, prev):
+            ''' Pushes the stations idx reached with the given costs. '''
+            for i, c in zip(idx, cost):
+                if c < g.get(i, float('inf')):
+                    g[i], pred[i] = c, prev
+                    heapq.heappush(heap, (c + left[i] * HEURISTIC, c, i))
+
+        while True:
+            # Add walking edges while they could be better than the heap top
+            top = min(heap[0][0] if heap else best, best)
+            while rings is not None and (bound / WALK_SPEED + max(0, total -
+                                         bound) * HEURISTIC) < top:
+                ring = next(rings, None)
+                if ring is None:
+                    rings = None
+                    break
+                bound, idx, dist = ring
+                push(idx.tolist(), (dist / WALK_SPEED).tolist(), -1)
+                top = min(heap[0][0] if heap else best, best)
+
+            if not heap or heap[0][0] >= best:
+                break
+            f, c, i = heapq.heappop(heap)
+            if c > g[i]:
+                continue   # Already reached with a lower cost
+
+            if c + left[i] / WALK_SPEED < best:   # Walking to the destination
+                best, last = c + left[i] / WALK_SPEED, i
+            a, b = self.offsets[i], self.offsets[i + 1]
+            push(self.indices[a:b].tolist(),
+                 [c + w for w in self.weights[a:b].tolist()], i)
+
+        path = []
+        while last != -1:
+            path.append(last)
+            last = pred[last]
+        return path[::-1]
+
+    def distances(self, sources, limit=np.inf):
+        '''
+        Shortest bike distances (km) from every station of sources to every
+        station, as a float32 array (len(sources), n), inf if farther than
+        limit (km) or unreachable. Dijkstra with scipy.sparse.csgraph if
+        SciPy is installed, or else with a heap in Python.
+        '''
+        n = len(self.stations)
+        km = self.weights.astype(np.float64) * BIKE_SPEED
+        try:
+            from scipy.sparse import csr_matrix
+            from scipy.sparse.csgraph import dijkstra
+        except ImportError:
+            result = np.full((len(sources), n), np.inf, np.float32)
+            offsets, indices = self.offsets.tolist(), self.indices.tolist()
+            km = km.tolist()
+            for row, source in zip(result, sources):
+                dist, heap = {source: 0.0}, [(0.0, source)]
+                while heap:
+                    d, i = heapq.heappop(heap)
+                    if d > dist[i]:
+                        continue
+                    row[i] = d
+                    for e in range(offsets[i], offsets[i + 1]):
+                        j, c = indices[e], d + km[e]
+                        if c <= limit and c < dist.get(j, np.inf):
+                            dist[j] = c
+                            heapq.heappush(heap, (c, j))
+            return result
+
+        # Explicit zeros of csr_matrix are edges (stations at the same place)
+        matrix = csr_matrix((km, self.indices, self.offsets), shape=(n, n))
+        return dijkstra(matrix, indices=np.asarray(sources),
+                        limit=limit).astype(np.float32)
+
+
+class DistanceOracle:
+    '''
+    Shortest bike distances (km) between every pair of stations of a graph,
+    kept in a float32 matrix: row i has the distances from station i (inf
+    if unreachable). Built once per graph, so every query is a lookup.
+    The matrix takes 4 n^2 bytes.
+    '''
+    def __init__(self, G):
+        self.version, self.distance = G.version, G.distance
+        self.matrix = G.distances(np.arange(len(G.stations)))
+        readonly(self.matrix)
+
+    def query(self, i, j):
+        ''' Returns the shortest bike distance (km) from station i to j. '''
+        return float(self.matrix[i, j])
+
+    def within(self, i, km):
+        ''' Returns the stations at most km away from station i by bike,
+            and their distances, from the closest. '''
+        row = self.matrix[i]
+        idx = np.flatnonzero(row <= km)
+        idx = idx[np.argsort(row[idx], kind='stable')]
+        return idx, row[idx]
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes
@@ -0,0 +1,225 @@
+'''© fergascod & asleix'''
+
+import bisect
+import contextlib
+import cProfile
+import http.server
+import logging
+import os
+import threading
+import time
+
+
+# Local port of the Prometheus exposition (/metrics). Metrics are only
+# collected when it is set.
+METRICS_PORT = int(os.environ.get('BICING_METRICS_PORT', 0))
+ENABLED = METRICS_PORT > 0
+
+# Directory where a cProfile dump of every request is written, if set.
+PROFILE_DIR = os.environ.get('BICING_PROFILE_DIR')
+
+# Upper bounds (s) of the buckets of the latency histograms.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+           2.5, 5, 10, 30)
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+class Counter:
+    ''' Prometheus counter with labels. '''
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield '%s{%s} %g' % (self.name, _labels(self.labels, labels), value)
+
+
+class Histogram:
+    ''' Prometheus histogram with labels. '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = buckets
+        self.values = {}   # labels -> [count of every bucket, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, ([*counts], total, count))
+                            for labels, (counts, total, count)
+                            in self.values.items())
+        for labels, (counts, total, count) in values:
+            names = self.labels + ('le',)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '%s_bucket{%s} %d' % (
+                    self.name, _labels(names, labels + ('%g' % bound,)),
+                    cumulative)
+            yield '%s_bucket{%s} %d' % (self.name,
+                                        _labels(names, labels + ('+Inf',)), count)
+            yield '%s_sum{%s} %g' % (self.name, _labels(self.labels, labels), total)
+            yield '%s_count{%s} %d' % (self.name, _labels(self.labels, labels),
+                                       count)
+
+
+requests = Histogram('bicing_request_seconds',
+                     'Latency of the requests by command.', ('command',))
+outcomes = Counter('bicing_requests_total',
+                   'Requests by command and outcome.', ('command', 'outcome'))
+phases = Histogram('bicing_phase_seconds',
+                   'Time spent in every phase of the requests.', ('phase',))
+caches = Counter('bicing_cache_requests_total',
+                 'Cache lookups by cache and result (hit or miss).',
+                 ('cache', 'result'))
+METRICS = [requests, outcomes, phases, caches]
+
+_null = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def _timed(histogram, *labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, *labels)
+
+
+def phase(name):
+    '''
+    Context manager that times a phase of a request: fetch, parse, graph,
+    geocode, route, oracle, history, solve, render or send (and save, of
+    the state).
+    '''
+    if not ENABLED:
+        return _null
+    return _timed(phases, name)
+
+
+def hit(cache):
+    ''' Counts a hit of cache. '''
+    if ENABLED:
+        caches.inc(cache, 'hit')
+
+
+def miss(cache):
+    ''' Counts a miss of cache. '''
+    if ENABLED:
+        caches.inc(cache, 'miss')
+
+
+@contextlib.contextmanager
+def request(command):
+    '''
+    Context manager around a request: times it, counts its outcome (ok or
+    error) and, with PROFILE_DIR, writes its cProfile dump.
+    '''
+    profile = None
+    if PROFILE_DIR:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:   # Another profiler is running in this thread
+            profile = None
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        elapsed = time.perf_counter() - start
+        if ENABLED:
+            requests.observe(elapsed, command)
+            outcomes.inc(command, outcome)
+        if profile is not None:
+            profile.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile.dump_stats(os.path.join(PROFILE_DIR, '%s-%d-%d.prof' % (
+                command, time.time() * 1000, threading.get_ident())))
+
+
+class TimedBot:
+    ''' Wraps a telegram.Bot so that its send_* calls are timed as 'send'. '''
+    def __init__(self, bot):
+        self._bot = bot
+
+    def __getattr__(self, name):
+        attr = getattr(self._bot, name)
+        if not name.startswith('send_'):
+            return attr
+
+        def send(*args, **kwargs):
+            with phase('send'):
+                return attr(*args, **kwargs)
+        return send
+
+
+def timed_bot(bot):
+    ''' Returns bot, timing its messages when metrics are enabled. '''
+    if not ENABLED or isinstance(bot, TimedBot):
+        return bot
+    return TimedBot(bot)
+
+
+def exposition():
+    ''' Returns all the metrics in the Prometheus text format. '''
+    lines = []
+    for metric in METRICS:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=None):
+    ''' Serves /metrics on localhost from a daemon thread. Returns the server. '''
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', METRICS_PORT if port is None else port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    logging.info('Metrics on http://127.0.0.1:%d/metrics',
+                 server.server_address[1])
+    return server
@@ -0,0 +1,59 @@
+'''© fergascod & asleix'''
+
+import os
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+def save(path, arrays):
+    '''
+    Saves the dict of arrays to path as an uncompressed .npz file. It is
+    written to a temporary file that replaces path at the end, so readers
+    never see a partial file (and old maps of path stay valid).
+    '''
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load(path):
+    '''
+    Returns the arrays of an .npz file written by save, memory-mapped
+    read-only: nothing is read until it is used. np.load cannot map the
+    members of an .npz, but they are plain .npy files stored uncompressed,
+    so each one is mapped from its offset in the file.
+    '''
+    arrays = {}
+    with open(path, 'rb') as file, zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Compressed member ' + info.filename)
+            # Local header: 30 bytes, then the name and the extra field
+            file.seek(info.header_offset)
+            name, extra = struct.unpack('<HH', file.read(30)[26:30])
+            file.seek(info.header_offset + 30 + name + extra)
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(file)
+            if dtype.hasobject:
+                raise ValueError('Object member ' + info.filename)
+            key = info.filename[:-len('.npy')]
+            if 0 in shape:   # mmap cannot map empty arrays
+                arrays[key] = np.empty(shape, dtype)
+                arrays[key].flags.writeable = False
+            else:
+                arrays[key] = np.memmap(file, dtype, 'r', file.tell(), shape,
+                                        'F' if fortran else 'C')
+    return arrays
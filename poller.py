@@ -0,0 +1,232 @@
+'''© fergascod & asleix'''
+
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+import gbfs
+from graph import readonly
+import metrics
+
+
+# Seconds between polls of station_status when the feed has no ttl, and
+# the minimum and maximum (after errors) seconds between polls.
+STATUS_INTERVAL = float(os.environ.get('BICING_STATUS_INTERVAL', 30))
+STATUS_MIN_INTERVAL = float(os.environ.get('BICING_STATUS_MIN_INTERVAL', 5))
+STATUS_MAX_INTERVAL = 300
+
+# Intervals without a successful poll after which the status is stale: it
+# is polled by the request, and reported as stale if that fails too.
+STATUS_STALE = float(os.environ.get('BICING_STATUS_STALE', 3))
+
+# last_updated is read from the start of the feed, before parsing it.
+LAST_UPDATED = re.compile(rb'"last_updated"\s*:\s*(\d+)')
+
+
+def fetch(url, timeout=30):
+    ''' Returns the content of url, an http(s) url or a local path. '''
+    if not url.startswith(('http://', 'https://')):
+        with open(url, 'rb') as file:
+            return file.read()
+    import requests   # Slow to import, not needed before the first poll
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def last_updated(content):
+    ''' Returns the last_updated field of a GBFS feed, or None. '''
+    match = LAST_UPDATED.search(content, 0, 512) or LAST_UPDATED.search(content)
+    return int(match.group(1)) if match else None
+
+
+class StationStatus:
+    '''
+    Immutable status of the stations, published by StatusPoller.
+    bikes and docks are aligned to stations (-1 for stations missing from
+    the feed), and changed holds the indices of the stations whose status
+    differs from the previous one (all of them if the stations changed).
+    '''
+    def __init__(self, version, stations, last_updated, ttl, bikes, docks,
+                 changed):
+        self.version = version
+        self.stations = stations
+        self.last_updated = last_updated
+        self.ttl = ttl
+        self.bikes, self.docks, self.changed = bikes, docks, changed
+        readonly(bikes, docks, changed)
+        self.created = time.monotonic()
+
+    def age(self):
+        ''' Seconds since the status was published. '''
+        return time.monotonic() - self.created
+
+    def aligned(self, stations):
+        '''
+        Returns the bikes and docks of stations, which can belong to an
+        older snapshot than the status.
+        '''
+        if stations is self.stations:
+            return self.bikes, self.docks
+        idx = np.array([self.stations.index.get(i, -1)
+                        for i in stations.ids.tolist()], np.int64)
+        known = idx >= 0
+        return (np.where(known, self.bikes[idx], -1),
+                np.where(known, self.docks[idx], -1))
+
+
+class StatusPoller:
+    '''
+    Keeps the latest station_status, aligned to the stations returned by
+    stations() (the cached snapshot). A background thread polls the feed
+    every ttl seconds (as given by the feed) and only parses it when its
+    last_updated has changed. Readers take the published status without
+    waiting for the network, unless the last successful poll is too old
+    (STATUS_STALE): then they poll the feed themselves, at most once per
+    interval. Every new status is passed to record, if set.
+    '''
+    def __init__(self, url, stations, record=None):
+        self.url = url
+        self.stations = stations
+        self.record = record
+        self.version = 0
+        self.polls = self.parses = 0
+        self._status = None
+        self._last_updated = None
+        self._checked = None       # Time of the last successful poll
+        self._retry_after = 0      # Time of the next poll by a request
+        self._polling = threading.RLock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def parse(self, content, stations):
+        ''' Returns the last_updated, ttl, bikes and docks of a feed. '''
+        updated, ttl, ids, b, d = gbfs.status(content)
+        n = len(stations.ids)
+        bikes, docks = np.full(n, -1, np.int64), np.full(n, -1, np.int64)
+        index = stations.index
+        idx = np.fromiter((index.get(i, -1) for i in ids.tolist()), np.int64,
+                          len(ids))
+        known = idx >= 0
+        bikes[idx[known]] = b[known]
+        docks[idx[known]] = d[known]
+        return updated, ttl, bikes, docks
+
+    def poll(self):
+        '''
+        Downloads the feed and publishes its status if it has changed.
+        Returns the published status.
+        '''
+        with self._polling:
+            stations = self.stations()
+            with metrics.phase('fetch'):
+                content = fetch(self.url() if callable(self.url) else self.url)
+            self.polls += 1
+            self._checked = time.monotonic()
+            old = self._status
+            updated = last_updated(content)
+            if (old is not None and old.stations is stations and
+                    updated is not None and updated == self._last_updated):
+                metrics.hit('status')
+                return old   # Same data, not parsed
+
+            metrics.miss('status')
+            with metrics.phase('parse'):
+                updated, ttl, bikes, docks = self.parse(content, stations)
+            self.parses += 1
+            if old is None or old.stations is not stations:
+                changed = np.arange(len(bikes))
+            else:
+                changed = np.flatnonzero((bikes != old.bikes) |
+                                         (docks != old.docks))
+            self.version += 1
+            self._last_updated = updated
+            self._status = StationStatus(self.version, stations, updated, ttl,
+                                         bikes, docks, changed)
+            if self.record is not None:
+                try:
+                    self.record(self._status)
+                except Exception:
+                    logging.exception('Could not record the status')
+            return self._status
+
+    def get(self):
+        '''
+        Returns the latest status. Only downloads it when nothing has been
+        published yet, or when the poller is not running and the status
+        has expired.
+        '''
+        status = self._status
+        if self.fresh(status):
+            return status
+        with self._polling:
+            status = self._status
+            if self.fresh(status):   # Polled while we were waiting
+                return status
+            try:
+                return self.poll()
+            except Exception:
+                if status is None:
+                    raise
+                logging.exception('Could not poll station_status, serving '
+                                  'the status of %.0f s ago', self.age())
+                self._retry_after = time.monotonic() + self.interval(status)
+                return status
+
+    def age(self):
+        ''' Seconds since the last successful poll, or None. '''
+        if self._checked is None:
+            return None
+        return time.monotonic() - self._checked
+
+    def fresh(self, status):
+        ''' Tells whether status can be served without polling. '''
+        if status is None:
+            return False
+        if time.monotonic() < self._retry_after:
+            return True   # A poll failed just now
+        limit = self.interval(status)
+        return self.age() < (STATUS_STALE * limit if self.running() else limit)
+
+    def stale(self):
+        ''' Tells whether the status has not been polled for too long. '''
+        status, age = self._status, self.age()
+        return (status is not None and age is not None and
+                age >= STATUS_STALE * self.interval(status))
+
+    def interval(self, status):
+        ''' Seconds until the feed is expected to change. '''
+        ttl = STATUS_INTERVAL if status is None or not status.ttl else status.ttl
+        return max(STATUS_MIN_INTERVAL, ttl)
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        ''' Starts polling in a background thread. '''
+        if self.running():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='status-poller',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        wait = None
+        while not self._stop.is_set():
+            try:
+                wait = self.interval(self.poll())
+            except Exception:
+                logging.exception('Could not poll station_status')
+                wait = min(STATUS_MAX_INTERVAL, 2 * (wait or STATUS_MIN_INTERVAL))
+            self._stop.wait(wait)
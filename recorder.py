@@ -0,0 +1,261 @@
+'''© fergascod & asleix'''
+
+from bisect import bisect_right
+from collections import OrderedDict
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+
+# Records of a chunk, and seconds of status after which the open chunk is
+# written even if it is not full.
+CHUNK_RECORDS = int(os.environ.get('BICING_HISTORY_CHUNK_RECORDS', 1 << 16))
+CHUNK_SECONDS = int(os.environ.get('BICING_HISTORY_CHUNK_SECONDS', 3600))
+
+# Memory (bytes) for the decompressed chunks kept for the queries.
+CHUNK_CACHE_BYTES = int(os.environ.get('BICING_HISTORY_CACHE_BYTES', 32 << 20))
+
+# Header of every chunk: magic, first and last time, number of records,
+# bytes of the compressed records and their crc32.
+HEADER = struct.Struct('<4sqqIII')
+MAGIC = b'BCH1'
+
+# Columns of the records, stored one after the other in every chunk.
+COLUMNS = (np.int32, np.int64, np.int16, np.int16)   # station, time, bikes, docks
+RECORD_BYTES = sum(np.dtype(t).itemsize for t in COLUMNS)
+
+
+class HistoryFile:
+    '''
+    Append-only history of the status of the stations. Every status adds a
+    record (station, time, bikes, docks) for each station whose bikes or
+    docks changed since the previous status. Records are gathered in
+    chunks, compressed with zlib and appended to path after a header with
+    their time range. Every chunk starts with the status of all the
+    stations, so it can be read alone, and its records are sorted by
+    station and time. The file is memory-mapped to read the chunks.
+    Station ids are kept in path + '.ids' (one JSON value per line) and
+    records refer to them by their line.
+    '''
+    def __init__(self, path, chunk_records=None, chunk_seconds=None):
+        self.path = path
+        self.chunk_records = chunk_records or CHUNK_RECORDS
+        self.chunk_seconds = chunk_seconds or CHUNK_SECONDS
+        self._lock = threading.RLock()
+        self._ids, self._codes = [], {}      # code -> id, id -> code
+        self._chunks = []                    # (first, last, offset, size, count)
+        self._firsts = []                    # First time of every chunk
+        self._cache = OrderedDict()          # Chunk -> decompressed columns
+        self._cached = 0                     # Bytes of the cache
+        self._map = None
+        self._stations = (None, None)        # Last station table and its codes
+        self._bikes = self._docks = np.empty(0, np.int64)   # Last status by code
+        self._open, self._count = [], 0      # Records of the open chunk
+        self._last = (None, None)            # Stations and version appended
+        self.load()
+
+    def load(self):
+        ''' Reads the station ids and the headers of the chunks. A chunk cut
+            short (the bot stopped while writing it) is removed. '''
+        if os.path.exists(self.path + '.ids'):
+            with open(self.path + '.ids') as file:
+                self._ids = [json.loads(line) for line in file if line.strip()]
+            self._codes = {id: code for code, id in enumerate(self._ids)}
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb+') as file:
+            end = file.seek(0, os.SEEK_END)
+            offset = 0
+            while offset + HEADER.size <= end:
+                file.seek(offset)
+                magic, first, last, count, size, crc = HEADER.unpack(
+                    file.read(HEADER.size))
+                if (magic != MAGIC or offset + HEADER.size + size > end or
+                        zlib.crc32(file.read(size)) != crc):
+                    break
+                self._chunks.append((first, last, offset + HEADER.size, size,
+                                     count))
+                self._firsts.append(first)
+                offset += HEADER.size + size
+            if offset < end:
+                logging.warning('Truncating %s from %d to %d bytes',
+                                self.path, end, offset)
+                file.truncate(offset)
+
+    def codes(self, stations):
+        ''' Returns the codes of a station table, adding its new ids. '''
+        cached, codes = self._stations
+        if cached is stations:
+            return codes
+        with self._lock:
+            ids = stations.ids.tolist()
+            new = [id for id in dict.fromkeys(ids) if id not in self._codes]
+            if new:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.path + '.ids', 'a') as file:
+                    file.write(''.join(json.dumps(id) + '\n' for id in new))
+                for id in new:
+                    self._codes[id] = len(self._ids)
+                    self._ids.append(id)
+            codes = np.fromiter((self._codes[id] for id in ids), np.int32,
+                                len(ids))
+            self._stations = (stations, codes)
+            return codes
+
+    def append(self, status):
+        '''
+        Records the stations of a StationStatus whose bikes or docks
+        changed (all of them if a chunk starts), at its last_updated (or
+        now if the feed has none). Bikes and docks are -1 while a station
+        is missing from the feed. If the status follows the last one
+        appended, its changed stations are taken instead of compared.
+        '''
+        codes = self.codes(status.stations)
+        bikes, docks = status.bikes, status.docks
+        with self._lock:
+            if len(self._bikes) < len(self._ids):
+                grow = len(self._ids) - len(self._bikes)
+                self._bikes = np.concatenate([self._bikes,
+                                              np.full(grow, -2, np.int64)])
+                self._docks = np.concatenate([self._docks,
+                                              np.full(grow, -2, np.int64)])
+            if self._count == 0:
+                changed = np.arange(len(codes))
+            elif self._last == (status.stations, status.version - 1):
+                changed = status.changed   # Found by the poller
+            else:
+                changed = np.flatnonzero((self._bikes[codes] != bikes) |
+                                         (self._docks[codes] != docks))
+            self._last = (status.stations, status.version)
+            self._bikes[codes], self._docks[codes] = bikes, docks
+            if len(changed):
+                t = status.last_updated or int(time.time())
+                self._open.append((codes[changed],
+                                   np.full(len(changed), t, np.int64),
+                                   bikes[changed], docks[changed]))
+                self._count += len(changed)
+            if self._count and (self._count >= self.chunk_records or
+                                self.last_time() - self.open_time() >=
+                                self.chunk_seconds):
+                self.flush()
+
+    def open_columns(self):
+        ''' Returns the columns of the records of the open chunk. '''
+        return [np.concatenate(c).astype(t) for c, t in
+                zip(zip(*self._open), COLUMNS)]
+
+    def open_time(self):
+        return int(self._open[0][1][0]) if self._count else None
+
+    def last_time(self):
+        ''' Time of the last status recorded, or None. '''
+        with self._lock:
+            if self._count:
+                return int(self._open[-1][1][0])
+            return self._chunks[-1][1] if self._chunks else None
+
+    def flush(self):
+        ''' Writes the open chunk at the end of the file. '''
+        with self._lock:
+            if not self._count:
+                return
+            columns = self.open_columns()
+            order = np.lexsort((columns[1], columns[0]))   # Station, time
+            payload = zlib.compress(b''.join(c[order].tobytes()
+                                             for c in columns))
+            first, last = int(columns[1].min()), int(columns[1].max())
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'ab') as file:
+                offset = file.seek(0, os.SEEK_END)
+                file.write(HEADER.pack(MAGIC, first, last, self._count,
+                                       len(payload), zlib.crc32(payload)))
+                file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+            self._chunks.append((first, last, offset + HEADER.size,
+                                 len(payload), self._count))
+            self._firsts.append(first)
+            self._open, self._count = [], 0
+
+    close = flush
+
+    def chunk(self, i):
+        ''' Returns the columns of chunk i, decompressed from the map. '''
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+            first, last, offset, size, count = self._chunks[i]
+            if self._map is None or len(self._map) < offset + size:
+                self._map = np.memmap(self.path, np.uint8, 'r')
+            data = self._map
+        raw = zlib.decompress(data[offset:offset + size])
+        columns, start = [], 0
+        for t in COLUMNS:
+            columns.append(np.frombuffer(raw, t, count, start))
+            start += count * np.dtype(t).itemsize
+        with self._lock:
+            if i not in self._cache:
+                self._cache[i] = columns
+                self._cached += len(raw)
+            while self._cached > CHUNK_CACHE_BYTES and len(self._cache) > 1:
+                j, old = self._cache.popitem(last=False)
+                self._cached -= sum(c.nbytes for c in old)
+        return columns
+
+    def query(self, station_id, start, end):
+        '''
+        Returns the times (s), bikes and docks of a station from start to
+        end: its status at start, if it was known, and every change until
+        end. Only the chunks that overlap the window are read.
+        '''
+        empty = (np.empty(0, np.int64), np.empty(0, np.int16),
+                 np.empty(0, np.int16))
+        code = self._codes.get(station_id)
+        if code is None:
+            return empty
+        with self._lock:
+            # The chunk that starts last before start has the status at start
+            first = max(bisect_right(self._firsts, start) - 1, 0)
+            stop = bisect_right(self._firsts, end)
+            chunks = range(first, stop)
+            opened = self.open_columns() if self._count and \
+                self.open_time() <= end else None
+
+        parts = []
+        for i in chunks:
+            station, times, bikes, docks = self.chunk(i)
+            a, b = np.searchsorted(station, [code, code + 1])
+            parts.append((times[a:b], bikes[a:b], docks[a:b]))
+        if opened is not None:
+            mine = opened[0] == code
+            parts.append(tuple(c[mine] for c in opened[1:]))
+        if not parts:
+            return empty
+
+        times, bikes, docks = (np.concatenate(c) for c in zip(*parts))
+        a = max(np.searchsorted(times, start, 'right') - 1, 0)
+        b = np.searchsorted(times, end, 'right')
+        times, bikes, docks = times[a:b].copy(), bikes[a:b], docks[a:b]
+        if len(times) and times[0] < start:
+            times[0] = start
+        return times, bikes, docks
+
+    def station_id(self, text):
+        ''' Returns the recorded station id written as text, or None. '''
+        for id in (int(text) if text.lstrip('-').isdigit() else None, text):
+            if id in self._codes:
+                return id
+        return None
+
+    @property
+    def nbytes(self):
+        ''' Bytes of the file. '''
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
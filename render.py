@@ -0,0 +1,325 @@
+'''© fergascod & asleix'''
+
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
+import os
+import tempfile
+import threading
+
+from PIL import Image, ImageDraw
+import requests
+from staticmap import StaticMap, Line
+from staticmap.staticmap import _lat_to_y, _lon_to_x
+
+
+# Map tiles. The template can also be a local path, such as
+# /srv/tiles/{z}/{x}/{y}.png, so maps can be drawn with no network.
+TILE_URL = os.environ.get('BICING_TILE_URL',
+                          'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png')
+
+# Directory where downloaded tiles are kept, and tiles kept in memory.
+TILE_CACHE = os.environ.get('BICING_TILE_CACHE', os.path.join('cache', 'tiles'))
+TILE_MEMORY = int(os.environ.get('BICING_TILE_MEMORY', 256))
+
+# Memory (bytes) for rendered maps, and maps whose Telegram file_id is kept.
+IMAGE_CACHE_BYTES = int(os.environ.get('BICING_IMAGE_CACHE_BYTES', 64 << 20))
+IMAGE_CACHE_ENTRIES = 1024
+
+# Bounding box of Barcelona (min lon, min lat, max lon, max lat) and size
+# of the maps in pixels.
+CITY = (2.05, 41.32, 2.25, 41.47)
+SIZE = 800
+
+
+class TileStore:
+    '''
+    Map tiles by url, kept in memory (least recently used first out) and
+    on disk. Tiles are only downloaded when they are in neither. Tiles from
+    a local path are read directly and only kept in memory.
+    '''
+    def __init__(self, directory=None, capacity=None):
+        self.directory = TILE_CACHE if directory is None else directory
+        self.capacity = TILE_MEMORY if capacity is None else capacity
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, url):
+        ''' Returns the file of the disk cache for url. '''
+        name = hashlib.sha1(url.encode()).hexdigest() + '.png'
+        return os.path.join(self.directory, name[:2], name)
+
+    def fetch(self, url, **kwargs):
+        ''' Returns the status code and content of url, without memory. '''
+        if not url.startswith(('http://', 'https://')):
+            if not os.path.exists(url):
+                return 404, None
+            with open(url, 'rb') as file:
+                return 200, file.read()
+
+        path = self.path(url)
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                return 200, file.read()
+
+        response = requests.get(url, **kwargs)
+        if response.status_code == 200:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Unique among the threads and the processes drawing maps
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(response.content)
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return response.status_code, response.content
+
+    def get(self, url, **kwargs):
+        ''' Returns the status code and content of the tile at url. '''
+        with self._lock:
+            if url in self._tiles:
+                self._tiles.move_to_end(url)
+                return 200, self._tiles[url]
+
+        status, content = self.fetch(url, **kwargs)
+        if status == 200:
+            with self._lock:
+                self._tiles[url] = content
+                while len(self._tiles) > self.capacity:
+                    self._tiles.popitem(last=False)
+        return status, content
+
+
+class Map(StaticMap):
+    ''' StaticMap that takes its tiles from a TileStore. '''
+    def __init__(self, width, height, tiles, url_template):
+        super().__init__(width, height, url_template=url_template)
+        self.tiles = tiles
+
+    def get(self, url, **kwargs):
+        return self.tiles.get(url, **kwargs)
+
+    def center_on(self, zoom, center):
+        ''' Sets the zoom and center (lon, lat) used to draw the features. '''
+        self.zoom = zoom
+        self.x_center = _lon_to_x(center[0], zoom)
+        self.y_center = _lat_to_y(center[1], zoom)
+
+
+class Renderer:
+    '''
+    Draws maps of the city. The base layer of the city (its tiles) is
+    rendered once, and maps of the city draw their lines and markers over
+    a copy. Maps zoomed to fit their features, or with features out of the
+    city, are rendered completely, with the tiles from the TileStore.
+    '''
+    def __init__(self, size=SIZE, bbox=CITY, url_template=None, tiles=None):
+        self.size = size
+        self.bbox = bbox
+        self.url_template = url_template or TILE_URL
+        self.tiles = tiles or TileStore()
+        self._base = None
+        self._lock = threading.Lock()
+
+    def new_map(self):
+        return Map(self.size, self.size, self.tiles, self.url_template)
+
+    def base(self):
+        ''' Returns the base layer of the city, its zoom and its center. '''
+        with self._lock:
+            if self._base is None:
+                lon1, lat1, lon2, lat2 = self.bbox
+                mapa = self.new_map()
+                mapa.add_line(Line([[lon1, lat1], [lon2, lat2]], 'white', 1))
+                zoom = mapa._calculate_zoom()
+                center = [(lon1 + lon2) / 2, (lat1 + lat2) / 2]
+                image = self.new_map().render(zoom=zoom, center=center)
+                self._base = (image, zoom, center)
+            return self._base
+
+    def inside(self, mapa):
+        ''' Tells whether all the features of mapa are in the city. '''
+        lon1, lat1, lon2, lat2 = mapa.determine_extent()
+        return (self.bbox[0] <= lon1 and self.bbox[1] <= lat1 and
+                lon2 <= self.bbox[2] and lat2 <= self.bbox[3])
+
+    def render(self, lines=(), markers=(), fit=False):
+        '''
+        Returns a buffer with the PNG image of the map with the features.
+        With fit, the map is zoomed to the features instead of the city.
+        '''
+        mapa = self.new_map()
+        for line in lines:
+            mapa.add_line(line)
+        for marker in markers:
+            mapa.add_marker(marker)
+
+        if not fit and self.inside(mapa):
+            base, zoom, center = self.base()
+            image = base.copy()
+            mapa.center_on(zoom, center)
+            mapa._draw_features(image)
+        else:
+            image = mapa.render()
+
+        buffer = BytesIO()
+        image.save(buffer, format='PNG')
+        buffer.seek(0)
+        return buffer
+
+
+class ImageCache:
+    '''
+    Rendered maps (PNG bytes) by key, shared by all users. Once a map has
+    been sent, Telegram's file_id is kept instead of its bytes, so it can be
+    sent again without uploading it. The least recently used maps are
+    evicted when their bytes exceed max_bytes.
+    '''
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = IMAGE_CACHE_BYTES if max_bytes is None else max_bytes
+        self.max_entries = (IMAGE_CACHE_ENTRIES if max_entries is None
+                            else max_entries)
+        self.bytes = 0
+        self._images = OrderedDict()   # key -> PNG bytes or file_id
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns the file_id of the map with key, or a buffer with its PNG
+        image, or None if it is not cached.
+        '''
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                return None
+            self._images.move_to_end(key)
+        return BytesIO(image) if isinstance(image, bytes) else image
+
+    def _set(self, key, image):
+        old = self._images.pop(key, None)
+        if isinstance(old, bytes):
+            self.bytes -= len(old)
+        self._images[key] = image
+        if isinstance(image, bytes):
+            self.bytes += len(image)
+        while (self.bytes > self.max_bytes or
+               len(self._images) > self.max_entries) and len(self._images) > 1:
+            key, old = self._images.popitem(last=False)
+            if isinstance(old, bytes):
+                self.bytes -= len(old)
+
+    def put(self, key, png):
+        ''' Keeps the PNG bytes of a map, unless it was already sent. '''
+        with self._lock:
+            if not isinstance(self._images.get(key, b''), str):
+                self._set(key, png)
+
+    def sent(self, key, file_id):
+        ''' Keeps the Telegram file_id of a sent map instead of its bytes. '''
+        with self._lock:
+            self._set(key, file_id)
+
+
+renderer = Renderer()
+images = ImageCache()
+
+
+def png(lines, markers, fit=False):
+    ''' Returns the PNG image of a map, see Renderer.render. '''
+    return renderer.render(lines, markers, fit).getvalue()
+
+
+def gradient(t):
+    ''' Colour (r, g, b) of t in [0, 1], from green (0) to red (1). '''
+    return (int(255 * min(1, 2 * t)), int(255 * min(1, 2 * (1 - t))), 0)
+
+
+def heatmap(rows, columns, values, cell=(56, 28)):
+    '''
+    Returns the PNG image of a table of values (None for missing ones),
+    with a cell of size (width, height) for every value, from green (the
+    lowest) to red (the highest), and rows and columns as labels.
+    '''
+    width, height = cell
+    image = Image.new('RGB', (width * (len(columns) + 1),
+                              height * (len(rows) + 1)), 'white')
+    draw = ImageDraw.Draw(image)
+    known = [v for row in values for v in row if v is not None]
+    low, high = (min(known), max(known)) if known else (0, 0)
+
+    def text(x, y, label):
+        left, top, right, bottom = draw.textbbox((0, 0), label)
+        draw.text((x + (width - right) / 2, y + (height - bottom) / 2),
+                  label, fill='black')
+
+    text(0, 0, 'b \\ d')
+    for j, column in enumerate(columns):
+        text(width * (j + 1), 0, str(column))
+    for i, row in enumerate(rows):
+        text(0, height * (i + 1), str(row))
+        for j, value in enumerate(values[i]):
+            x, y = width * (j + 1), height * (i + 1)
+            if value is None:
+                colour, label = (200, 200, 200), '-'
+            else:
+                colour = gradient((value - low) / (high - low)
+                                  if high > low else 0)
+                label = '%.1f' % value
+            draw.rectangle([x, y, x + width - 1, y + height - 1], fill=colour,
+                           outline='white')
+            text(x, y, label)
+
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def steps(xs, ys, xmax, mark=None, labels=('', ''), size=(800, 500),
+          series=()):
+    '''
+    Returns the PNG image of a step chart: the value is ys[i] from xs[i] to
+    xs[i+1] (and to xmax after the last one). With mark, a vertical line is
+    drawn at that x. labels are the names of the axes. series are more
+    lines over the same xs, as (ys, colour, name), named in a legend with
+    the first one (named labels[1]).
+    '''
+    width, height = size
+    left, right, top, bottom = 60, 20, 20, 50
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    series = [(ys, 'blue', labels[1])] + list(series)
+    ymax = max(max(max(ys, default=0) for ys, colour, name in series), 1)
+
+    def point(x, y):
+        return (left + (width - left - right) * x / xmax,
+                height - bottom - (height - top - bottom) * y / ymax)
+
+    # Axes with five ticks each
+    draw.line([point(0, ymax), point(0, 0), point(xmax, 0)], fill='black')
+    for t in range(6):
+        x, y = point(xmax * t / 5, 0)
+        draw.line([(x, y), (x, y + 4)], fill='black')
+        draw.text((x - 10, y + 8), '%g' % (xmax * t / 5), fill='black')
+        x, y = point(0, ymax * t / 5)
+        draw.line([(x - 4, y), (x, y)], fill='black')
+        draw.text((5, y - 6), '%d' % round(ymax * t / 5), fill='black')
+    draw.text((width / 2, height - 18), labels[0], fill='black')
+    draw.text((5, 3), labels[1], fill='black')
+
+    if mark is not None:
+        draw.line([point(mark, 0), point(mark, ymax)], fill=(200, 200, 200))
+    for k, (ys, colour, name) in enumerate(series):
+        line = []
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            end = xs[i + 1] if i + 1 < len(xs) else xmax
+            line += [point(x, y), point(end, y)]
+        draw.line(line, fill=colour, width=2)
+        if len(series) > 1:
+            draw.text((width - right - 80, top + 14 * k), name, fill=colour)
+
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
@@ -0,0 +1,168 @@
+'''© fergascod & asleix'''
+
+from collections import namedtuple, OrderedDict
+import os
+import sqlite3
+import threading
+import time
+
+
+# SQLite file of the sessions, so several bot processes can share them.
+# When it is not set, sessions are only kept in memory.
+SESSION_DB = os.environ.get('BICING_SESSION_DB')
+
+# Seconds a session is kept since it was last used.
+SESSION_TTL = float(os.environ.get('BICING_SESSION_TTL', 30 * 24 * 3600))
+
+# Memory (bytes) for the sessions kept in memory.
+SESSION_CACHE_BYTES = int(os.environ.get('BICING_SESSION_CACHE_BYTES',
+                                         16 << 20))
+
+# Approximate memory (bytes) of a session in memory: its entry in the
+# ordered dict, the user id and the list (see benchmarks/bench_sessions.py).
+SESSION_BYTES = 270
+
+
+# State of a user: the distance (m) of their graph and the version of the
+# snapshot it belongs to (None for the current one).
+Session = namedtuple('Session', ['distance', 'version'])
+
+
+class MemorySessions:
+    '''
+    Sessions kept in memory, evicting the least recently used ones when
+    they take more than max_bytes and those not used for ttl seconds.
+    '''
+    def __init__(self, ttl=None, max_bytes=None):
+        self.ttl = SESSION_TTL if ttl is None else ttl
+        max_bytes = SESSION_CACHE_BYTES if max_bytes is None else max_bytes
+        self.max_sessions = max(1, max_bytes // SESSION_BYTES)
+        self._sessions = OrderedDict()   # user -> [distance, version, used]
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        ''' Returns the Session of user, or None. '''
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(user)
+            if entry is None:
+                return None
+            if now - entry[2] > self.ttl:
+                del self._sessions[user]
+                return None
+            entry[2] = now
+            self._sessions.move_to_end(user)
+            return Session(entry[0], entry[1])
+
+    def set(self, user, distance, version=None):
+        with self._lock:
+            self._sessions[user] = [distance, version, time.time()]
+            self._sessions.move_to_end(user)
+            self._evict()
+
+    def restore(self, distances):
+        ''' Adds the sessions {user: distance} of the users without one. '''
+        now = time.time()
+        with self._lock:
+            for user, distance in distances.items():
+                if user not in self._sessions:
+                    self._sessions[user] = [distance, None, now]
+                    self._sessions.move_to_end(user, last=False)
+            self._evict()
+
+    def _evict(self):
+        sessions, now = self._sessions, time.time()
+        while len(sessions) > self.max_sessions:
+            sessions.popitem(last=False)
+        while sessions:   # The oldest are first
+            user, entry = next(iter(sessions.items()))
+            if now - entry[2] <= self.ttl:
+                break
+            del sessions[user]
+
+    def distances(self):
+        ''' Returns the distance of every user with a session. '''
+        with self._lock:
+            return {user: entry[0] for user, entry in self._sessions.items()}
+
+    def __contains__(self, user):
+        return self.get(user) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteSessions:
+    '''
+    Sessions kept in a SQLite file that several processes can share.
+    Nothing is kept in memory, every lookup reads the file, so a change
+    made by one process is seen by the others at once. The time of last
+    use is only written once it is older than a hundredth of the ttl.
+    '''
+    def __init__(self, path, ttl=None):
+        self.ttl = SESSION_TTL if ttl is None else ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions '
+                         '(user INTEGER PRIMARY KEY, distance INTEGER, '
+                         'version INTEGER, used REAL)')
+        self._db.execute('DELETE FROM sessions WHERE used < ?',
+                         (time.time() - self.ttl,))
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        ''' Returns the Session of user, or None. '''
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT distance, version, used FROM '
+                                   'sessions WHERE user = ?',
+                                   (user,)).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                return None
+            if now - row[2] > self.ttl / 100:
+                self._db.execute('UPDATE sessions SET used = ? WHERE user = ?',
+                                 (now, user))
+                self._db.commit()
+        return Session(row[0], row[1])
+
+    def set(self, user, distance, version=None):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO sessions VALUES '
+                             '(?, ?, ?, ?)', (user, distance, version,
+                                              time.time()))
+            self._db.commit()
+
+    def restore(self, distances):
+        ''' Adds the sessions {user: distance} of the users without one. '''
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR IGNORE INTO sessions VALUES '
+                                 '(?, ?, NULL, ?)',
+                                 [(user, distance, now)
+                                  for user, distance in distances.items()])
+            self._db.commit()
+
+    def distances(self):
+        ''' Returns the distance of every user with a session. '''
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT user, distance FROM sessions WHERE used >= ?',
+                (time.time() - self.ttl,)))
+
+    def __contains__(self, user):
+        return self.get(user) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM sessions'
+                                    ).fetchone()[0]
+
+
+def store(path=None):
+    ''' Returns the session store: SQLite if path (SESSION_DB by default)
+        is given, in memory otherwise. '''
+    path = path or SESSION_DB
+    return SQLiteSessions(path) if path else MemorySessions()
@@ -0,0 +1,125 @@
+'''© fergascod & asleix'''
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+
+
+# Processes for CPU heavy work (graph building, flows, maps). With 0, the
+# work is done in the thread of the request.
+CPU_WORKERS = int(os.environ.get('BICING_CPU_WORKERS', os.cpu_count() or 1))
+
+# Threads running the requests, which mostly wait for I/O
+# (downloads, geocoding, Telegram) or for the processes.
+IO_WORKERS = int(os.environ.get('BICING_IO_WORKERS', 16))
+
+_lock = threading.Lock()
+_cpu_pool = None
+_io_pool = None
+
+
+def cpu_pool():
+    ''' Returns the process pool, started on first use. '''
+    global _cpu_pool
+    with _lock:
+        if _cpu_pool is None:
+            # Processes are spawned: forking a process with threads is unsafe
+            _cpu_pool = ProcessPoolExecutor(
+                CPU_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _cpu_pool
+
+
+def io_pool():
+    ''' Returns the thread pool, started on first use. '''
+    global _io_pool
+    with _lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(IO_WORKERS,
+                                          thread_name_prefix='request')
+        return _io_pool
+
+
+def cpu(fn, *args):
+    '''
+    Runs fn(*args) in the process pool and returns its result.
+    fn must be a module level function and its arguments picklable.
+    If a process of the pool dies (e.g. out of memory), the pool is
+    replaced and fn is run once more in the new one.
+    '''
+    if CPU_WORKERS <= 0 or multiprocessing.parent_process() is not None:
+        return fn(*args)
+    for retry in (True, False):
+        pool = cpu_pool()
+        try:
+            return pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            logging.warning('A process of the pool died running %s',
+                            fn.__name__)
+            discard(pool)
+            if not retry:
+                raise
+
+
+def discard(pool):
+    ''' Drops a broken process pool, so the next work starts a new one. '''
+    global _cpu_pool
+    with _lock:
+        if _cpu_pool is pool:
+            _cpu_pool = None
+    pool.shutdown(wait=False)
+
+
+def shutdown():
+    ''' Stops the pools, waiting for the running work. '''
+    global _cpu_pool, _io_pool
+    with _lock:
+        for pool in (_cpu_pool, _io_pool):
+            if pool is not None:
+                pool.shutdown()
+        _cpu_pool = _io_pool = None
+
+
+class Serializer:
+    '''
+    Runs requests in the thread pool. The requests of a user run one at a
+    time and in the order they arrived, while requests of different users
+    run concurrently.
+    '''
+    def __init__(self, pool=None):
+        self.pool = pool
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user, fn, *args, **kwargs):
+        ''' Queues fn(*args, **kwargs) after the pending requests of user. '''
+        with self._lock:
+            queue = self._queues.setdefault(user, deque())
+            queue.append((fn, args, kwargs))
+            if len(queue) > 1:
+                return   # Already being run
+        (self.pool or io_pool()).submit(self._run, user)
+
+    def pending(self):
+        ''' Returns the number of requests queued or running. '''
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _run(self, user):
+        ''' Runs the requests of user until the queue is empty. '''
+        while True:
+            with self._lock:
+                fn, args, kwargs = self._queues[user][0]
+            try:
+                fn(*args, **kwargs)
+            except Exception:   # Not handled by the request (bot.ErrorHandler)
+                logging.exception('Request of %s failed', user)
+            with self._lock:
+                queue = self._queues[user]
+                queue.popleft()
+                if not queue:
+                    del self._queues[user]
+                    return